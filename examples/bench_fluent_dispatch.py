@@ -0,0 +1,48 @@
+from __future__ import print_function
+import threading
+import timeit
+import uiautomatorminus as uiauto
+
+
+def main(number=20000):
+    '''client side cost of the fluent actions, rpc answered at once without serialization.'''
+    d = uiauto.Device(serial='bench', local_port=9008)
+    client = uiauto.JsonRPCClient(lambda method, *args, **kwargs: [] if method == 'getWatchers' else True)
+    d.server.jsonrpc = lambda timeout=None: client
+    d.info_cache.invalidate = lambda: None
+    obj = d(text="OK")
+    cases = [
+        ('d.press.home()', lambda: d.press.home()),
+        ('d.press(89)', lambda: d.press(89)),
+        ('d.open.notification()', lambda: d.open.notification()),
+        ('d.wait.idle()', lambda: d.wait.idle()),
+        ('d.screen.on()', lambda: d.screen.on()),
+        ('d.watchers', lambda: d.watchers),
+        ('obj.click()', lambda: obj.click()),
+        ('obj.click.topleft()', lambda: obj.click.topleft()),
+        ('obj.swipe.left()', lambda: obj.swipe.left()),
+        ('obj.scroll.horiz.forward()', lambda: obj.scroll.horiz.forward()),
+        ('obj.fling.vert.toEnd()', lambda: obj.fling.vert.toEnd()),
+        ('obj.wait.exists()', lambda: obj.wait.exists()),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print('{:<28} {:8.2f} us/call'.format(name, best / number * 1e6))
+
+    # one binding shared by threads, each choosing its own prop
+    press, errors = d.press, []
+
+    def worker(key):
+        for i in range(number // 10):
+            if getattr(press, key).kwargs != {'key': key}:
+                errors.append(key)
+    threads = [threading.Thread(target=worker, args=(key,)) for key in ('home', 'back', 'menu', 'power')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('shared binding across threads: {} mixed up calls'.format(len(errors)))
+
+
+if __name__ == '__main__':
+    main()
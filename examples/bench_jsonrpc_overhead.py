@@ -0,0 +1,36 @@
+from __future__ import print_function
+import json
+import timeit
+import uiautomatorminus as uiauto
+
+
+class Response(object):
+
+    content = b'{"jsonrpc": "2.0", "id": "1", "result": true}'
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class Session(object):
+
+    '''stands for requests.Session so only the client side is measured.'''
+
+    def post(self, url, **kwargs):
+        return Response()
+
+
+def main(number=20000):
+    d = uiauto.Device(serial='bench', local_port=9008)
+    d.server.session = Session()
+    cases = [
+        ('d.jsonrpc().ping()', lambda: d.jsonrpc().ping()),
+        ('d(text="OK").exists', lambda: d(text="OK").exists),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print('{:<24} {:8.1f} us/call'.format(name, best / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
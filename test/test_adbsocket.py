@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+from uiautomatorminus.adbsocket import AdbSocket
+
+
+def recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def payload(text):
+    data = text.encode('utf-8')
+    return ('%04x' % len(data)).encode('ascii') + data
+
+
+class FakeAdbServer(object):
+
+    '''adb server speaking the smart socket protocol for a single device.'''
+
+    def __init__(self, serial='emulator-5554'):
+        self.serial = serial
+        self.requests = []
+        self.forwards = []
+        self.files = {'/sdcard/remote.txt': b'x' * 100000}
+        self.shell_output = {}
+        self.hold = threading.Event()
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def request(self, conn):
+        service = recv_exactly(conn, int(recv_exactly(conn, 4), 16)).decode('utf-8')
+        self.requests.append(service)
+        return service
+
+    def handle(self, conn):
+        try:
+            service = self.request(conn)
+            if service == 'host:version':
+                conn.sendall(b'OKAY' + payload('0029'))
+            elif service == 'host:devices':
+                conn.sendall(b'OKAY' + payload('%s\tdevice\n' % self.serial))
+            elif service == 'host:list-forward':
+                conn.sendall(b'OKAY' + payload(''.join('%s %s %s\n' % f for f in self.forwards)))
+            elif service.startswith('host-serial:%s:forward:' % self.serial):
+                local, remote = service.split(':forward:')[1].split(';')
+                self.forwards.append((self.serial, local, remote))
+                conn.sendall(b'OKAY' + b'OKAY')
+            elif service == 'host:transport:%s' % self.serial:
+                conn.sendall(b'OKAY')
+                self.device_service(conn, self.request(conn))
+            else:
+                conn.sendall(b'FAIL' + payload('unknown service'))
+        except EOFError:
+            pass
+        finally:
+            conn.close()
+
+    def device_service(self, conn, service):
+        conn.sendall(b'OKAY')
+        if service.startswith('shell:') or service.startswith('exec:'):
+            command = service.split(':', 1)[1]
+            if command == 'hold':
+                self.hold.wait(5)
+            elif command.startswith('pm install'):
+                conn.sendall(b'Success\n' if command.split()[-1] in self.files else b'Failure\n')
+            elif command.startswith('rm -f'):
+                self.files.pop(command.split()[-1], None)
+            else:
+                conn.sendall(self.shell_output.get(command, b''))
+        elif service == 'sync:':
+            self.sync(conn)
+
+    def sync(self, conn):
+        while True:
+            sync_id, length = struct.unpack('<4sI', recv_exactly(conn, 8))
+            if sync_id == b'QUIT':
+                return
+            path = recv_exactly(conn, length).decode('utf-8')
+            if sync_id == b'SEND':
+                data = b''
+                while True:
+                    sync_id, length = struct.unpack('<4sI', recv_exactly(conn, 8))
+                    if sync_id == b'DONE':
+                        break
+                    data += recv_exactly(conn, length)
+                self.files[path.rsplit(',', 1)[0]] = data
+                conn.sendall(b'OKAY' + struct.pack('<I', 0))
+            elif sync_id == b'RECV':
+                if path not in self.files:
+                    message = b'No such file'
+                    conn.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+                    continue
+                data = self.files[path]
+                for i in range(0, len(data), 65536):
+                    chunk = data[i:i + 65536]
+                    conn.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                conn.sendall(b'DONE' + struct.pack('<I', 0))
+
+    def close(self):
+        self.hold.set()
+        self.sock.close()
+
+
+class TestAdbSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAdbServer()
+        self.adb = AdbSocket(adb_server_host='127.0.0.1', adb_server_port=self.server.port)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_host_services(self):
+        self.assertEqual(self.adb.version(), ['1.0.41', '1', '0', '41'])
+        self.assertEqual(self.adb.devices(), {'emulator-5554': 'device'})
+        self.assertEqual(self.adb.device_serial(), 'emulator-5554')
+        out = self.adb.raw_cmd('devices').communicate()[0]
+        self.assertEqual(out, b'List of devices attached\nemulator-5554\tdevice\n')
+
+    def test_forward(self):
+        self.assertEqual(self.adb.forward(9008, 9009), 0)
+        self.assertEqual(self.adb.forward_list(), [['emulator-5554', 'tcp:9008', 'tcp:9009']])
+        self.assertIn('host-serial:emulator-5554:forward:tcp:9008;tcp:9009', self.server.requests)
+
+    def test_shell(self):
+        self.server.shell_output['getprop ro.build.version.sdk'] = b'28\n'
+        process = self.adb.cmd('shell', 'getprop', 'ro.build.version.sdk')
+        self.assertEqual(process.communicate()[0], b'28\n')
+        self.assertEqual(process.returncode, 0)
+        self.assertEqual(process.poll(), 0)
+
+    def test_running_shell(self):
+        process = self.adb.cmd('shell', 'hold')
+        self.assertIsNone(process.poll())
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.communicate(timeout=0.1)
+        process.kill()
+        self.assertEqual(process.returncode, -9)
+        self.assertEqual(process.communicate(timeout=1), (b'', b''))
+
+    def test_failure(self):
+        adb = AdbSocket(serial='unknown', adb_server_host='127.0.0.1', adb_server_port=self.server.port)
+        process = adb.cmd('shell', 'ls')
+        self.assertIn(b'unknown service', process.communicate()[1])
+        self.assertEqual(process.returncode, 1)
+        self.assertEqual(adb.cmd('logcat').wait(), 1)
+
+    def test_no_server(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with self.assertRaises(EnvironmentError):
+            AdbSocket(adb_server_host='127.0.0.1', adb_server_port=port).devices()
+
+    def test_push_pull_install(self):
+        fd, local = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual(self.adb.cmd('pull', '/sdcard/remote.txt', local).wait(), 0)
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), self.server.files['/sdcard/remote.txt'])
+            self.assertEqual(self.adb.cmd('pull', '/sdcard/missing', local).wait(), 1)
+
+            self.assertEqual(self.adb.cmd('push', local, '/sdcard/copy.txt').wait(), 0)
+            self.assertEqual(self.server.files['/sdcard/copy.txt'], self.server.files['/sdcard/remote.txt'])
+
+            process = self.adb.cmd('install', '-r', '-t', local)
+            self.assertEqual(process.communicate()[0], b'Success\n')
+            self.assertEqual(process.returncode, 0)
+            remote = '/data/local/tmp/' + os.path.basename(local)
+            self.assertIn('exec:pm install -r -t %s' % remote, self.server.requests)
+            self.assertIn('exec:rm -f %s' % remote, self.server.requests)
+            self.assertNotIn(remote, self.server.files)
+        finally:
+            os.remove(local)
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from mock import AsyncMock, MagicMock, call, patch
+import requests
+from uiautomatorminus import JsonRPCError, InstrumentationError, Selector
+from uiautomatorminus.aio import (
+    HttpClient, AsyncAdb, AsyncAutomatorServer, AsyncDevice, AsyncDeviceObject,
+    AsyncDeviceNamedUiObject, jsonrpc_call)
+
+
+class FakeRpcServer(object):
+
+    '''JSON-RPC over HTTP/1.1 keep-alive, methods answered from a dict.'''
+
+    def __init__(self, loop, methods=None, chunked=False, close_after=False, batch=True):
+        self.methods = methods or {}
+        self.chunked = chunked
+        self.close_after = close_after
+        self.batch = batch
+        self.calls = []
+        self.requests = 0
+        self.connections = 0
+        self.server = loop.run_until_complete(asyncio.start_server(self.handle, '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                writer.write(self.respond(request_line, body))
+                await writer.drain()
+                if self.close_after:  # without telling the client
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, request_line, body):
+        self.requests += 1
+        if request_line.startswith(b'GET /screenshot.png'):
+            content = b'png'
+        else:
+            request = json.loads(body.decode('utf-8'))
+            if not isinstance(request, list):
+                reply = self.reply(request)
+            elif self.batch:
+                reply = [self.reply(r) for r in request]
+            else:
+                reply = {'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch'}}
+            content = json.dumps(reply).encode('utf-8')
+        if self.chunked:
+            half = len(content) // 2
+            payload = b''.join(b'%x\r\n%s\r\n' % (len(c), c) for c in (content[:half], content[half:]))
+            return b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' + payload + b'0\r\n\r\n'
+        return b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(content) + content
+
+    def reply(self, request):
+        self.calls.append((request['method'], request['params']))
+        result = self.methods.get(request['method'], True)
+        if callable(result):
+            result = result(request['params'])
+        if isinstance(result, dict) and 'code' in result:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': result}
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def close(self, loop):
+        self.server.close()
+        loop.run_until_complete(self.server.wait_closed())
+
+
+class AsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        pending = asyncio.all_tasks(self.loop)  # connection handlers of the fake server
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def await_(self, coro):
+        return self.loop.run_until_complete(asyncio.wait_for(coro, 10))
+
+
+class TestHttpClient(AsyncTestCase):
+
+    def test_keep_alive(self):
+        rpc = FakeRpcServer(self.loop, {'ping': 'pong'})
+        http = HttpClient()
+        try:
+            for i in range(3):
+                self.assertEqual(self.await_(jsonrpc_call(http, '127.0.0.1', rpc.port, 5, {'method': 'ping'})), 'pong')
+            self.assertEqual(rpc.connections, 1)
+        finally:
+            http.close()
+            rpc.close(self.loop)
+
+    def test_chunked(self):
+        rpc = FakeRpcServer(self.loop, {'dump': '<hierarchy/>' * 100}, chunked=True)
+        http = HttpClient()
+        try:
+            self.assertEqual(self.await_(jsonrpc_call(http, '127.0.0.1', rpc.port, 5, {'method': 'dump'})),
+                             '<hierarchy/>' * 100)
+        finally:
+            http.close()
+            rpc.close(self.loop)
+
+    def test_stale_connection(self):
+        rpc = FakeRpcServer(self.loop, {'ping': 'pong'}, close_after=True)
+        http = HttpClient()
+        try:
+            for i in range(2):
+                self.assertEqual(self.await_(jsonrpc_call(http, '127.0.0.1', rpc.port, 5, {'method': 'ping'})), 'pong')
+            self.assertEqual(rpc.connections, 2)
+        finally:
+            http.close()
+            rpc.close(self.loop)
+
+    def test_errors(self):
+        rpc = FakeRpcServer(self.loop, {'click': {'code': -32001, 'message': 'boom'}})
+        port = rpc.port
+        http = HttpClient()
+        try:
+            with self.assertRaises(JsonRPCError):
+                self.await_(jsonrpc_call(http, '127.0.0.1', port, 5, {'method': 'click'}))
+        finally:
+            http.close()
+            rpc.close(self.loop)
+        with self.assertRaises(requests.exceptions.ConnectionError) as cm:
+            self.await_(jsonrpc_call(http, '127.0.0.1', port, 5, {'method': 'click'}))
+        self.assertIn('refused', str(cm.exception).lower())
+
+
+class TestAsyncDevice(AsyncTestCase):
+
+    def setUp(self):
+        super(TestAsyncDevice, self).setUp()
+        self.rpc = FakeRpcServer(self.loop, {
+            'deviceInfo': {'displayWidth': 720, 'displayRotation': 1, 'screenOn': True},
+            'objInfo': {'text': 'OK', 'contentDescription': 'ok button'},
+            'count': 2,
+            'childByText': 'named-1',
+            'dumpWindowHierarchy': '<hierarchy rotation="0"/>',
+        })
+        self.server = AsyncAutomatorServer(serial='abcd', local_port=self.rpc.port, adb_server_host='127.0.0.1')
+        self.device = AsyncDevice(server=self.server)
+
+    def tearDown(self):
+        self.server.http.close()
+        self.rpc.close(self.loop)
+        super(TestAsyncDevice, self).tearDown()
+
+    def test_device(self):
+        d = self.device
+        self.assertEqual(self.await_(d.info)['displayWidth'], 720)
+        self.assertEqual(self.await_(d.width), 720)
+        self.assertEqual(self.await_(d.orientation), 'left')
+        self.assertEqual(self.await_(d.screen.state()), 'on')
+        self.assertTrue(self.await_(d.click(1, 2)))
+        self.assertTrue(self.await_(d.press.back()))
+        self.assertTrue(self.await_(d.wait.idle(timeout=100)))
+        self.await_(d.set_orientation('n'))
+        self.assertIn(('click', [1, 2]), self.rpc.calls)
+        self.assertIn(('pressKey', ['back']), self.rpc.calls)
+        self.assertIn(('waitForIdle', [100]), self.rpc.calls)
+        self.await_(d.wait.idle(timeout=0))
+        self.assertIn(('waitForIdle', [0]), self.rpc.calls)
+        self.assertIn(('setOrientation', ['natural']), self.rpc.calls)
+        self.assertTrue(self.await_(d.wait.stable(window_ms=0, timeout=5000)))
+        self.assertEqual(self.rpc.calls.count(('dumpWindowHierarchy', [True, None])), 3)
+
+    def test_batch(self):
+        self.rpc.methods['click'] = {'code': -32001, 'message': 'boom'}
+        self.server.recovery_policy.max_attempts = 0
+
+        async def batch():
+            async with self.device.batch() as b:
+                info = b.deviceInfo()
+                clicked = b.click(1, 2)
+            return info, clicked
+        requests_before = self.rpc.requests
+        info, clicked = self.await_(batch())
+        self.assertEqual(self.rpc.requests, requests_before + 1)
+        self.assertEqual(info.result()['displayWidth'], 720)
+        self.assertIsInstance(clicked.exception(), JsonRPCError)
+        with self.assertRaises(TypeError):
+            with self.device.batch():
+                pass
+
+        self.rpc.batch = False
+        info, clicked = self.await_(batch())
+        self.assertFalse(self.server.batch_supported)
+        self.assertEqual(info.result()['displayWidth'], 720)
+        self.assertIsInstance(clicked.exception(), JsonRPCError)
+
+    def test_object(self):
+        obj = self.device(text='OK')
+        self.assertIsInstance(obj, AsyncDeviceObject)
+        self.assertTrue(self.await_(obj.click()))
+        self.assertTrue(self.await_(obj.wait.exists(timeout=100)))
+        self.assertEqual(self.await_(obj.description), 'ok button')
+        self.assertEqual(self.await_(obj.count), 2)
+        selector = Selector(text='OK')
+        self.assertIn(('click', [selector]), self.rpc.calls)
+        self.assertIn(('waitForExists', [selector, 100]), self.rpc.calls)
+
+        async def collect():
+            return [o async for o in obj]
+        objects = self.await_(collect())
+        self.assertEqual([o.selector['instance'] for o in objects], [0, 1])
+        self.assertEqual([info.text for info in self.await_(obj.infos())], ['OK', 'OK'])
+        self.assertEqual([o.selector['instance'] for o in self.await_(obj.all())], [0, 1])
+        named = self.await_(obj.child_by_text('Wi-Fi', className='android.widget.LinearLayout'))
+        self.assertIsInstance(named, AsyncDeviceNamedUiObject)
+        self.assertEqual(named.selector, 'named-1')
+        with self.assertRaises(TypeError):
+            len(obj)
+
+    def test_dump_nodes(self):
+        self.rpc.methods['dumpWindowHierarchy'] = (
+            '<hierarchy rotation="0"><node text="a"><node text="b"/></node></hierarchy>')
+        nodes = list(self.await_(self.device.dump_nodes()))
+        self.assertEqual([node.get('text') for node in nodes], ['a', 'b'])
+        self.assertIs(nodes[1].parent, nodes[0])
+        self.assertIn(('dumpWindowHierarchy', [True, None]), self.rpc.calls)
+
+    def test_screenshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'screen.png')
+            self.assertEqual(self.await_(self.device.screenshot(filename)), filename)
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), b'png')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_screenshot_fallback(self):
+        self.server.screenshot = AsyncMock(return_value=None)
+        self.server.adb = MagicMock()
+        process = MagicMock()
+        process.stdout.read = AsyncMock(side_effect=[b'scr', b'een', b''])
+        process.wait = AsyncMock(return_value=0)
+        self.server.adb.cmd = AsyncMock(return_value=process)
+        out = io.BytesIO()
+        capture = self.await_(self.device.capture(out))
+        self.assertEqual((capture.source, capture.size), ('screencap', 6))
+        self.assertEqual(out.getvalue(), b'screen')
+        self.server.adb.cmd.assert_called_once_with('exec-out', 'screencap', '-p')
+
+    def test_capture_stream(self):
+        with self.assertRaises(TypeError):
+            self.device.capture_stream(fps=10)
+
+    def test_remote_exec(self):
+        results = [None, {'resultCode': 0, 'stdOutString': 'done'}]
+        self.rpc.methods['runScript'] = 'token'
+        self.rpc.methods['waitScriptResult'] = {'code': -32601, 'message': 'not found'}
+        self.rpc.methods['getScriptResult'] = lambda params: results.pop(0)
+        with patch('asyncio.sleep', AsyncMock()) as sleep:
+            self.assertEqual(self.await_(self.device.remote_exec('ls')), 'done')
+        sleep.assert_called_once_with(0.005)
+        self.assertFalse(self.server.long_poll_supported)
+
+    def test_remote_exec_long_poll(self):
+        replies = [{'output': 'do', 'result': None},
+                   {'output': 'ne', 'result': {'resultCode': 0, 'stdOutString': 'done'}}]
+        self.rpc.methods['runScript'] = 'token'
+        self.rpc.methods['waitScriptResult'] = lambda params: replies.pop(0)
+        output = []
+        self.assertEqual(self.await_(self.device.remote_exec('ls', on_output=output.append)), 'done')
+        self.assertEqual(output, ['do', 'ne'])
+        offsets = [params[1] for method, params in self.rpc.calls if method == 'waitScriptResult']
+        self.assertEqual(offsets, [0, 2])
+
+    def test_remote_exec_apk(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            apk = os.path.join(tmpdir, 'helper.apk')
+            with open(apk, 'wb') as f:
+                f.write(b'apk')
+            staged = []
+            self.rpc.methods['apkStaged'] = lambda params: params[0] in staged
+            self.rpc.methods['stageApkChunk'] = lambda params: staged.append(params[0]) or True
+            self.rpc.methods['runStagedApk'] = 'token'
+            self.rpc.methods['waitRunApkResult'] = {'output': 'do', 'result': {'stdOutString': 'done'}}
+            for i in range(2):
+                output = []
+                result = self.await_(self.device.remote_exec_apk(apk, 'Main', {}, on_output=output.append))
+                self.assertEqual(result, {'stdOutString': 'done'})
+                self.assertEqual(output, ['do', 'ne'])
+            methods = [method for method, _ in self.rpc.calls]
+            self.assertEqual(methods.count('stageApkChunk'), 1)
+            self.assertEqual(methods.count('apkStaged'), 1)
+            self.assertEqual(methods.count('runStagedApk'), 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_register(self):
+        handles = {}
+        self.rpc.methods['registerSelector'] = lambda params: handles.setdefault('s1', params[0]) and 's1'
+        self.rpc.methods['exist'] = lambda params: params[0] == {'handle': 's1'} or {'code': -32003, 'message': ''}
+        self.assertEqual(self.await_(self.device.register(text='OK')), 's1')
+        self.assertTrue(self.await_(self.device(text='OK').exists))
+        self.assertEqual(self.rpc.calls[-1], ('exist', [{'handle': 's1'}]))
+        self.assertEqual(handles['s1']['text'], 'OK')
+
+        self.rpc.methods['unregisterSelector'] = lambda params: handles.pop(params[0]) and True
+        self.await_(self.device.unregister(text='OK'))
+        self.assertEqual(self.rpc.calls[-1], ('unregisterSelector', ['s1']))
+        self.assertEqual(handles, {})
+        self.assertFalse(self.server.selector_registry.handles)
+
+    def test_fnf_handling(self):
+        results = [{'code': -32002, 'message': 'not found'}, True]
+        self.rpc.methods['click'] = lambda params: results.pop(0)
+        handled = []
+
+        async def handler(device):
+            handled.append(device)
+            return True
+        self.device.handlers.on(handler)
+        self.assertTrue(self.await_(self.device(text='OK').click()))
+        self.assertEqual(handled, [self.device])
+
+    def test_recovery(self):
+        results = [{'code': -32001, 'message': 'crashed', 'data': {'exceptionTypeName': 'RuntimeException'}}, True]
+        self.rpc.methods['click'] = lambda params: results.pop(0)
+        self.server.recover = AsyncMock()
+        self.assertTrue(self.await_(self.device.click(1, 2)))
+        self.server.recover.assert_called_once_with('restart')
+        self.assertEqual(self.server.recovery_policy.counters['recovered'], 1)
+
+        self.rpc.methods['click'] = {'code': -32002, 'message': 'not found'}
+        with self.assertRaises(JsonRPCError):
+            self.await_(self.device.click(1, 2))
+        self.assertEqual(self.server.recover.call_count, 1)
+
+
+class FakeProcess(object):
+
+    def __init__(self, output):
+        self.stdout = asyncio.StreamReader()
+        self.stdout.feed_data(output)
+        self.stdout.feed_eof()
+        self.returncode = None
+        self.kill = MagicMock()
+
+
+class TestAsyncAutomatorServer(AsyncTestCase):
+
+    def setUp(self):
+        super(TestAsyncAutomatorServer, self).setUp()
+        self.server = AsyncAutomatorServer(serial='abcd', local_port=9008)
+
+    def test_wait_device(self):
+        self.server.ping = AsyncMock(side_effect=[None, 'pong'])
+        self.server.uiautomator_process = FakeProcess(b'INSTRUMENTATION_STATUS_CODE: 1\n')
+        self.await_(self.server.wait_device(5))
+        self.assertEqual(self.server.ping.call_count, 2)
+        self.assertFalse(self.server.uiautomator_process.kill.called)
+
+    def test_wait_device_ended(self):
+        self.server.ping = AsyncMock(return_value=None)
+        process = self.server.uiautomator_process = FakeProcess(b'INSTRUMENTATION_FAILED: boom\n')
+        with self.assertRaises(InstrumentationError):
+            self.await_(self.server.wait_device(5))
+        self.assertTrue(process.kill.called)
+
+    def test_start(self):
+        for name in ('install', 'set_forwarding', 'start_instrumentation', 'wait_device'):
+            setattr(self.server, name, AsyncMock())
+        task = self.await_(self.server.start(timeout=3, wait=False))
+        self.await_(task)
+        self.server.install.assert_called_once_with(confirm=True)
+        self.server.wait_device.assert_called_once_with(3)
+
+    def test_start_reinstalls_after_skipped_install(self):
+        for name in ('set_forwarding', 'stop_instrumentation', 'start_instrumentation'):
+            setattr(self.server, name, AsyncMock())
+        self.server.install = AsyncMock(side_effect=[False, True])
+        self.server.wait_device = AsyncMock(side_effect=[IOError(), None])
+        with patch('uiautomatorminus.InstallCache.invalidate') as invalidate:
+            self.await_(self.server.start(timeout=3))
+        self.assertTrue(invalidate.called)
+        self.assertEqual(self.server.install.call_args_list, [call(confirm=False), call(force=True)])
+        self.assertEqual(self.server.start_instrumentation.call_count, 2)
+
+        self.server.install = AsyncMock(return_value=True)
+        self.server.wait_device = AsyncMock(side_effect=IOError())
+        with self.assertRaises(IOError):
+            self.await_(self.server.start(timeout=3))
+
+    def test_install_skipped(self):
+        self.server.adb.run = AsyncMock()
+        with patch('uiautomatorminus.InstallCache.check', return_value=True):
+            self.await_(self.server.install())
+        self.assertFalse(self.server.adb.run.called)
+
+    def test_restart(self):
+        for name in ('set_forwarding', 'stop_instrumentation', 'start_instrumentation', 'install'):
+            setattr(self.server, name, AsyncMock())
+        self.server.wait_device = AsyncMock(side_effect=[IOError(), None])
+        self.await_(self.server.restart())
+        self.server.install.assert_called_once_with(force=True)
+        self.assertEqual(self.server.start_instrumentation.call_count, 2)
+
+
+class TestAsyncAdb(AsyncTestCase):
+
+    def setUp(self):
+        super(TestAsyncAdb, self).setUp()
+        self.android_home = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.android_home, 'platform-tools'))
+        adb = os.path.join(self.android_home, 'platform-tools', 'adb')
+        with open(adb, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'case "$1" in\n'
+                    '  devices) printf "List of devices attached\\nemulator-5554\\tdevice\\n" ;;\n'
+                    '  forward) printf "emulator-5554 tcp:9010 tcp:9008\\n" ;;\n'
+                    '  *) echo "$@" ;;\n'
+                    'esac\n')
+        os.chmod(adb, stat.S_IRWXU)
+        self.environ = patch.dict(os.environ, {'ANDROID_HOME': self.android_home})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.android_home)
+        super(TestAsyncAdb, self).tearDown()
+
+    def test_commands(self):
+        with patch.dict(os.environ):
+            os.environ.pop('ANDROID_SERIAL', None)
+            adb = AsyncAdb()
+        self.assertEqual(self.await_(adb.resolve_serial()), 'emulator-5554')
+        self.assertEqual(adb.device_serial(), 'emulator-5554')
+        self.assertEqual(self.await_(adb.run('shell', 'getprop', 'ro.serialno')),
+                         (0, b'-s emulator-5554 shell getprop ro.serialno\n', b''))
+
+    def test_local_port(self):
+        server = AsyncAutomatorServer(serial='emulator-5554')
+        self.assertEqual(self.await_(server.resolve_local_port()), 9010)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from mock import MagicMock
+from uiautomatorminus import AutomatorDevice, Capture, CaptureStream
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class FakeCapture(object):
+
+    def __init__(self, fail_every=0):
+        self.count = 0
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+
+    def __call__(self, out):
+        with self.lock:
+            self.count += 1
+            count = self.count
+        if self.fail_every and count % self.fail_every == 0:
+            return Capture(None, 0, [('http', 0.001)])
+        out.write(PNG + str(count).encode('ascii'))
+        return Capture('http', len(PNG) + 1, [('http', 0.001)])
+
+
+class TestCaptureStream(unittest.TestCase):
+
+    def test_frames(self):
+        stream = CaptureStream(FakeCapture(), fps=100, size=4).start()
+        indexes = []
+        for frame in stream.frames():
+            indexes.append(frame.index)
+            if len(indexes) == 8:
+                stream.stop()
+        self.assertEqual(indexes, list(range(8)))
+        self.assertFalse(stream.running)
+        self.assertEqual(len(stream.buffer), 4)
+        self.assertEqual(stream.dropped, stream.captured - 4)
+        times = [frame.time for frame in stream.buffer]
+        self.assertEqual(times, sorted(times))
+
+    def test_errors(self):
+        stream = CaptureStream(FakeCapture(fail_every=2), fps=100).start()
+        frames = []
+        for frame in stream.frames(timeout=1):
+            frames.append(frame)
+            if len(frames) == 3:
+                break
+        stream.stop()
+        self.assertEqual([frame.index for frame in frames], [0, 1, 2])
+        self.assertGreaterEqual(stream.errors, 2)
+
+    def test_rate(self):
+        capture = FakeCapture()
+        with CaptureStream(capture, fps=20):
+            time.sleep(0.5)
+        self.assertTrue(5 <= capture.count <= 12, capture.count)
+
+    def test_save_on_failure(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with self.assertRaises(ValueError):
+                with CaptureStream(FakeCapture(), fps=100, failure_dir=tmpdir, failure_seconds=10) as stream:
+                    next(stream.frames())
+                    raise ValueError()
+            names = sorted(os.listdir(tmpdir))
+            self.assertTrue(names)
+            self.assertTrue(all(name.endswith('.png') for name in names))
+            with open(os.path.join(tmpdir, names[0]), 'rb') as f:
+                self.assertTrue(f.read().startswith(PNG))
+            self.assertEqual(stream.last(0), [])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_device(self):
+        device = AutomatorDevice(server=MagicMock())
+        device.server.screenshot.side_effect = lambda scale, quality, out: out.write(PNG) or len(PNG)
+        stream = device.capture_stream(fps=100, scale=0.5, quality=50)
+        frame = next(stream.frames())
+        stream.stop()
+        self.assertEqual(frame.data, PNG)
+        self.assertEqual(device.server.screenshot.call_args[0][:2], (0.5, 50))
@@ -2,11 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import base64
+import hashlib
+import io
 import re
 import os.path
 import codecs
+import shutil
+import tempfile
+import time
 from mock import MagicMock, call, patch
-from uiautomatorminus import AutomatorDevice, Selector
+from uiautomatorminus import AutomatorDevice, Selector, rect, ApkStager, JsonRPCError, ERROR_CODE_METHOD_NOT_FOUND, \
+    LONG_POLL_WAIT, RESULT_POLL_BACKOFF
 
 
 def fake_jsonrpc_method(rpc_client, method, **kwargs):
@@ -64,19 +71,114 @@ class TestDevice(unittest.TestCase):
             raw_xml = "".join(re.split(r"\n[ ]*", xml))
             method = self.fake_jsonrpc_method('dumpWindowHierarchy', return_value=raw_xml)
             self.assertTrue("\n  " in self.device.dump("/tmp/test.xml"))
+            nodes = list(self.device.dump_nodes())
+            self.assertEqual(len(nodes), 12)
+            self.assertEqual(nodes[1].parent, nodes[0])
+
+    def test_snapshot(self):
+        with codecs.open(os.path.join(os.path.dirname(__file__), "res", "layout.xml"), "r", encoding="utf8") as f:
+            xml = f.read()
+        method = self.fake_jsonrpc_method('dumpWindowHierarchy', return_value=xml)
+        snap = self.device.snapshot()
+        method.assert_called_once_with(False, None)
+
+        self.assertTrue(snap(text="Phone").exists)
+        self.assertFalse(snap.exists(text="Nothing"))
+        textviews = snap(className="android.widget.TextView")
+        self.assertEqual(textviews.count, 5)
+        self.assertEqual([obj.info["text"] for obj in textviews],
+                         ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual(textviews[3].selector["instance"], 3)
+        self.assertEqual([info.text for info in textviews.infos()], ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual([obj.text for obj in textviews.all()], ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual(snap(description="Apps").text, "")
+        hotseat = snap(resourceId="com.android.launcher:id/hotseat")
+        self.assertEqual(hotseat.child(clickable=True).count, 5)
+        self.assertEqual(hotseat.child(clickable=True)[1].text, "People")
+        self.assertEqual(snap(text="Phone").sibling(text="Browser").info["bounds"]["left"], 384)
+        with self.assertRaises(Exception):
+            snap(text="Nothing").info
+        people = snap.at(150, 750)
+        self.assertEqual(people.text, "People")
+        self.assertEqual(people.selector["instance"], 1)
+        self.assertEqual([obj.text for obj in snap.overlapping(rect(700, 90, 710, 200)) if obj.text],
+                         ["Phone", "People"])
+        self.assertEqual(snap(text="Phone").right(className="android.widget.TextView").text, "People")
+        self.assertEqual(snap(text="People").left(className="android.widget.TextView").text, "Phone")
+        self.assertEqual(snap(text="Phone").up(clickable=True).info["contentDescription"], "Home screen 3")
+        self.assertIsNone(snap(text="Phone").down(clickable=True))
+        self.assertEqual([c[0] for c in self.rpc_client.method_calls], ['dumpWindowHierarchy'])
+
+        compact = self.device.snapshot(compact=True)
+        self.assertEqual([obj.text for obj in compact(className="android.widget.TextView")],
+                         ["Phone", "People", "", "Messaging", "Browser"])
+        self.assertEqual(compact.at(150, 750).text, "People")
+
+        click = self.fake_jsonrpc_method('click', return_value=True)
+        self.assertTrue(snap(text="Phone").click())
+        click.assert_called_once_with(Selector(text="Phone"))
 
     def test_screenshot(self):
-        method = self.fake_jsonrpc_method('takeScreenshot', return_value='1.png')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "a.png")
+            self.device.server.screenshot = MagicMock()
+            self.device.server.screenshot.side_effect = lambda scale, quality, out: out.write(b"http") or 4
+            self.assertEqual(self.device.screenshot(filename, 0.5, 99), filename)
+            self.assertEqual(self.device.server.screenshot.call_args[0][:2], (0.5, 99))
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"http")
+
+            self.device.server.screenshot.side_effect = None
+            self.device.server.screenshot.return_value = None
+            self.device.server.adb.cmd = cmd = MagicMock()
+            cmd.return_value.stdout = io.BytesIO(b"screencap")
+            cmd.return_value.wait.return_value = 0
+            self.assertEqual(self.device.screenshot(filename), filename)
+            cmd.assert_called_once_with("exec-out", "screencap", "-p")
+            with open(filename, "rb") as f:
+                self.assertEqual(f.read(), b"screencap")
+
+            cmd.return_value.stdout = io.BytesIO(b"")
+            cmd.return_value.wait.return_value = 1
+            self.assertIsNone(self.device.screenshot(filename))
+            self.assertFalse(os.path.exists(filename))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_capture(self):
+        self.device.server.screenshot = MagicMock(return_value=None)
         self.device.server.adb.cmd = cmd = MagicMock()
-        self.device.server.screenshot = MagicMock()
-        self.device.server.screenshot.return_value = None
-        cmd.return_value.returncode = 0
-        self.assertEqual(self.device.screenshot("a.png", 1.0, 99), "a.png")
-        method.assert_called_once_with("screenshot.png", 1.0, 99)
-        self.assertEqual(cmd.call_args_list, [call("pull", "1.png", "a.png"), call("shell", "rm", "1.png")])
-
-        method = self.fake_jsonrpc_method('takeScreenshot', return_value=None)
-        self.assertEqual(self.device.screenshot("a.png", 1.0, 100), None)
+        cmd.return_value.stdout = io.BytesIO(b"x" * 100)
+        cmd.return_value.wait.return_value = 0
+        buf = io.BytesIO()
+        capture = self.device.capture(buf)
+        self.assertTrue(capture.ok)
+        self.assertEqual((capture.source, capture.size), ("screencap", 100))
+        self.assertEqual([source for source, _ in capture.timings], ["http", "screencap"])
+        self.assertGreaterEqual(capture.seconds, 0)
+        self.assertEqual(buf.getvalue(), b"x" * 100)
+
+    def test_capture_rewinds_partial_write(self):
+        self.device.server.screenshot = MagicMock(side_effect=lambda scale, quality, out: out.write(b"part") and None)
+        self.device.server.adb.cmd = cmd = MagicMock()
+        cmd.return_value.stdout = io.BytesIO(b"screencap")
+        cmd.return_value.wait.return_value = 0
+        buf = io.BytesIO(b"head")
+        buf.seek(4)
+        self.assertEqual(self.device.capture(buf).source, "screencap")
+        self.assertEqual(buf.getvalue(), b"headscreencap")
+
+        out = MagicMock(spec=["write"])
+        cmd.return_value.stdout = io.BytesIO(b"screencap")
+        self.assertTrue(self.device.capture(out).ok)
+        out.write.assert_called_once_with(b"screencap")
+
+        out = MagicMock(spec=["write"])
+        cmd.return_value.stdout = io.BytesIO(b"broken")
+        cmd.return_value.wait.return_value = 1
+        self.assertFalse(self.device.capture(out).ok)
+        self.assertFalse(out.write.called)
 
     def test_freeze_rotation(self):
         method = self.fake_jsonrpc_method('freezeRotation')
@@ -242,6 +344,30 @@ class TestDevice(unittest.TestCase):
         self.assertFalse(self.device.wait("idle", timeout=10))
         method.assert_called_once_with(10)
 
+        method.reset_mock()
+        self.device.wait.idle(timeout=0)
+        method.assert_called_once_with(0)
+        method.reset_mock()
+        self.device.wait.idle()
+        method.assert_called_once_with(1000)
+
+    def test_wait_stable(self):
+        method = self.fake_jsonrpc_method('dumpWindowHierarchy')
+        method.side_effect = ["a", "b", "b", "b"]
+        self.assertTrue(self.device.wait.stable(window_ms=0, timeout=5000))
+        self.assertEqual(method.call_count, 4)
+        method.assert_called_with(True, None)
+
+        method.side_effect = ("%d" % i for i in range(1000))
+        self.assertFalse(self.device.wait("stable", timeout=200))
+
+        method.reset_mock()
+        method.side_effect = ("%d" % i for i in range(1000))
+        with patch("time.sleep") as sleep:
+            self.assertFalse(self.device.wait.stable(timeout=0))
+        self.assertEqual(method.call_count, 1)
+        self.assertFalse(sleep.called)
+
     def test_wait_update(self):
         method = self.fake_jsonrpc_method('waitForWindowUpdate', return_value=True)
         self.assertTrue(self.device.wait.update(timeout=10, package_name="android"))
@@ -251,6 +377,10 @@ class TestDevice(unittest.TestCase):
         self.assertFalse(self.device.wait("update", timeout=100, package_name="android"))
         method.assert_called_once_with("android", 100)
 
+        method.reset_mock()
+        self.device.wait.update(timeout=0, package_name="android")
+        method.assert_called_once_with("android", 0)
+
     def test_get_info_attr(self):
         info = {"test_a": 1, "test_b": "string", "displayWidth": 720, "displayHeight": 1024}
         method = self.fake_jsonrpc_method('deviceInfo', return_value=info)
@@ -274,9 +404,231 @@ class TestDevice(unittest.TestCase):
             self.assertFalse(self.device.exists(text="..."))
 
 
+class TestDeviceInfoCache(unittest.TestCase):
+
+    def setUp(self):
+        self.device = AutomatorDevice(info_ttl=60)
+        self.device.server = MagicMock()
+        self.rpc_client = self.device.server.jsonrpc.return_value
+        self.info = {"productName": "walleye", "sdkInt": 28, "displayRotation": 0,
+                     "displayWidth": 720, "screenOn": True, "currentPackageName": "com.android.launcher"}
+        self.rpc_client.deviceInfo.side_effect = lambda: dict(self.info)
+
+    def test_cached(self):
+        self.assertEqual(self.device.width, 720)
+        self.assertEqual(self.device.orientation, "natural")
+        self.assertTrue(self.device.screen == "on")
+        self.assertEqual(self.device.info["sdkInt"], 28)
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 1)
+        self.assertEqual(self.device.currentPackageName, "com.android.launcher")
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 2)
+        self.assertEqual(self.device.timeout(10).width, 720)
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 2)
+
+    def test_ttl(self):
+        self.device.info_cache.ttl = 0.01
+        self.device.width
+        time.sleep(0.02)
+        self.device.width
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 2)
+
+    def test_invalidate(self):
+        self.device.width
+        self.info["displayRotation"] = 1
+        self.device.orientation = "l"
+        self.assertEqual(self.device.orientation, "left")
+        self.device.press.home()
+        self.device.wakeup()
+        self.device.freeze_rotation()
+        self.device.width
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 3)
+        self.device.sleep()
+        self.assertEqual(self.device.productName, "walleye")  # kept for the session
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 3)
+
+    def test_refresh(self):
+        info = self.device.info
+        self.info["screenOn"] = False
+        self.assertFalse(info.refresh()["screenOn"])
+        self.assertFalse(self.device.info["screenOn"])
+        self.assertEqual(self.rpc_client.deviceInfo.call_count, 2)
+
+    def test_disabled(self):
+        device = AutomatorDevice()
+        device.server = MagicMock()
+        device.width, device.width
+        self.assertEqual(device.server.jsonrpc.return_value.deviceInfo.call_count, 2)
+
+
 class TestDeviceWithSerial(unittest.TestCase):
 
     def test_serial(self):
         with patch('uiautomatorminus.AutomatorServer') as AutomatorServer:
             AutomatorDevice("abcdefhijklmn")
             AutomatorServer.assert_called_once_with(serial="abcdefhijklmn", local_port=None, adb_server_host=None, adb_server_port=None)
+
+
+class FakeStagingRpc(object):
+
+    '''stand-in of the server side of apk staging.'''
+
+    def __init__(self, supported=True):
+        self.supported = supported
+        self.store = {}
+        self.uploads = {}
+        self.calls = []
+
+    def __call(self, method):
+        self.calls.append(method)
+        if not self.supported and method != "runApk" and method != "getRunApkResult":
+            raise JsonRPCError(ERROR_CODE_METHOD_NOT_FOUND, "method not found")
+
+    def apkStaged(self, digest):
+        self.__call("apkStaged")
+        return digest in self.store
+
+    def stageApkChunk(self, digest, offset, size, data):
+        self.__call("stageApkChunk")
+        upload = self.uploads.setdefault(digest, bytearray())
+        assert offset == len(upload)
+        upload.extend(base64.b64decode(data))
+        if len(upload) == size:
+            assert hashlib.sha256(upload).hexdigest() == digest
+            self.store[digest] = bytes(self.uploads.pop(digest))
+        return True
+
+    def runStagedApk(self, digest, class_name, args):
+        self.__call("runStagedApk")
+        if digest not in self.store:
+            raise JsonRPCError(-32001, "not staged")
+        return "token"
+
+    def runApk(self, data, class_name, args):
+        self.__call("runApk")
+        return "token"
+
+    def getRunApkResult(self, token):
+        self.__call("getRunApkResult")
+        return {"token": token}
+
+
+class TestRemoteExecApk(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.apk = os.path.join(self.tmpdir, "helper.apk")
+        with open(self.apk, "wb") as f:
+            f.write(b"apk content " * 10)
+        self.device = AutomatorDevice(server=MagicMock())
+        self.device.server.apk_stager = ApkStager(chunk_size=50)
+        self.device.server.long_poll_supported = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_apk(self, rpc):
+        self.device.server.jsonrpc.return_value = rpc
+        rpc.calls = []
+        self.assertEqual(self.device.remote_exec_apk(self.apk, "Main", {}), {"token": "token"})
+        return [method for method in rpc.calls if method != "getRunApkResult"]
+
+    def test_staged_once(self):
+        rpc = FakeStagingRpc()
+        self.assertEqual(self.run_apk(rpc), ["apkStaged"] + ["stageApkChunk"] * 3 + ["runStagedApk"])
+        self.assertEqual(self.run_apk(rpc), ["runStagedApk"])
+        self.assertEqual(len(rpc.store), 1)
+
+    def test_staged_lost(self):
+        rpc = FakeStagingRpc()
+        self.run_apk(rpc)
+        rpc.store.clear()  # e.g. the server restarted
+        self.assertEqual(self.run_apk(rpc), ["runStagedApk", "apkStaged"] + ["stageApkChunk"] * 3 + ["runStagedApk"])
+        self.device.server.apk_stager.staged.clear()  # e.g. a new session
+        self.assertEqual(self.run_apk(rpc), ["apkStaged", "runStagedApk"])
+
+    def test_not_supported(self):
+        rpc = FakeStagingRpc(supported=False)
+        self.assertEqual(self.run_apk(rpc), ["apkStaged", "runApk"])
+        self.assertEqual(self.run_apk(rpc), ["runApk"])
+
+
+class FakeScriptRpc(object):
+
+    '''stand-in of a server running a script which writes one output chunk per poll.'''
+
+    def __init__(self, chunks, long_poll=True):
+        self.chunks = list(chunks)
+        self.written = ""
+        self.long_poll = long_poll
+        self.calls = []
+
+    def runScript(self, text):
+        return "token"
+
+    def __step(self):
+        if self.chunks:
+            self.written += self.chunks.pop(0)
+        if not self.chunks:
+            return {"resultCode": 0, "stdOutString": self.written, "stdErrString": ""}
+
+    def waitScriptResult(self, token, offset, wait):
+        self.calls.append(("waitScriptResult", offset, wait))
+        if not self.long_poll:
+            raise JsonRPCError(ERROR_CODE_METHOD_NOT_FOUND, "method not found")
+        result = self.__step()
+        return {"output": self.written[offset:], "result": result}
+
+    def getScriptResult(self, token):
+        self.calls.append(("getScriptResult",))
+        return self.__step()
+
+
+class TestRemoteExec(unittest.TestCase):
+
+    def setUp(self):
+        self.device = AutomatorDevice(server=MagicMock())
+        self.device.server.long_poll_supported = True
+
+    def test_long_poll(self):
+        rpc = FakeScriptRpc(["a", "bc", "d"])
+        self.device.server.jsonrpc.return_value = rpc
+        output = []
+        with patch("time.sleep") as sleep:
+            self.assertEqual(self.device.remote_exec("ls", on_output=output.append), "abcd")
+        self.assertEqual(output, ["a", "bc", "d"])
+        self.assertEqual([call[1] for call in rpc.calls], [0, 1, 3])
+        self.assertTrue(all(0 < call[2] <= LONG_POLL_WAIT for call in rpc.calls))
+        self.assertFalse(sleep.called)
+
+    def test_backoff(self):
+        rpc = FakeScriptRpc(["a", "b", "c", "d", "e"], long_poll=False)
+        self.device.server.jsonrpc.return_value = rpc
+        output = []
+        with patch("time.sleep") as sleep:
+            self.assertEqual(self.device.remote_exec("ls", on_output=output.append), "abcde")
+        self.assertEqual(output, ["abcde"])
+        self.assertFalse(self.device.server.long_poll_supported)
+        delays = [args[0] for args, _ in sleep.call_args_list]
+        self.assertEqual(delays, [RESULT_POLL_BACKOFF[0] * 2 ** i for i in range(4)])
+        rpc.calls = []
+        rpc.chunks = ["f"]
+        self.device.remote_exec("ls")
+        self.assertEqual(rpc.calls, [("getScriptResult",)])
+
+    def test_timeout(self):
+        rpc = FakeScriptRpc(["a"] * 10)
+        self.device.server.jsonrpc.return_value = rpc
+        with patch("time.time", side_effect=[0, 0, 0.5, 1.5]):
+            with self.assertRaises(RuntimeError):
+                self.device.remote_exec("ls", timeout=1000)
+        self.assertEqual([call[2] for call in rpc.calls], [1000, 500])
+
+    def test_apk_output_tail(self):
+        self.device.server.long_poll_supported = False
+        rpc = self.device.server.jsonrpc.return_value
+        rpc.getRunApkResult.return_value = {"stdOutString": "done"}
+        output = []
+        with patch.object(AutomatorDevice, "_AutomatorDevice__run_apk", return_value="token"):
+            result = self.device.remote_exec_apk("helper.apk", "Main", {}, on_output=output.append)
+        self.assertEqual(result, {"stdOutString": "done"})
+        self.assertEqual(output, ["done"])
@@ -3,7 +3,9 @@
 
 import unittest
 from mock import MagicMock, call
-from uiautomatorminus import AutomatorDeviceObject, Selector, AutomatorDeviceNamedUiObject
+from uiautomatorminus import AutomatorDeviceObject, Selector, AutomatorDeviceNamedUiObject, Snapshot, \
+    FrozenSelector, JsonRPCBatch, JsonRPCError, ERROR_CODE_FILE_NOT_FOUND
+from uiautomatorminus.hierarchy import Hierarchy
 
 
 class TestDeviceObjInit(unittest.TestCase):
@@ -32,6 +34,7 @@ class TestDeviceObj(unittest.TestCase):
         self.device = MagicMock()
         self.rpc_client = MagicMock()
         self.device.server.jsonrpc.return_value = self.rpc_client
+        self.device.jsonrpc.return_value = self.rpc_client
         self.kwargs = {"text": "text", "className": "android"}
         self.obj = AutomatorDeviceObject(self.device,
                                          Selector(**self.kwargs))
@@ -105,6 +108,21 @@ class TestDeviceObj(unittest.TestCase):
         with self.assertRaises(AttributeError):
             self.obj.not_exists
 
+    def test_info_snapshot(self):
+        info = {'text': 'OK', 'enabled': True, 'bounds': {'left': 0, 'top': 0, 'right': 10, 'bottom': 20}}
+        method = self.fake_jsonrpc_method(method='objInfo', return_value=info)
+        self.assertEqual((self.obj.text, self.obj.enabled, self.obj.bounds.height), ('OK', True, 20))
+        self.assertEqual(method.call_count, 1)
+        self.assertIs(self.obj.snapshot(), self.obj.snapshot())
+        self.obj.refresh()
+        self.assertEqual(method.call_count, 2)
+        self.fake_jsonrpc_method(method='click', return_value=True)
+        self.obj.click()
+        self.obj.text
+        self.assertEqual(method.call_count, 3)
+        self.obj.info
+        self.assertEqual(method.call_count, 4)
+
     def test_text(self):
         method = self.fake_jsonrpc_method(method='clearTextField', return_value=None)
         self.obj.set_text(None)
@@ -330,6 +348,15 @@ class TestDeviceObj(unittest.TestCase):
         self.assertTrue(self.obj.wait.exists(timeout=10))
         method.assert_called_once_with(self.obj.selector, 10)
 
+    def test_wait_invalidates_info(self):
+        self.fake_jsonrpc_method(method='objInfo', return_value={'text': 'before'})
+        self.assertEqual(self.obj.text, 'before')
+        self.fake_jsonrpc_method(method='objInfo', return_value={'text': 'after'})
+        self.assertEqual(self.obj.text, 'before')  # kept until the next call
+        self.fake_jsonrpc_method(method='waitForExists', return_value=True)
+        self.obj.wait.exists()
+        self.assertEqual(self.obj.text, 'after')
+
     def test_child_by_text(self):
         method = self.fake_jsonrpc_method(method='childByText', return_value='myname')
         kwargs = {"className": "android", "text": "patern match text"}
@@ -392,58 +419,115 @@ class TestDeviceObj(unittest.TestCase):
         self.fake_jsonrpc_method(method='count', return_value=count)
         for index, inst in enumerate(self.obj):
             self.assertEqual(inst.selector["instance"], index)
+        self.assertEqual(self.rpc_client.count.call_count, 1)
+
+    def fake_batch(self, count, found=None):
+        self.fake_jsonrpc_method(method='count', return_value=count)
+        batches = []
+
+        def send_batch(calls):
+            batches.append(calls)
+            return [({"text": "t%d" % args[0]["instance"]}, None)
+                    if found is None or args[0]["instance"] < found else
+                    (None, JsonRPCError(ERROR_CODE_FILE_NOT_FOUND, "not found"))
+                    for method, args, kwargs in calls]
+        self.device.batch.side_effect = lambda: JsonRPCBatch(send_batch, None, lambda call: call)
+        return batches
+
+    def test_infos(self):
+        batches = self.fake_batch(5)
+        infos = list(self.obj.infos(chunk_size=2))
+        self.assertEqual([info.text for info in infos], ["t0", "t1", "t2", "t3", "t4"])
+        self.assertEqual([len(calls) for calls in batches], [2, 2, 1])
+        self.assertEqual(set(method for calls in batches for method, _, _ in calls), set(["objInfo"]))
+        self.assertEqual(self.rpc_client.count.call_count, 1)
+
+    def test_all(self):
+        self.fake_batch(3)
+        objs = list(self.obj.all())
+        self.assertEqual([obj.selector["instance"] for obj in objs], [0, 1, 2])
+        self.assertEqual([obj.text for obj in objs], ["t0", "t1", "t2"])
+        self.assertEqual(self.rpc_client.count.call_count, 1)
+        self.assertEqual(self.rpc_client.objInfo.call_count, 0)
+
+    def test_all_shrunk(self):
+        self.fake_batch(4, found=2)
+        self.assertEqual([info.text for info in self.obj.infos()], ["t0", "t1"])
+        self.fake_batch(0)
+        self.assertEqual(list(self.obj.all()), [])
+        self.assertEqual(self.device.batch.call_count, 1)
+
+    def fake_hierarchy(self, bounds, others):
+        node = '<node index="0" text="%s" class="%s" bounds="[%d,%d][%d,%d]" />'
+        nodes = [node % ("text", "android", bounds["left"], bounds["top"], bounds["right"], bounds["bottom"])]
+        for b in others:
+            nodes.append(node % ("", "other", b["left"], b["top"], b["right"], b["bottom"]))
+        xml = '<hierarchy rotation="0">%s</hierarchy>' % "".join(nodes)
+        self.device.snapshot = lambda: Snapshot(self.device, Hierarchy.parse(xml))
+        self.device.side_effect = lambda **kwargs: AutomatorDeviceObject(self.device, FrozenSelector(**kwargs))
 
     def test_left(self):
-        method = self.fake_jsonrpc_method(method='objInfo', side_effect=[
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}}
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}
         ])
-        self.fake_jsonrpc_method(method='count', return_value=3)
-        self.assertEqual(self.obj.left().selector["instance"], 2)
+        self.assertEqual(self.obj.left(className="other").selector["instance"], 2)
+        self.assertIsNone(self.obj.left(className="android"))
 
     def test_right(self):
-        method = self.fake_jsonrpc_method(method='objInfo', side_effect=[
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 50, 'right': 100}},
-            {"bounds": {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}}
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 200, 'bottom': 300, 'left': 50, 'right': 100},
+            {'top': 200, 'bottom': 300, 'left': 150, 'right': 200}
         ])
-        self.fake_jsonrpc_method(method='count', return_value=3)
-        self.assertEqual(self.obj.right().selector["instance"], 2)
+        self.assertEqual(self.obj.right(className="other").selector["instance"], 2)
 
     def test_up(self):
-        method = self.fake_jsonrpc_method(method='objInfo', side_effect=[
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 100, 'right': 200}}
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 250, 'bottom': 300, 'left': 100, 'right': 150},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 100, 'right': 200}
         ])
-        self.fake_jsonrpc_method(method='count', return_value=3)
-        self.assertEqual(self.obj.up().selector["instance"], 2)
+        self.assertEqual(self.obj.up(className="other").selector["instance"], 2)
 
     def test_down(self):
-        method = self.fake_jsonrpc_method(method='objInfo', side_effect=[
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}}
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 250, 'bottom': 300, 'left': 100, 'right': 150}
         ])
-        self.fake_jsonrpc_method(method='count', return_value=3)
-        self.assertEqual(self.obj.down().selector["instance"], 2)
+        self.assertEqual(self.obj.down(className="other").selector["instance"], 2)
 
     def test_multiple_matched_down(self):
-        method = self.fake_jsonrpc_method(method='objInfo', side_effect=[
-            {"bounds": {'top': 200, 'bottom': 250, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 300, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 150, 'bottom': 200, 'left': 150, 'right': 200}},
-            {"bounds": {'top': 275, 'bottom': 300, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 300, 'bottom': 350, 'left': 100, 'right': 150}},
-            {"bounds": {'top': 250, 'bottom': 275, 'left': 100, 'right': 150}}
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 250, 'bottom': 300, 'left': 150, 'right': 200},
+            {'top': 150, 'bottom': 200, 'left': 150, 'right': 200},
+            {'top': 275, 'bottom': 300, 'left': 100, 'right': 150},
+            {'top': 300, 'bottom': 350, 'left': 100, 'right': 150},
+            {'top': 250, 'bottom': 275, 'left': 100, 'right': 150}
+        ])
+        self.assertEqual(self.obj.down(className="other").selector["instance"], 4)
+
+    def test_instance_of_chain(self):
+        self.fake_hierarchy({'top': 0, 'bottom': 10, 'left': 0, 'right': 10}, [])
+        obj = AutomatorDeviceObject(self.device, Selector(text="a").child(text="b"))
+        snapshot_obj = self.device.snapshot()(text="a").child(text="b")
+        self.assertEqual(obj.instance(1).selector, snapshot_obj.instance(1).selector)
+        self.assertEqual(obj.instance(1).selector["childOrSiblingSelector"][-1]["instance"], 1)
+
+    def test_beside_single_match(self):
+        self.fake_hierarchy({'top': 200, 'bottom': 250, 'left': 100, 'right': 150}, [
+            {'top': 200, 'bottom': 250, 'left': 400, 'right': 450}
         ])
-        self.fake_jsonrpc_method(method='count', return_value=5)
-        self.assertEqual(self.obj.down().selector["instance"], 4)
+        found = self.obj.right(className="other")
+        self.assertIs(type(found), AutomatorDeviceObject)  # live, not bound to the snapshot
+        self.assertEqual(found.selector, FrozenSelector(className="other", instance=0))
+        self.assertEqual(found.bounds["left"], 400)  # held from the dump until the next call
+        self.assertFalse(self.rpc_client.objInfo.called)
+        found.click()
+        found.info
+        self.rpc_client.objInfo.assert_called_once_with(found.selector)
 
 class TestAutomatorDeviceNamedUiObject(unittest.TestCase):
 
@@ -451,6 +535,7 @@ class TestAutomatorDeviceNamedUiObject(unittest.TestCase):
         self.device = MagicMock()
         self.rpc_client = MagicMock()
         self.device.server.jsonrpc.return_value = self.rpc_client
+        self.device.jsonrpc.return_value = self.rpc_client
         self.name = "my-name"
         self.obj = AutomatorDeviceNamedUiObject(self.device, self.name)
 
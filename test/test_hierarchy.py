@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import re
+import codecs
+import xml.dom.minidom
+from uiautomatorminus import Selector
+from uiautomatorminus.hierarchy import Hierarchy, CompactHierarchy, StringTable, SpatialIndex, DISTANCES, parse_bounds, \
+    iter_nodes, pretty_xml, diff, HierarchyDiffer, StabilityTracker, STABLE_MIN_INTERVAL
+
+
+def load_layout():
+    with codecs.open(os.path.join(os.path.dirname(__file__), "res", "layout.xml"), "r", encoding="utf8") as f:
+        return f.read()
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.hierarchy = Hierarchy.parse(load_layout())
+
+    def texts(self, selector):
+        return [node.get("text") or node.get("content-desc") for node in self.hierarchy.select(selector)]
+
+    def test_parse(self):
+        self.assertEqual(len(self.hierarchy), 12)
+        self.assertEqual(len(self.hierarchy.roots), 1)
+        root = self.hierarchy.roots[0]
+        self.assertEqual(root.bounds, (0, 0, 480, 800))
+        self.assertEqual([c.index for c in root.children], [0, 3, 4])
+        self.assertEqual(len(self.hierarchy.descendants(root)), 11)
+        self.assertEqual(parse_bounds("[-1,2][3,4]"), (-1, 2, 3, 4))
+
+    def test_text_fields(self):
+        self.assertEqual(self.texts(Selector(text="Phone")), ["Phone"])
+        self.assertEqual(self.texts(Selector(textContains="e")), ["Phone", "People", "Messaging", "Browser"])
+        self.assertEqual(self.texts(Selector(textStartsWith="P")), ["Phone", "People"])
+        self.assertEqual(self.texts(Selector(textMatches="P.*e")), ["Phone", "People"])
+        self.assertEqual(self.texts(Selector(textMatches="P")), [])
+        self.assertEqual(self.texts(Selector(description="Apps")), ["Apps"])
+        self.assertEqual(self.texts(Selector(descriptionContains="clock")), ["Analog clock"])
+        self.assertEqual(self.texts(Selector(descriptionMatches=r"\d+:\d+")), ["11:33"])
+
+    def test_other_fields(self):
+        self.assertEqual(len(self.hierarchy.select(Selector(className="android.widget.TextView"))), 5)
+        self.assertEqual(len(self.hierarchy.select(Selector(classNameMatches=r".*\.View"))), 3)
+        self.assertEqual(len(self.hierarchy.select(Selector(packageName="com.android.deskclock"))), 1)
+        self.assertEqual(len(self.hierarchy.select(Selector(packageNameMatches="com.android.*"))), 12)
+        self.assertEqual(len(self.hierarchy.select(Selector(resourceId="com.android.launcher:id/hotseat"))), 1)
+        self.assertEqual(len(self.hierarchy.select(Selector(resourceIdMatches=".*:id/cell[0-9]"))), 1)
+        self.assertEqual(len(self.hierarchy.select(Selector(scrollable=True))), 1)
+        self.assertEqual(len(self.hierarchy.select(Selector(clickable=True, focusable=True))), 6)
+        self.assertEqual(len(self.hierarchy.select(Selector(longClickable=True, text="Phone"))), 1)
+        self.assertEqual(len(self.hierarchy.select(Selector(checked=False))), 12)
+        self.assertEqual(self.texts(Selector(className="android.widget.TextView", index=3)), ["Messaging"])
+
+    def test_instance(self):
+        selector = Selector(className="android.widget.TextView", instance=1)
+        self.assertEqual(self.texts(selector), ["People"])
+        selector["instance"] = 5
+        self.assertEqual(self.texts(selector), [])
+
+    def test_child_and_sibling(self):
+        selector = Selector(resourceId="com.android.launcher:id/hotseat").child(clickable=True)
+        self.assertEqual(self.texts(selector), ["Phone", "People", "Apps", "Messaging", "Browser"])
+        selector = Selector(resourceId="com.android.launcher:id/cell3").child(clickable=True)
+        self.assertEqual(self.texts(selector), ["11:33"])
+        selector = Selector(text="Phone").sibling(className="android.widget.TextView", instance=1)
+        self.assertEqual(self.texts(selector), ["Apps"])
+        selector = Selector(text="Phone").sibling(text="Phone")
+        self.assertEqual(self.texts(selector), [])
+        selector = Selector(text="Nothing").child(clickable=True)
+        self.assertEqual(self.texts(selector), [])
+
+    def test_info(self):
+        node = self.hierarchy.select(Selector(text="People"))[0]
+        info = node.info
+        self.assertEqual(info["bounds"], {"left": 96, "top": 706, "right": 192, "bottom": 800})
+        self.assertEqual(info["className"], "android.widget.TextView")
+        self.assertTrue(info["clickable"])
+        self.assertFalse(info["checked"])
+        self.assertEqual(info["childCount"], 0)
+        self.assertIsNone(info["resourceName"])
+
+
+    def test_iter_nodes(self):
+        nodes = list(iter_nodes(load_layout()))
+        self.assertEqual([n.attrib for n in nodes], [n.attrib for n in self.hierarchy.nodes])
+        self.assertEqual([(n.order, n.end) for n in nodes], [(n.order, n.end) for n in self.hierarchy.nodes])
+        self.assertEqual([n.info for n in nodes], [n.info for n in self.hierarchy.nodes])
+
+
+class TestCompactHierarchy(unittest.TestCase):
+
+    def setUp(self):
+        self.hierarchy = Hierarchy.parse(load_layout())
+        self.compact = CompactHierarchy.parse(load_layout())
+
+    def test_nodes(self):
+        self.assertEqual(len(self.compact), len(self.hierarchy))
+        for node, view in zip(self.hierarchy, self.compact):
+            self.assertEqual(view.attrib, node.attrib)
+            self.assertEqual((view.order, view.end, view.bounds, view.index), (node.order, node.end, node.bounds, node.index))
+            self.assertEqual(view.info, node.info)
+            self.assertEqual([c.order for c in view.children], [c.order for c in node.children])
+            self.assertEqual(view.parent and view.parent.order, node.parent and node.parent.order)
+        self.assertEqual(self.compact.nodes[3], self.compact.nodes[3])
+        self.assertEqual([n.order for n in self.compact.roots], [0])
+        self.assertEqual([n.order for n in self.compact.descendants(self.compact.nodes[1])],
+                         [n.order for n in self.hierarchy.descendants(self.hierarchy.nodes[1])])
+
+    def test_select(self):
+        selectors = [
+            Selector(text="Phone"), Selector(textContains="e"), Selector(textMatches="P.*e"),
+            Selector(descriptionStartsWith="Home"), Selector(clickable=True), Selector(scrollable=False, index=1),
+            Selector(className="android.widget.TextView", instance=2), Selector(text="Nothing"),
+            Selector(resourceId="com.android.launcher:id/hotseat").child(clickable=True),
+            Selector(text="Phone").sibling(text="Browser")]
+        for selector in selectors:
+            self.assertEqual([n.order for n in self.compact.select(selector)],
+                             [n.order for n in self.hierarchy.select(selector)])
+
+    def test_spatial(self):
+        self.assertEqual([n.order for n in self.compact.spatial_index.at(150, 750)],
+                         [n.order for n in self.hierarchy.spatial_index.at(150, 750)])
+
+    def test_shared_strings(self):
+        strings = StringTable()
+        first = CompactHierarchy.parse(load_layout(), strings)
+        size = len(strings)
+        second = CompactHierarchy.parse(load_layout(), strings)
+        self.assertEqual(len(strings), size)
+        self.assertEqual(first.string_columns["class"], second.string_columns["class"])
+
+    def test_extra_attributes(self):
+        compact = CompactHierarchy.parse('<hierarchy><node text="a" NAF="true"/><node/></hierarchy>')
+        self.assertEqual(compact.nodes[0].attrib, {"text": "a", "NAF": "true"})
+        self.assertEqual(compact.nodes[1].attrib, {})
+        self.assertEqual(compact.nodes[1].get("checked"), "")
+        self.assertEqual([n.order for n in compact.roots], [0, 1])
+
+
+class TestHierarchyDiff(unittest.TestCase):
+
+    def test_diff(self):
+        layout = load_layout()
+        changed = layout.replace('text="People"', 'text="Contacts"')
+        changed = re.sub(r'\s*<node index="4" text="Browser"[^>]*/>', "", changed)
+        changed = changed.replace('<node index="0" text="Phone"', '<node index="9" text="New" /><node index="0" text="Phone"')
+        result = diff(Hierarchy.parse(layout), CompactHierarchy.parse(changed))
+        self.assertTrue(result)
+        self.assertEqual([n.get("text") for n in result.added], ["New"])
+        self.assertEqual([n.get("text") for n in result.removed], ["Browser"])
+        self.assertEqual([(old.get("text"), new.get("text")) for old, new in result.changed], [("People", "Contacts")])
+        self.assertFalse(diff(Hierarchy.parse(layout), Hierarchy.parse(layout)))
+        self.assertFalse(diff(Hierarchy.parse(layout), Hierarchy.parse(changed.replace("Contacts", "People")),
+                              ignore=["text"]).changed)
+
+    def test_update(self):
+        differ = HierarchyDiffer()
+        self.assertEqual(len(differ.update(Hierarchy.parse(load_layout())).added), 12)
+        self.assertFalse(differ.update(Hierarchy.parse(load_layout())))
+
+
+class TestStabilityTracker(unittest.TestCase):
+
+    def test_settle(self):
+        tracker = StabilityTracker(1.0, matches=3)
+        self.assertEqual(tracker.observe("a", 0.0), (False, STABLE_MIN_INTERVAL))
+        self.assertEqual(tracker.observe("b", 0.25), (False, STABLE_MIN_INTERVAL * 2))
+        self.assertEqual(tracker.observe("b", 0.5), (False, 0.75))
+        self.assertEqual(tracker.observe("b", 1.0), (False, 0.25))
+        self.assertEqual(tracker.observe("b", 1.25), (True, 0))
+
+    def test_window(self):
+        tracker = StabilityTracker(1.0, matches=2)
+        tracker.observe("a", 0.0)
+        self.assertEqual(tracker.observe("a", 0.5), (False, 0.5))
+        self.assertEqual(tracker.observe("a", 1.0), (True, 0))
+
+    def test_ignore(self):
+        layout = load_layout()
+        tracker = StabilityTracker(0, matches=2, ignore=["focused"])
+        tracker.observe(layout, 0)
+        self.assertTrue(tracker.observe(layout.replace('focused="false"', 'focused="true"', 1), 0)[0])
+        self.assertFalse(tracker.observe(layout.replace("Phone", "Dialer"), 0)[0])
+
+
+class TestPrettyXml(unittest.TestCase):
+
+    def assertSameAsMinidom(self, content):
+        expected = xml.dom.minidom.parseString(content.encode("utf-8")).toprettyxml(indent="  ")
+        self.assertEqual(pretty_xml(content), expected)
+
+    def test_layout(self):
+        self.assertSameAsMinidom("".join(re.split(r"\n[ ]*", load_layout())))
+
+    def test_text_and_escapes(self):
+        self.assertSameAsMinidom(u'<a x="1&amp;&quot;&gt;&#10;" b="\u00e9"><b>hi &lt; "x"</b><c/>tail<d>\n</d> </a>')
+        self.assertSameAsMinidom(u'<?xml version="1.0" encoding="UTF-8"?><r>t1<x/>t2</r>')
+        self.assertSameAsMinidom(u"<r/>")
+
+
+class TestSpatialIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.hierarchy = Hierarchy.parse(load_layout())
+        self.index = self.hierarchy.spatial_index
+
+    def test_at(self):
+        nodes = self.index.at(150, 750)
+        self.assertEqual(nodes[-1].get("text"), "People")
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(self.index.at(192, 750)[-1].get("content-desc"), "Apps")
+        self.assertEqual(self.index.at(1000, 1000), [])
+
+    def test_overlapping(self):
+        nodes = self.index.overlapping((90, 700, 200, 710))
+        self.assertEqual([n.get("text") for n in nodes if n.get("text")], ["Phone", "People"])
+
+    def test_nearest_matches_brute_force(self):
+        import random
+        random.seed(1)
+        xml = ['<hierarchy rotation="0">']
+        for i in range(300):
+            left, top = random.randint(-50, 1000), random.randint(-50, 1800)
+            right, bottom = left + random.randint(0, 150), top + random.randint(0, 150)
+            xml.append('<node index="%d" class="c%d" bounds="[%d,%d][%d,%d]" />' % (i, i % 3, left, top, right, bottom))
+        xml.append('</hierarchy>')
+        hierarchy = Hierarchy.parse("".join(xml))
+        index = SpatialIndex(hierarchy.nodes, cell_size=50)
+        for node in hierarchy.nodes[:60]:
+            for direction, distance in DISTANCES.items():
+                best = None
+                for other in hierarchy.nodes:
+                    if other.get("class") != "c1":
+                        continue
+                    dist = distance(node.bounds, other.bounds)
+                    if dist >= 0 and (best is None or dist < best[0]):
+                        best = (dist, other)
+                found = index.nearest(node.bounds, direction, lambda n: n.get("class") == "c1")
+                self.assertIs(found, best[1] if best else None)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import pickle
+import unittest
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from uiautomatorminus.info import Rect, UiObjectInfo
+
+
+class TestRect(unittest.TestCase):
+
+    def test_fields(self):
+        rect = Rect(10, 20, 110, 220)
+        self.assertEqual((rect.left, rect.top, rect.right, rect.bottom), (10, 20, 110, 220))
+        self.assertEqual(rect["left"], 10)
+        self.assertEqual(rect[2], 110)
+        self.assertEqual((rect.width, rect.height, rect.center), (100, 200, (60, 120)))
+        self.assertTrue(rect.contains(10, 20))
+        self.assertFalse(rect.contains(110, 20))
+        with self.assertRaises(KeyError):
+            rect["width"]
+
+    def test_equality(self):
+        rect = Rect.from_dict({"left": 1, "top": 2, "right": 3, "bottom": 4})
+        self.assertEqual(rect, {"left": 1, "top": 2, "right": 3, "bottom": 4})
+        self.assertEqual({"left": 1, "top": 2, "right": 3, "bottom": 4}, rect)
+        self.assertEqual(rect, (1, 2, 3, 4))
+        self.assertNotEqual(rect, {"left": 1})
+        self.assertEqual(rect.to_dict(), {"left": 1, "top": 2, "right": 3, "bottom": 4})
+
+
+class TestUiObjectInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = {
+            "text": "OK", "enabled": True, "childCount": 0, "chileCount": 2,
+            "bounds": {"left": 0, "top": 0, "right": 720, "bottom": 1184}}
+        self.info = UiObjectInfo(self.fields)
+
+    def test_access(self):
+        self.assertEqual(self.info.text, "OK")
+        self.assertEqual(self.info["enabled"], True)
+        self.assertEqual(self.info.bounds, Rect(0, 0, 720, 1184))
+        self.assertEqual(self.info.chileCount, 2)
+        self.assertIn("text", self.info)
+        self.assertNotIn("checked", self.info)
+        self.assertNotIn("extra", self.info)
+        self.assertIsNone(self.info.get("checked"))
+        with self.assertRaises(KeyError):
+            self.info["checked"]
+        with self.assertRaises(AttributeError):
+            self.info.checked
+
+    def test_read_only(self):
+        with self.assertRaises(AttributeError):
+            self.info.text = "Cancel"
+        with self.assertRaises(AttributeError):
+            del self.info.text
+
+    def test_mapping(self):
+        self.assertEqual(self.info, self.fields)
+        self.assertEqual(sorted(self.info), sorted(self.fields))
+        self.assertEqual(len(self.info), 5)
+        self.assertEqual(self.info.to_dict(), self.fields)
+        self.assertNotEqual(self.info, dict(self.fields, text="Cancel"))
+        self.assertIsInstance(self.info, Mapping)
+        self.assertEqual(json.loads(json.dumps(self.info.to_dict())), self.fields)
+
+    def test_copy(self):
+        self.assertEqual(pickle.loads(pickle.dumps(self.info)), self.info)
+        self.assertEqual(copy.deepcopy(self.info), self.info)
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.info, "__dict__"))
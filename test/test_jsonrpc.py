@@ -4,7 +4,7 @@
 import json
 import unittest
 from mock import MagicMock, patch
-from uiautomatorminus import jsonrpc_call, JsonRPCClient
+from uiautomatorminus import jsonrpc_call, jsonrpc_batch_call, JsonRPCClient, JsonRPCError
 import os
 import requests
 
@@ -23,7 +23,8 @@ class TestJsonRPCMethod_id(unittest.TestCase):
         prev_id = None
         for i in range(20):
             jsonrpc_call(url='', timeout=30, call_desc={'method': 'method'})
-            rpcdata = mock_post.call_args[1]['json']
+            self.assertEqual(mock_post.call_args[1]['headers'], {'Content-Type': 'application/json'})
+            rpcdata = json.loads(mock_post.call_args[1]['data'])
             self.assertTrue(isinstance(rpcdata['id'], str))
             self.assertTrue(len(rpcdata['id']) > 0)
             self.assertNotEqual(rpcdata['id'], prev_id)
@@ -79,3 +80,39 @@ class TestJsonRPCClient(unittest.TestCase):
         mock_post.return_value = PostResponse(
             '{"result": {"width": 10, "height": 20}, "id": "JDLSFJLILJEMNC"}')
         self.assertEqual(client.info(), {"width": 10, "height": 20})
+        self.assertIs(client.info, client.info)
+
+
+
+class TestJsonRPCBatchCall(unittest.TestCase):
+
+    def echo(self, responses):
+        def post(url, **kwargs):
+            return PostResponse(json.dumps([
+                dict(response, id=request['id'])
+                for request, response in zip(json.loads(kwargs['data']), responses)]))
+        return post
+
+    @patch('requests.post')
+    def test_batch(self, mock_post):
+        mock_post.side_effect = self.echo([
+            {"result": "pong"},
+            {"error": {"code": -32002, "message": "not found",
+                       "data": {"exceptionTypeName": "UiObjectNotFoundException"}}}])
+        results = jsonrpc_batch_call(
+            url='http://localhost/jsonrpc', timeout=30,
+            call_descs=[{'method': 'ping'}, {'method': 'click', 'args': [1, 2]}])
+        rpcdata = json.loads(mock_post.call_args[1]['data'])
+        self.assertEqual([r['method'] for r in rpcdata], ['ping', 'click'])
+        self.assertEqual(rpcdata[1]['params'], [1, 2])
+        self.assertEqual(results[0], ("pong", None))
+        self.assertIsNone(results[1][0])
+        self.assertTrue(isinstance(results[1][1], JsonRPCError))
+        self.assertEqual(results[1][1].code, -32002)
+
+    @patch('requests.post')
+    def test_batch_rejected(self, mock_post):
+        mock_post.return_value = PostResponse(
+            '{"error": {"code": -32600, "message": "Invalid Request"}, "id": null}')
+        self.assertIsNone(jsonrpc_batch_call(
+            url='http://localhost/jsonrpc', timeout=30, call_descs=[{'method': 'ping'}]))
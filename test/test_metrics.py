@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from uiautomatorminus import jsonrpc_call, adb_command_name, JsonRPCError
+from uiautomatorminus.metrics import Metrics, Series, MAX_SAMPLES, collector
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics(enabled=True)
+
+    def test_observe(self):
+        for i in range(100):
+            self.metrics.observe("rpc", "click", (i + 1) / 1000.0, 10, 20, error=i == 0)
+        summary = self.metrics.snapshot()["rpc"]["click"]
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["errors"], 1)
+        self.assertEqual(summary["bytes_out"], 1000)
+        self.assertEqual(summary["bytes_in"], 2000)
+        self.assertEqual(summary["latency"]["p50"], 0.051)
+        self.assertEqual(summary["latency"]["p95"], 0.096)
+        self.assertEqual(summary["latency"]["p99"], 0.1)
+        self.assertEqual(summary["latency"]["max"], 0.1)
+        self.assertAlmostEqual(summary["latency"]["sum"], 5.05)
+
+    def test_bounded_samples(self):
+        series = Series()
+        for i in range(MAX_SAMPLES * 2):
+            series.add(0.001, 0, 0, False)
+        self.assertEqual(series.count, MAX_SAMPLES * 2)
+        self.assertEqual(len(series.samples), MAX_SAMPLES)
+
+    def test_hooks(self):
+        hook = MagicMock()
+        metrics = Metrics()
+        metrics.add_hook(hook)
+        self.assertTrue(metrics.enabled)
+        metrics.observe("fnf", "click", 0.5)
+        hook.assert_called_once_with("fnf", "click", 0.5, 0, 0, False)
+        metrics.remove_hook(hook)
+        metrics.observe("fnf", "click", 0.5)
+        self.assertEqual(hook.call_count, 1)
+
+    def test_prometheus(self):
+        self.metrics.observe("rpc", 'say "hi"', 0.25, 3, 4)
+        text = self.metrics.to_prometheus()
+        self.assertIn('uiautomator_calls_total{kind="rpc",name="say \\"hi\\""} 1\n', text)
+        self.assertIn('uiautomator_bytes_received_total{kind="rpc",name="say \\"hi\\""} 4\n', text)
+        self.assertIn('uiautomator_latency_seconds{kind="rpc",name="say \\"hi\\"",quantile="0.95"} 0.25\n', text)
+        self.assertIn("# TYPE uiautomator_latency_seconds summary\n", text)
+
+    def test_dump(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.metrics.observe("rpc", "ping", 0.01)
+            prefix = os.path.join(tmpdir, "metrics")
+            self.metrics.dump(prefix)
+            with open(prefix + ".json") as f:
+                self.assertEqual(json.load(f)["rpc"]["ping"]["count"], 1)
+            self.assertTrue(os.path.exists(prefix + ".prom"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        collector.reset()
+        collector.enable()
+
+    def tearDown(self):
+        collector.disable()
+        collector.reset()
+
+    def test_jsonrpc_call(self):
+        response = MagicMock()
+        response.json.return_value = {"jsonrpc": "2.0", "id": 1, "result": True}
+        response.content = b'{"jsonrpc": "2.0", "id": 1, "result": true}'
+        session = MagicMock()
+        session.post.return_value = response
+        self.assertTrue(jsonrpc_call("http://localhost/jsonrpc/0", 10, {"method": "click", "args": [1, 2]}, session))
+        response.json.return_value = {"jsonrpc": "2.0", "id": 1, "error": {"code": -32001, "message": "x"}}
+        with self.assertRaises(JsonRPCError):
+            jsonrpc_call("http://localhost/jsonrpc/0", 10, {"method": "click", "args": [1, 2]}, session)
+        session.post.side_effect = IOError()
+        with self.assertRaises(IOError):
+            jsonrpc_call("http://localhost/jsonrpc/0", 10, {"method": "click", "args": [1, 2]}, session)
+        summary = collector.snapshot()["rpc"]["click"]
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["errors"], 2)
+        self.assertEqual(summary["bytes_in"], 2 * len(response.content))
+        self.assertGreater(summary["bytes_out"], 0)
+
+    def test_disabled(self):
+        collector.disable()
+        session = MagicMock()
+        session.post.return_value.json.return_value = {"result": True}
+        jsonrpc_call("http://localhost/jsonrpc/0", 10, {"method": "click"}, session)
+        self.assertEqual(collector.snapshot(), {})
+
+    def test_adb_command_name(self):
+        self.assertEqual(adb_command_name(["-s", "1234", "shell", "am", "instrument"]), "shell am")
+        self.assertEqual(adb_command_name(["-H", "host", "-P", "5038", "forward", "--list"]), "forward")
@@ -3,8 +3,16 @@
 
 import unittest
 import uiautomatorminus
+import json
 import os
-from mock import patch
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from mock import MagicMock, patch
 
 
 class TestMisc(unittest.TestCase):
@@ -36,12 +44,91 @@ class TestMisc(unittest.TestCase):
             self.assertEqual(uiautomatorminus.point(x, y), {"x": x, "y": y})
 
     def test_next_port(self):
-        with patch('socket.socket') as socket:
-            socket.return_value.connect_ex.side_effect = [0, 0, 1]
-            uiautomatorminus._init_local_port = 9007
-            self.assertEqual(uiautomatorminus.next_local_port(), 9010)
-
-        with patch('socket.socket') as socket:
-            socket.return_value.connect_ex.return_value = 1
-            uiautomatorminus._init_local_port = 32764
-            self.assertEqual(uiautomatorminus.next_local_port(), 9008)
+        with patch('uiautomatorminus.port_registry') as registry:
+            registry.allocate.return_value = 40000
+            self.assertEqual(uiautomatorminus.next_local_port('localhost', 'abcd', 9008), 40000)
+            registry.allocate.assert_called_once_with('localhost', 'abcd', 9008)
+
+            registry.allocate.side_effect = IOError("read-only")
+            port = uiautomatorminus.next_local_port()
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', port))  # the OS reported it free
+            sock.close()
+
+    def test_free_port_remote(self):
+        with patch('uiautomatorminus.is_port_listening') as listening:
+            listening.side_effect = [True, False]
+            uiautomatorminus.free_local_port('10.0.0.2')
+            self.assertEqual(listening.call_count, 2)
+
+
+class TestPortRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'run', 'ports.json')
+        self.registry = uiautomatorminus.PortRegistry(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_allocate(self):
+        port = self.registry.allocate('localhost', 'abcd', 9008)
+        self.assertEqual(self.registry.allocate(None, 'abcd', 9008), port)
+        other = uiautomatorminus.PortRegistry(self.path)  # as another process would
+        self.assertNotEqual(other.allocate('localhost', 'efgh', 9008), port)
+        self.assertEqual(self.registry.entries()['localhost|abcd|9008']['pids'], [os.getpid()])
+
+    def test_release(self):
+        self.registry.allocate('localhost', 'abcd', 9008)
+        self.registry.release('localhost', 'abcd', 9008)
+        self.assertEqual(self.registry.entries(), {})
+
+    def test_stale_entries(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        now = time.time()
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump({
+                'localhost|dead|9008': {'port': 40001, 'pids': [process.pid], 'time': now},
+                'localhost|old|9008': {'port': 40002, 'pids': [os.getpid()], 'time': now - 2 * 24 * 3600},
+                'localhost|live|9008': {'port': 40003, 'pids': [os.getpid()], 'time': now},
+                'broken': {'port': 'x'},
+            }, f)
+        self.registry.allocate('localhost', 'abcd', 9008)
+        self.assertEqual(sorted(self.registry.entries()), ['localhost|abcd|9008', 'localhost|live|9008'])
+        self.assertEqual(self.registry.allocate('localhost', 'live', 9008), 40003)
+
+    def test_concurrent(self):
+        ports = []
+
+        def allocate(i):
+            ports.append(uiautomatorminus.PortRegistry(self.path).allocate('localhost', 'serial%d' % i, 9008))
+        threads = [threading.Thread(target=allocate, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(ports)), 20)
+        self.assertEqual(len(self.registry.entries()), 20)
+
+    def test_server_serial(self):
+        adbs = [MagicMock(), MagicMock()]
+        for adb, serial in zip(adbs, ('abcd', 'efgh')):  # as resolved from ANDROID_SERIAL
+            adb.device_serial.return_value = serial
+            adb.forward_list.return_value = []
+        with patch('uiautomatorminus.port_registry', self.registry), \
+                patch('uiautomatorminus.Adb', side_effect=adbs):
+            first, second = uiautomatorminus.AutomatorServer(), uiautomatorminus.AutomatorServer()
+            self.assertNotEqual(first.local_port, second.local_port)
+            self.assertEqual(sorted(self.registry.entries()), ['localhost|abcd|9008', 'localhost|efgh|9008'])
+            first.stop_instrumentation = lambda **kwargs: None
+            first.stop()
+            self.assertEqual(sorted(self.registry.entries()), ['localhost|efgh|9008'])
+            first.set_forwarding()
+            self.assertEqual(sorted(self.registry.entries()), ['localhost|abcd|9008', 'localhost|efgh|9008'])
+
+    def test_runtime_user(self):
+        with patch('getpass.getuser', side_effect=KeyError('uid not found')):
+            self.assertTrue(uiautomatorminus.runtime_user())
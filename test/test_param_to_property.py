@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import unittest
-from uiautomatorminus import param_to_property
+from uiautomatorminus import param_to_property, fluent_method, FluentMethod, AutomatorDevice
 
 
 class TestParamToProperty(unittest.TestCase):
@@ -60,3 +60,50 @@ class TestParamToProperty(unittest.TestCase):
             @param_to_property("a", "b", key=["one", "two", "three"])
             def func(*args, **kwargs):
                 pass
+
+    def test_stateless(self):
+        @param_to_property(key=["one", "two"])
+        def func(*args, **kwargs):
+            return args, kwargs
+
+        one = func.one
+        self.assertEqual(func.two(1), ((1,), {"key": "two"}))
+        self.assertEqual(one(), ((), {"key": "one"}))
+        self.assertEqual(one(), ((), {"key": "one"}))
+        self.assertEqual(func(), ((), {}))
+
+
+class TestFluentMethod(unittest.TestCase):
+
+    class Keys(object):
+
+        def __init__(self, name):
+            self.name = name
+
+        @fluent_method(dimention=["vert", "horiz"], action=["forward", "to"])
+        def scroll(self, dimention="vert", action="forward", **kwargs):
+            '''scroll doc.'''
+            return self.name, dimention, action, kwargs
+
+        @fluent_method("home", "back")
+        def press(self, *args):
+            return self.name, args
+
+    def test_bound(self):
+        a, b = self.Keys("a"), self.Keys("b")
+        self.assertEqual(a.scroll(), ("a", "vert", "forward", {}))
+        self.assertEqual(b.scroll.horiz.to(text="OK"), ("b", "horiz", "to", {"text": "OK"}))
+        self.assertEqual(a.scroll.to(), ("a", "vert", "to", {}))
+        self.assertEqual(a.press.home.back("x"), ("a", ("home", "back", "x")))
+        with self.assertRaises(AttributeError):
+            a.scroll.to.forward
+        with self.assertRaises(AttributeError):
+            a.press.menu
+
+    def test_built_once(self):
+        method = self.Keys.__dict__["scroll"]
+        self.assertIsInstance(method, FluentMethod)
+        self.assertIs(self.Keys.scroll, method)
+        self.assertEqual(method.__doc__, "scroll doc.")
+        for name in ("press", "open", "wait"):
+            self.assertIsInstance(AutomatorDevice.__dict__[name], FluentMethod)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+from uiautomatorminus import DevicePool, JsonRPCError
+import requests
+
+
+class TestDevicePool(unittest.TestCase):
+
+    def setUp(self):
+        self.attached = {'A': 'device', 'B': 'device', 'C': 'offline'}
+        self.created = []
+        self.pool = DevicePool(device_factory=self.new_device, readmit_interval=60)
+        self.pool.adb = MagicMock()
+        self.pool.adb.devices.side_effect = lambda: dict(self.attached)
+
+    def new_device(self, serial):
+        device = MagicMock()
+        device.serial = serial
+        device.server.recovery_policy = None
+        self.created.append(serial)
+        return device
+
+    def test_start(self):
+        results = self.pool.start()
+        self.assertEqual(sorted(results), ['A', 'B'])
+        self.assertEqual(sorted(self.pool.devices), ['A', 'B'])
+        self.assertEqual([d.serial for d in self.pool], ['A', 'B'])
+        self.pool['A'].server.start.assert_called_once_with(timeout=self.pool.start_timeout)
+
+    def test_start_in_parallel(self):
+        barrier = threading.Event()
+        started = []
+
+        def factory(serial):
+            device = self.new_device(serial)
+
+            def start(timeout):
+                started.append(serial)
+                if len(started) == 2:
+                    barrier.set()
+                if not barrier.wait(2):  # both devices start at the same time
+                    raise IOError("serial start")
+            device.server.start.side_effect = start
+            return device
+        self.pool.device_factory = factory
+        self.assertEqual(self.pool.start().errors, {})
+
+    def test_start_failure(self):
+        def factory(serial):
+            device = self.new_device(serial)
+            if serial == 'B':
+                device.server.start.side_effect = IOError("RPC server not started!")
+            return device
+        self.pool.device_factory = factory
+        results = self.pool.start()
+        self.assertEqual(list(results.values_ok), ['A'])
+        self.assertIsInstance(results.errors['B'], IOError)
+        self.assertIn('B', self.pool.evicted)
+        self.assertEqual(sorted(self.pool.devices), ['A'])
+
+    def test_map(self):
+        self.pool.start()
+        results = self.pool.map(lambda d: d.serial.lower())
+        self.assertEqual(results.values_ok, {'A': 'a', 'B': 'b'})
+        self.assertEqual(results['A'].get(), 'a')
+        self.assertIs(results.raise_errors(), results)
+
+    def test_broadcast(self):
+        self.pool.start()
+        self.pool.broadcast('press.home')
+        self.pool.broadcast('click', 1, 2)
+        for device in self.pool:
+            device.press.home.assert_called_once_with()
+            device.click.assert_called_once_with(1, 2)
+
+    def test_bounded_concurrency(self):
+        self.pool.max_workers = 1
+        self.pool.start()
+        lock = threading.Lock()
+
+        def fn(device):
+            self.assertTrue(lock.acquire(False))
+            time.sleep(0.05)
+            lock.release()
+        self.assertEqual(self.pool.map(fn).errors, {})
+
+    def test_eviction(self):
+        self.pool.start()
+
+        def fn(device):
+            if device.serial == 'A':
+                raise requests.exceptions.ConnectionError("Connection refused")
+            if device.serial == 'B':
+                raise JsonRPCError(-32002, "UiObjectNotFoundException: not found")
+        results = self.pool.map(fn)
+        self.assertEqual(sorted(results.errors), ['A', 'B'])
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            results.raise_errors()
+        self.assertEqual(list(self.pool.devices), ['B'])  # application errors keep the device
+        self.assertIn('A', self.pool.evicted)
+
+        self.pool.map(lambda d: None)
+        self.assertEqual(sorted(self.pool.devices), ['B'])  # not due yet
+        self.pool.readmit_interval = 0
+        self.pool.map(lambda d: None)
+        self.assertEqual(sorted(self.pool.devices), ['A', 'B'])
+        self.assertEqual(self.created.count('A'), 1)  # the device object is reused
+        self.pool['A'].server.stop_instrumentation.assert_called_once_with()
+
+    def test_timeout(self):
+        self.pool.start()
+        release = threading.Event()
+
+        def fn(device):
+            if device.serial == 'A':
+                release.wait(5)
+            return device.serial
+        begin = time.time()
+        results = self.pool.map(fn, timeout=0.2)
+        release.set()
+        self.assertLess(time.time() - begin, 2)
+        self.assertEqual(results.values_ok, {'B': 'B'})
+        self.assertIn('timed out', str(results.errors['A']))
+        self.assertEqual(list(self.pool.devices), ['B'])
+
+    def test_timed_out_call_keeps_its_worker(self):
+        self.pool.max_workers = 2
+        self.pool.start()
+        release = threading.Event()
+        calls = []
+
+        def fn(device):
+            calls.append(device.serial)
+            if device.serial == 'A':
+                release.wait(5)
+        threads = threading.active_count()
+        self.pool.map(fn, timeout=0.1)
+        self.pool.readmit_interval = 0
+        for _ in range(3):
+            results = self.pool.map(fn, timeout=0.1)
+        self.assertEqual(calls.count('A'), 1)  # not called again while the first call runs
+        self.assertIn('still running', str(self.pool.evicted['A'][1]))
+        self.assertEqual(results.values_ok, {'B': None})
+        self.assertLessEqual(threading.active_count(), threads + 2)
+
+        release.set()
+        time.sleep(0.1)
+        self.pool.map(fn, timeout=0.1)
+        self.assertEqual(sorted(self.pool.devices), ['A', 'B'])
+        self.assertLessEqual(threading.active_count(), threads + 2)
+
+    def test_detached(self):
+        self.pool.start()
+        del self.attached['B']
+        self.attached['D'] = 'device'
+        self.pool.refresh()
+        self.assertEqual(sorted(self.pool.devices), ['A', 'D'])
+        self.assertIn('B', self.pool.evicted)
+
+    def test_serials(self):
+        self.pool.serials = ['B', 'C']
+        self.pool.start()
+        self.assertEqual(list(self.pool.devices), ['B'])
+
+    def test_device_factory(self):
+        with patch('uiautomatorminus.AutomatorDevice') as device_class:
+            pool = DevicePool(adb_server_port=5038, adb_backend='socket')
+            pool.adb = MagicMock()
+            pool.adb.devices.return_value = {'A': 'device'}
+            pool.start()
+        device_class.assert_called_once_with(
+            serial='A', adb_server_host=None, adb_server_port=5038, adb_backend='socket')
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import copy
+import json
+import pickle
 import unittest
-from uiautomatorminus import Selector
+from uiautomatorminus import FrozenSelector, Selector, encode_params
 
 
 class TestSelector(unittest.TestCase):
@@ -104,3 +107,65 @@ class TestSelector(unittest.TestCase):
             self.assertEqual(sel[k], clone[k])
         self.assertEqual(sel["childOrSibling"], clone["childOrSibling"])
         self.assertEqual(sel["childOrSiblingSelector"], clone["childOrSiblingSelector"])
+
+
+class TestFrozenSelector(unittest.TestCase):
+
+    def test_equal_to_selector(self):
+        kwargs = {"text": "OK", "className": "android.widget.Button", "clickable": True}
+        frozen = FrozenSelector(**kwargs).child(text="1").sibling(index=2)
+        sel = Selector(**kwargs).child(text="1").sibling(index=2)
+        self.assertEqual(frozen, sel)
+        self.assertEqual(sel, frozen)
+        self.assertEqual(frozen["mask"], sel["mask"])
+        self.assertEqual(sel.freeze(), frozen)
+        self.assertEqual(frozen.thaw(), sel)
+        self.assertEqual(json.loads(frozen.to_json()), json.loads(json.dumps(sel)))
+
+    def test_hash(self):
+        a = FrozenSelector(text="OK", className="Button").child(text="1")
+        b = FrozenSelector(className="Button", text="OK").child(text="1")
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertEqual(a.to_json(), b.to_json())
+        cache = {a: 1}
+        self.assertEqual(cache[Selector(text="OK", className="Button").child(text="1").freeze()], 1)
+        self.assertNotIn(a.sibling(text="1"), cache)
+        self.assertNotIn(FrozenSelector(text="OK", className="Button"), cache)
+
+    def test_immutable(self):
+        sel = FrozenSelector(text="OK").child(text="1")
+        for mutate in (lambda: sel.__setitem__("text", "x"), lambda: sel.__delitem__("text"),
+                       lambda: sel.update(text="x"), lambda: sel.pop("text"), sel.clear,
+                       lambda: sel["childOrSibling"].append("child"),
+                       lambda: sel["childOrSiblingSelector"].pop()):
+            with self.assertRaises(TypeError):
+                mutate()
+        self.assertEqual(sel, Selector(text="OK").child(text="1"))
+        with self.assertRaises(ReferenceError):
+            FrozenSelector(text1="")
+
+    def test_builder(self):
+        sel = FrozenSelector(text="OK")
+        child = sel.child(text="1")
+        self.assertEqual(sel["childOrSibling"], [])
+        self.assertEqual(child["childOrSibling"], ["child"])
+        self.assertIs(sel.clone(), sel)
+        pinned = child.replace(instance=2)
+        self.assertEqual(pinned["instance"], 2)
+        self.assertEqual(pinned["mask"], child["mask"] | 0x01000000)
+        self.assertEqual(pinned["childOrSiblingSelector"], [Selector(text="1")])
+        self.assertIs(copy.deepcopy(pinned), pinned)
+        self.assertEqual(pickle.loads(pickle.dumps(pinned)), pinned)
+
+    def test_pinned(self):
+        self.assertEqual(FrozenSelector(text="OK").pinned(1), FrozenSelector(text="OK", instance=1))
+        pinned = FrozenSelector(text="OK").child(text="1").pinned(2)
+        self.assertNotIn("instance", pinned)
+        self.assertEqual(pinned["childOrSiblingSelector"], [Selector(text="1", instance=2)])
+
+    def test_encode_params(self):
+        sel = FrozenSelector(text="OK").child(text="1")
+        params = [sel, "text", [1, 2], {"a": None}]
+        self.assertEqual(json.loads(encode_params(params)), json.loads(json.dumps(params)))
+        self.assertEqual(encode_params({"a": 1}), json.dumps({"a": 1}))
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import io
 import json
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from mock import MagicMock, patch, call
-from uiautomatorminus import AutomatorServer, JsonRPCError
+from uiautomatorminus import AutomatorServer, InstallCache, JsonRPCError, ServerReadiness, \
+    RecoveryPolicy, InstrumentationError, AutomatorDevice, SelectorRegistry, Selector, \
+    JSONRPC_CLIENT_CACHE_SIZE
 import requests
 
 
@@ -28,6 +35,13 @@ class TestAutomatorServer(unittest.TestCase):
         self.assertEqual(AutomatorServer("1234", 9010).local_port, 9010)
         self.Adb.assert_called_once_with(serial="1234", adb_server_host=None, adb_server_port=None)
 
+    def test_adb_backend(self):
+        with patch('uiautomatorminus.AdbSocket') as AdbSocket:
+            server = AutomatorServer("1234", 9010, adb_server_port=5038, adb_backend="socket")
+            AdbSocket.assert_called_once_with(serial="1234", adb_server_host=None, adb_server_port=5038)
+            self.assertIs(server.adb, AdbSocket.return_value)
+            self.assertFalse(self.Adb.called)
+
     def test_local_port_forwarded(self):
         self.Adb.return_value.forward_list.return_value = [
             ("1234", "tcp:1001", "tcp:9009"),
@@ -96,13 +110,94 @@ class TestAutomatorServer(unittest.TestCase):
             server = AutomatorServer()
             server.restart = MagicMock()
             self.assertEqual("ok", server.jsonrpc().any_method())
-            server.restart.assert_called_once_with()
+            server.restart.assert_called_once_with(reinstall=False)
         with patch("uiautomatorminus.jsonrpc_call") as jsonrpc_call:
             jsonrpc_call.side_effect = JsonRPCError(-32000-2, "error msg")
             server = AutomatorServer()
             server.restart = MagicMock()
             with self.assertRaises(JsonRPCError):
                 server.jsonrpc().any_method()
+            self.assertFalse(server.restart.called)
+
+    def test_jsonrpc_cached(self):
+        server = AutomatorServer()
+        self.assertIs(server.jsonrpc(), server.jsonrpc())
+        self.assertIsNot(server.jsonrpc(), server.jsonrpc(timeout=5))
+        self.assertIs(server.jsonrpc(timeout=5), server.jsonrpc(timeout=5))
+        self.assertIs(server.jsonrpc(timeout=1.23), server.jsonrpc(timeout=1.3))
+        clients = set(id(server.jsonrpc(timeout=i / 7.0)) for i in range(1, 100))
+        self.assertGreater(len(clients), JSONRPC_CLIENT_CACHE_SIZE)
+        self.assertEqual(len(server._AutomatorServer__clients), JSONRPC_CLIENT_CACHE_SIZE)
+        client = server.jsonrpc()
+        server.adb = MagicMock()
+        self.assertIsNot(server.jsonrpc(), client)
+
+    def test_recover(self):
+        server = AutomatorServer()
+        server.restart = MagicMock()
+        server.set_forwarding = MagicMock()
+        server.recover('forward')
+        server.set_forwarding.assert_called_once_with()
+        server.recover('restart')
+        server.recover('reinstall')
+        self.assertEqual(server.restart.call_args_list, [call(reinstall=False), call(reinstall=True)])
+
+    def test_batch(self):
+        with patch("uiautomatorminus.jsonrpc_batch_call") as jsonrpc_batch_call, \
+                patch("uiautomatorminus.jsonrpc_call") as jsonrpc_call:
+            error = JsonRPCError(-32000-5, "UiObjectNotFoundException: error msg")
+            jsonrpc_batch_call.return_value = [({"displayWidth": 720}, None), (None, error)]
+            jsonrpc_call.side_effect = error
+            server = AutomatorServer()
+            server.restart = MagicMock()
+            with server.jsonrpc_batch() as b:
+                info = b.deviceInfo()
+                clicked = b.click({"text": "OK"})
+                self.assertFalse(info.done())
+            self.assertEqual(jsonrpc_batch_call.call_count, 1)
+            self.assertEqual(
+                [desc['method'] for desc in jsonrpc_batch_call.call_args[0][2]],
+                ['deviceInfo', 'click'])
+            self.assertEqual(info.result(), {"displayWidth": 720})
+            self.assertTrue(clicked.done())
+            with self.assertRaises(JsonRPCError):
+                clicked.result()
+
+    def test_batch_fnf_handling(self):
+        with patch("uiautomatorminus.jsonrpc_batch_call") as jsonrpc_batch_call, \
+                patch("uiautomatorminus.jsonrpc_call") as jsonrpc_call:
+            jsonrpc_batch_call.return_value = [
+                (True, None), (None, JsonRPCError(-32000-2, "error msg"))]
+            jsonrpc_call.return_value = True
+            server = AutomatorServer()
+            server.adb.device_serial.return_value = "1234"
+            handler = MagicMock(return_value=True)
+            server.handlers['handlers'].append(handler)
+            with server.jsonrpc_batch() as b:
+                first, second = b.exist({}), b.click({})
+            self.assertTrue(first.result())
+            self.assertTrue(second.result())
+            handler.assert_called_once_with(None)
+            self.assertEqual(jsonrpc_call.call_args[0][2]['method'], 'click')
+
+    def test_batch_fallback(self):
+        with patch("uiautomatorminus.jsonrpc_batch_call") as jsonrpc_batch_call, \
+                patch("uiautomatorminus.jsonrpc_call") as jsonrpc_call:
+            jsonrpc_batch_call.return_value = None
+            jsonrpc_call.side_effect = ["pong", True]
+            server = AutomatorServer()
+            with server.jsonrpc_batch() as b:
+                pong, clicked = b.ping(), b.click(1, 2)
+            self.assertEqual(pong.result(), "pong")
+            self.assertTrue(clicked.result())
+            self.assertFalse(server.batch_supported)
+            self.assertEqual([c[0][2]['method'] for c in jsonrpc_call.call_args_list], ['ping', 'click'])
+
+            jsonrpc_call.side_effect = ["pong"]
+            with server.jsonrpc_batch() as b:
+                pong = b.ping()
+            self.assertEqual(pong.result(), "pong")
+            self.assertEqual(jsonrpc_batch_call.call_count, 1)
 
     def test_start_ping(self):
         with patch("uiautomatorminus.jsonrpc_call") as jsonrpc_call:
@@ -133,15 +228,31 @@ class TestAutomatorServer_Stop(unittest.TestCase):
     def tearDown(self):
         self.urlopen_patch.stop()
 
-    @patch('requests.get')
-    def test_screenshot(self, mock_get):
+    def test_screenshot(self):
         server = AutomatorServer()
-        server.sdk_version = MagicMock()
-        server.sdk_version.return_value = 18
-        class GetResponse(object):
-            content = b'123456'
-        mock_get.return_value = GetResponse()
+        server.session = session = MagicMock()
+        response = session.get.return_value
+        response.status_code = 200
+        response.content = b"123456"
+        response.iter_content.return_value = [b"123", b"456"]
         self.assertEqual(server.screenshot(), b"123456")
+        self.assertEqual(session.get.call_args[1]["params"], {"scale": 1.0, "quality": 100})
+        self.assertTrue(session.get.call_args[1]["stream"])
+        out = io.BytesIO()
+        self.assertEqual(server.screenshot(0.5, 80, out=out), 6)
+        self.assertEqual(out.getvalue(), b"123456")
+        self.assertEqual(response.close.call_count, 2)
+        response.status_code = 404
+        self.assertIsNone(server.screenshot())
+        response.status_code = 200
+
+        def broken(size):
+            yield b"123"
+            raise requests.exceptions.ChunkedEncodingError()
+        response.iter_content.side_effect = broken
+        self.assertIsNone(server.screenshot(out=io.BytesIO()))
+        session.get.side_effect = requests.exceptions.ConnectionError()
+        self.assertIsNone(server.screenshot())
 
     @patch('requests.post')
     def test_stop_started_server(self, mock_post):
@@ -176,6 +287,167 @@ class TestAutomatorServer_Stop(unittest.TestCase):
         self.assertTrue(istop >= 0 and istart >= 0)
         self.assertTrue(istop < istart)
 
+    def test_start_nowait(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.ping = MagicMock(return_value="pong")
+        readiness = server.start(wait=False)
+        self.assertIsInstance(readiness, ServerReadiness)
+        self.assertIsNone(readiness.result(timeout=5))
+        self.assertTrue(readiness.done())
+
+
+class TestServerReadiness(unittest.TestCase):
+
+    def setUp(self):
+        read_fd, self.write_fd = os.pipe()
+        self.process = MagicMock()
+        self.process.stdout = os.fdopen(read_fd, "rb")
+        self.ready = False
+
+    def tearDown(self):
+        try:
+            os.close(self.write_fd)
+        except OSError:
+            pass
+        self.process.stdout.close()
+
+    def write(self, line):
+        os.write(self.write_fd, line.encode("utf-8") + b"\n")
+
+    def ping(self):
+        return "pong" if self.ready else None
+
+    def test_ready_line(self):
+        readiness = ServerReadiness(self.process, self.ping, timeout=30)
+        time.sleep(0.5)  # backoff has grown past the first pings
+        self.assertFalse(readiness.done())
+        self.ready = True
+        begin = time.time()
+        self.write("INSTRUMENTATION_STATUS: class=TestSupportMain")
+        self.write("INSTRUMENTATION_STATUS_CODE: 1")
+        readiness.result(timeout=5)
+        self.assertLess(time.time() - begin, 0.2)
+        self.assertFalse(self.process.kill.called)
+
+    def test_reader_stops_at_ready_line(self):
+        self.ready = True
+        readiness = ServerReadiness(self.process, self.ping, timeout=30)
+        self.write("INSTRUMENTATION_STATUS_CODE: 1")
+        readiness.result(timeout=5)
+        self.assertTrue(readiness.close(5))
+        self.write("INSTRUMENTATION_STATUS: left for communicate")
+        self.assertEqual(len(readiness.output), 1)
+        self.assertEqual(self.process.stdout.readline(), b"INSTRUMENTATION_STATUS: left for communicate\n")
+
+    def test_stop_instrumentation_joins_reader(self):
+        server = AutomatorServer()
+        server.adb = MagicMock()
+        server.adb.cmd.return_value = self.process
+        self.process.poll.return_value = None
+        server.ping = MagicMock(return_value="pong")
+        server.start_instrumentation()
+        readiness = server.readiness(30)
+        readiness.result(timeout=5)
+
+        def communicate(timeout=None):
+            self.assertTrue(readiness.close(0))  # the reader stopped before
+            return self.process.stdout.read(), None
+
+        def stop_server(*args, **kwargs):
+            os.close(self.write_fd)  # the instrumentation ends
+        self.process.communicate.side_effect = communicate
+        with patch("uiautomatorminus.jsonrpc_call", side_effect=stop_server):
+            server.stop_instrumentation(signal_server=True)
+        self.assertTrue(self.process.communicate.called)
+        self.assertFalse(self.process.kill.called)
+
+    def test_instrumentation_failed(self):
+        readiness = ServerReadiness(self.process, self.ping, timeout=30)
+        self.write("INSTRUMENTATION_FAILED: org.bitbucket.tksn.testsupportapp2.test")
+        with self.assertRaises(IOError):
+            readiness.result(timeout=5)
+        self.process.kill.assert_called_once_with()
+        self.assertIn("INSTRUMENTATION_FAILED", readiness.output[0])
+
+    def test_process_exit(self):
+        readiness = ServerReadiness(self.process, self.ping, timeout=30)
+        os.close(self.write_fd)
+        self.assertIsInstance(readiness.exception(timeout=5), IOError)
+
+    def test_timeout(self):
+        readiness = ServerReadiness(self.process, self.ping, timeout=0.3)
+        with self.assertRaises(IOError):
+            readiness.result(timeout=0.05)  # not resolved yet
+        with self.assertRaises(IOError):
+            readiness.result(timeout=5)
+        self.assertTrue(readiness.done())
+
+
+class TestRecoveryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = RecoveryPolicy()
+        self.recover = MagicMock()
+        self.sleep_patch = patch("time.sleep")
+        self.sleep_patch.start()
+
+    def tearDown(self):
+        self.sleep_patch.stop()
+
+    def test_classify(self):
+        classify = self.policy.classify
+        self.assertEqual(classify(JsonRPCError(-32002, "UiObjectNotFoundException: ")), "application")
+        self.assertEqual(classify(JsonRPCError(-32601, "method not found")), "application")
+        self.assertEqual(classify(JsonRPCError(-32001, "java.lang.IllegalArgumentException: x")), "application")
+        self.assertEqual(classify(JsonRPCError(-32001, "java.lang.IllegalStateException: x")), "server")
+        self.assertEqual(classify(requests.exceptions.ReadTimeout("read timed out")), "transport")
+        self.assertEqual(classify(requests.exceptions.ConnectionError("[Errno 111] Connection refused")), "forward")
+        self.assertEqual(classify(requests.exceptions.ConnectionError("Connection aborted.")), "server")
+        self.assertEqual(classify(InstrumentationError("ended")), "apk")
+
+    def test_cheapest_first(self):
+        call = MagicMock(return_value="ok")
+        self.assertEqual(self.policy.recover(requests.exceptions.ReadTimeout(), self.recover, call), "ok")
+        self.assertFalse(self.recover.called)
+        refused = requests.exceptions.ConnectionError("Connection refused")
+        self.assertEqual(self.policy.recover(refused, self.recover, call), "ok")
+        self.recover.assert_called_once_with("forward")
+        stats = self.policy.stats()
+        self.assertEqual(stats["recovered"], 2)
+        self.assertEqual(stats["level.retry"], 1)
+        self.assertEqual(stats["error.forward"], 1)
+        self.assertIn("recovery_time", stats)
+
+    def test_escalate(self):
+        call = MagicMock(side_effect=[
+            requests.exceptions.ReadTimeout(), requests.exceptions.ConnectionError("aborted"),
+            InstrumentationError("ended"), "ok"])
+        self.recover.side_effect = [None, None, None]
+        self.assertEqual(self.policy.recover(requests.exceptions.ReadTimeout(), self.recover, call), "ok")
+        self.assertEqual([c[0][0] for c in self.recover.call_args_list], ["forward", "restart", "reinstall"])
+
+    def test_give_up(self):
+        error = JsonRPCError(-32001, "IllegalStateException: UiAutomation not connected")
+        call = MagicMock(side_effect=error)
+        with self.assertRaises(JsonRPCError):
+            self.policy.recover(error, self.recover, call)
+        self.assertEqual([c[0][0] for c in self.recover.call_args_list], ["restart", "reinstall"])
+        self.assertEqual(self.policy.stats()["failed"], 1)
+
+        call = MagicMock(side_effect=JsonRPCError(-32002, "UiObjectNotFoundException: "))
+        with self.assertRaises(JsonRPCError):
+            self.policy.recover(JsonRPCError(-32002, "UiObjectNotFoundException: "), self.recover, call)
+        self.assertFalse(call.called)
+
+    def test_application_error_after_recovery(self):
+        call = MagicMock(side_effect=JsonRPCError(-32002, "UiObjectNotFoundException: "))
+        with self.assertRaises(JsonRPCError):
+            self.policy.recover(requests.exceptions.ReadTimeout(), self.recover, call)
+        stats = self.policy.stats()
+        self.assertEqual(stats["failed"], 1)
+        self.assertNotIn("recovered", stats)
+
 
 class TestJsonRPCError(unittest.TestCase):
 
@@ -185,3 +457,234 @@ class TestJsonRPCError(unittest.TestCase):
         self.assertTrue(len(str(e)) > 0)
         e = JsonRPCError("200", "error")
         self.assertEqual(200, e.code)
+
+
+class TestInstallCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.apks = []
+        for name in ("a.apk", "b.apk"):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, "wb") as f:
+                f.write(name.encode("ascii"))
+            self.apks.append(path)
+        self.listing = b"package:/data/app/x-1/base.apk=pkg\npackage:/data/app/y-1/base.apk=pkg.test\n"
+        self.adb = MagicMock()
+        self.adb.device_serial.return_value = "emulator-5554"
+
+        def cmd(*args):
+            process = MagicMock()
+            if args[0] == "install":
+                process.communicate.return_value = (b"Performing Streamed Install\nSuccess\n", b"")
+            else:
+                process.communicate.return_value = (self.listing, b"")
+            return process
+        self.adb.cmd.side_effect = cmd
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def cache(self, ttl=3600):
+        return InstallCache(self.adb, self.apks, cache_dir=os.path.join(self.tmpdir, "cache"), ttl=ttl)
+
+    def test_record(self):
+        self.assertFalse(self.cache().installed())
+        self.cache().update()
+        self.adb.cmd.reset_mock()
+        self.assertTrue(self.cache().installed())
+        self.assertFalse(self.adb.cmd.called)  # trusted within the ttl
+
+        self.assertTrue(self.cache(ttl=0).installed())
+        self.assertEqual(self.adb.cmd.call_count, 1)
+        self.listing = b"package:/data/app/x-2/base.apk=pkg\n"
+        self.assertFalse(self.cache(ttl=0).installed())
+
+    def test_fingerprint(self):
+        cache = self.cache()
+        cache.update()
+        with open(self.apks[0], "wb") as f:
+            f.write(b"new build")
+        self.assertFalse(self.cache().installed())
+        os.remove(self.apks[0])
+        self.assertIsNone(self.cache().fingerprint())
+        self.assertFalse(self.cache().installed())
+
+    def test_server_install(self):
+        with patch("uiautomatorminus.Adb"):
+            server = AutomatorServer()
+        server.adb = self.adb
+        with patch("uiautomatorminus.InstallCache") as MockCache:
+            MockCache.return_value = cache = self.cache()
+            server.install()
+            self.assertEqual(len([c for c in self.adb.cmd.call_args_list if c[0][0] == "install"]), 2)
+            self.adb.cmd.reset_mock()
+            server.install()
+            self.assertFalse(self.adb.cmd.called)
+            server.install(force=True)
+            self.assertEqual(len([c for c in self.adb.cmd.call_args_list if c[0][0] == "install"]), 2)
+            self.assertEqual(MockCache.call_count, 1)
+
+    def test_record_confirmed(self):
+        self.cache().update()
+        self.adb.cmd.reset_mock()
+        self.listing = b"package:/data/app/x-2/base.apk=pkg\n"
+        self.assertTrue(self.cache().installed())
+        self.assertFalse(self.cache().installed(confirm=True))
+
+    def test_start_reinstalls_after_skipped_install(self):
+        with patch("uiautomatorminus.Adb"):
+            server = AutomatorServer()
+        server.adb = self.adb
+        server.set_forwarding = MagicMock()
+        server.start_instrumentation = MagicMock()
+        server.stop_instrumentation = MagicMock()
+        server.wait_device = MagicMock(side_effect=[IOError(), None])
+        server.readiness = MagicMock()
+        with patch("uiautomatorminus.InstallCache") as MockCache:
+            MockCache.return_value = cache = self.cache()
+            cache.update()
+            self.adb.cmd.reset_mock()
+            server.start()
+            self.assertEqual(len([c for c in self.adb.cmd.call_args_list if c[0][0] == "install"]), 2)
+            self.assertEqual(server.start_instrumentation.call_count, 2)
+            self.assertTrue(server.stop_instrumentation.called)
+
+            server.wait_device.side_effect = IOError()
+            cache.invalidate()
+            with self.assertRaises(IOError):
+                server.start()  # installed, nothing to retry
+
+            self.listing = b"package:/data/app/x-2/base.apk=pkg\n"
+            cache.update(InstallCache.parse_state(b"package:/data/app/x-1/base.apk=pkg\n"))
+            self.adb.cmd.reset_mock()
+            server.start(wait=False)
+            self.assertEqual(len([c for c in self.adb.cmd.call_args_list if c[0][0] == "install"]), 2)
+
+
+class FakeSelectorServer(object):
+
+    '''stand-in of requests.Session talking to a server with a selector registry.'''
+
+    def __init__(self, supported=True):
+        self.supported = supported
+        self.selectors = {}
+        self.next_handle = 0
+        self.bodies = []
+
+    def restart(self):
+        self.selectors.clear()
+
+    def expand(self, param):
+        if isinstance(param, dict) and list(param) == ["handle"]:
+            if param["handle"] not in self.selectors:
+                raise JsonRPCError(-32003, "unknown handle")
+            return self.selectors[param["handle"]]
+        return param
+
+    def handle(self, method, params):
+        if method in ("registerSelector", "unregisterSelector") and not self.supported:
+            raise JsonRPCError(-32601, "method not found")
+        if method == "registerSelector":
+            self.next_handle += 1
+            handle = "s%d" % self.next_handle
+            self.selectors[handle] = params[0]
+            return handle
+        if method == "unregisterSelector":
+            return self.selectors.pop(params[0], None) is not None
+        params = [self.expand(param) for param in params]
+        if method in ("exist", "click"):
+            return params[0].get("text") == "OK"
+        if method == "objInfo":
+            return {"text": params[0].get("text")}
+        return None
+
+    def post(self, url, data=None, **kwargs):
+        self.bodies.append(data)
+        request = json.loads(data)
+        try:
+            reply = {"result": self.handle(request["method"], request["params"])}
+        except JsonRPCError as e:
+            reply = {"error": {"code": e.code, "message": e.message}}
+        return PostResponse(json.dumps(dict(reply, jsonrpc="2.0", id=request["id"])))
+
+
+class TestSelectorRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.Adb_patch = patch('uiautomatorminus.Adb')
+        self.Adb_patch.start()
+        self.server = AutomatorServer("1234", 9010)
+        self.server.session = self.fake = FakeSelectorServer()
+        self.device = AutomatorDevice(server=self.server)
+
+    def tearDown(self):
+        self.Adb_patch.stop()
+
+    def last_params(self):
+        return json.loads(self.fake.bodies[-1])["params"]
+
+    def test_handle_sent(self):
+        d = self.device
+        self.assertEqual(d.register(text="OK", className="android.widget.Button"), "s1")
+        self.assertEqual(d.register(Selector(className="android.widget.Button", text="OK")), "s1")
+        self.assertTrue(d(text="OK", className="android.widget.Button").exists)
+        self.assertEqual(self.last_params(), [{"handle": "s1"}])
+        self.assertEqual(d(text="OK", className="android.widget.Button").info["text"], "OK")
+        self.assertEqual(self.last_params(), [{"handle": "s1"}])
+        self.assertFalse(d(text="Cancel").exists)
+        self.assertEqual(self.last_params()[0]["text"], "Cancel")
+        d.unregister(d(text="OK", className="android.widget.Button"))
+        self.assertEqual(self.fake.selectors, {})
+        self.assertTrue(d(text="OK", className="android.widget.Button").exists)
+        self.assertEqual(self.last_params()[0]["text"], "OK")
+
+    def test_lru(self):
+        self.server.selector_registry.capacity = 2
+        d = self.device
+        for text in ("a", "b"):
+            d.register(text=text)
+        d(text="a").exists  # a is now more recent than b
+        d.register(text="c")
+        self.assertEqual(sorted(sel["text"] for sel in self.fake.selectors.values()), ["a", "c"])
+        self.assertEqual(sorted(sel["text"] for sel in self.server.selector_registry.handles), ["a", "c"])
+
+    def test_restart(self):
+        d = self.device
+        d.register(text="OK")
+        self.fake.restart()
+        with patch.object(self.server, "stop_instrumentation"), \
+                patch.object(self.server, "start_instrumentation"), \
+                patch.object(self.server, "wait_device"):
+            self.server.restart()
+        self.assertEqual(list(self.fake.selectors.values())[0]["text"], "OK")
+        self.assertTrue(d(text="OK").exists)
+        self.assertEqual(self.last_params(), [{"handle": "s2"}])
+
+    def test_handles_lost(self):
+        d = self.device
+        d.register(text="OK")
+        self.fake.restart()  # without the client knowing
+        self.assertTrue(d(text="OK").click())
+        self.assertEqual(self.last_params(), [{"handle": "s2"}])
+        methods = [json.loads(body)["method"] for body in self.fake.bodies[-3:]]
+        self.assertEqual(methods, ["click", "registerSelector", "click"])
+
+    def test_not_supported(self):
+        self.fake.supported = False
+        d = self.device
+        self.assertIsNone(d.register(text="OK"))
+        self.assertIsNone(d.register(text="OK"))
+        self.assertEqual(len(self.fake.bodies), 1)
+        self.assertTrue(d(text="OK").exists)
+        self.assertEqual(self.last_params()[0]["text"], "OK")
+
+    def test_substitute(self):
+        registry = SelectorRegistry()
+        selector = Selector(text="OK").freeze()
+        args = (selector, Selector(text="OK"), 10)
+        self.assertIs(registry.substitute(args), args)
+        registry.add(selector, 7)
+        self.assertEqual(registry.substitute(args), [{"handle": 7}, Selector(text="OK"), 10])
+        self.assertEqual(registry.reset(), [selector])
+        self.assertIs(registry.substitute(args), args)
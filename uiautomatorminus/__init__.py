@@ -5,17 +5,35 @@
 
 import base64
 import collections
+import contextlib
+import errno
+import getpass
+import hashlib
+import io
+import itertools
 import json
 import logging
+import math
 import os
+import random
 import re
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-import uuid
-import xml.dom.minidom
 import requests
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from .adbsocket import AdbSocket
+from .hierarchy import CompactHierarchy, Hierarchy, StabilityTracker, iter_nodes, pretty_xml
+from .info import Rect, UiObjectInfo
+from .metrics import collector
 
 MAINPACKAGE = 'org.bitbucket.tksn.testsupportapp2'
 TESTPACKAGE = 'org.bitbucket.tksn.testsupportapp2.test'
@@ -25,18 +43,75 @@ INSTRUMENT_EXTRA_OPTS = [
     '-e', 'hideWindow', 'true'
 ]
 DEVICE_PORT = int(os.environ.get('UIAUTOMATOR_DEVICE_PORT', '9008'))
-LOCAL_PORT = int(os.environ.get('UIAUTOMATOR_LOCAL_PORT', '9008'))
+# "process" runs the adb executable, "socket" talks to the adb server directly
+ADB_BACKEND = os.environ.get('UIAUTOMATOR_ADB_BACKEND', 'process')
 
 JSONRPC_TIMEOUT = int(os.environ.get('JSONRPC_TIMEOUT', 20))
+# JsonRPCClients kept per server, one per timeout rounded up to 0.1 second
+JSONRPC_CLIENT_CACHE_SIZE = 8
 RESTART_TIMEOUT_AFTER_INSTRUMENT_RESET = 7
 RESTART_TIMEOUT_AFTER_REINSTALL = 23
 STOP_TIMEOUT = 5
+# am instrument output line telling the server has started
+READY_PATTERN = os.environ.get('UIAUTOMATOR_READY_PATTERN', r'^INSTRUMENTATION_STATUS_CODE: 1\b')
+# am instrument output lines telling the instrumentation has ended
+INSTRUMENTATION_END_MARKERS = ('INSTRUMENTATION_FAILED', 'INSTRUMENTATION_RESULT', 'INSTRUMENTATION_CODE')
+PING_TIMEOUT = 1
+PING_BACKOFF = (0.05, 1.0)
+# apk install records are kept per device serial in this directory
+CACHE_DIR = os.environ.get('UIAUTOMATOR_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'uiautomatorminus'))
+# seconds during which a matching install record is trusted without asking the device
+INSTALL_CACHE_TTL = int(os.environ.get('UIAUTOMATOR_INSTALL_CACHE_TTL', 3600))
+
+
+def runtime_user():
+    '''login name, or the uid where the user has no passwd entry (e.g. in containers).'''
+    try:
+        return getpass.getuser()
+    except (KeyError, OSError, ImportError):
+        return str(os.getuid()) if hasattr(os, 'getuid') else 'user'
+
+
+# local port registry shared by the processes of the user
+RUNTIME_DIR = os.environ.get('UIAUTOMATOR_RUNTIME_DIR') or os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'uiautomatorminus-%s' % runtime_user())
+# seconds after which a port registry entry is dropped even if its process looks alive
+PORT_ENTRY_TTL = 24 * 3600
+# seconds AutomatorDevice.info is cached, 0 disables the cache
+INFO_TTL = float(os.environ.get('UIAUTOMATOR_INFO_TTL', 0))
+# deviceInfo fields kept for the session once the cache is enabled
+STATIC_INFO_FIELDS = ('productName', 'sdkInt')
+# deviceInfo fields read from the device even when the info is cached
+VOLATILE_INFO_FIELDS = ('currentPackageName',)
+# devices a DevicePool starts or calls at the same time
+POOL_MAX_WORKERS = int(os.environ.get('UIAUTOMATOR_POOL_MAX_WORKERS', 16))
+# seconds an evicted device waits before the pool tries to start it again
+POOL_READMIT_INTERVAL = 30
+# objInfo calls sent in one batch request by AutomatorDeviceObject.infos() and all()
+INFOS_CHUNK_SIZE = 50
+# milliseconds the window must stay unchanged for wait.stable
+STABLE_WINDOW = 500
+# consecutive equal dumps wait.stable needs
+STABLE_MATCHES = 3
+# bytes read at a time when a screenshot is streamed to its destination
+SCREENSHOT_CHUNK_SIZE = 64 * 1024
+# frames a capture stream keeps before it drops the oldest
+CAPTURE_BUFFER_FRAMES = int(os.environ.get('UIAUTOMATOR_CAPTURE_BUFFER_FRAMES', 120))
+# apk bytes sent per stageApkChunk call by remote_exec_apk
+APK_CHUNK_SIZE = 512 * 1024
+# milliseconds a long poll for a remote_exec result waits on the server
+LONG_POLL_WAIT = 5000
+# first and max seconds between result polls when the server has no long poll
+RESULT_POLL_BACKOFF = (0.005, 1.0)
+# selectors kept registered on the server, the least recently used are dropped
+SELECTOR_REGISTRY_SIZE = int(os.environ.get('UIAUTOMATOR_SELECTOR_REGISTRY_SIZE', 256))
 
 
 if 'localhost' not in os.environ.get('no_proxy', ''):
     os.environ['no_proxy'] = "localhost,%s" % os.environ.get('no_proxy', '')
 
-__all__ = ["Device", "rect", "point", "Selector", "JsonRPCError"]
+__all__ = ["Device", "DevicePool", "rect", "point", "Rect", "UiObjectInfo", "Selector", "FrozenSelector", "JsonRPCError"]
 
 
 def U(x):
@@ -46,40 +121,97 @@ def U(x):
         return x
 
 
+class FluentMethod(object):
+
+    '''
+    Descriptor of a fluent entry point such as d.press.home(), built once
+    with the class. Accessing it on an instance returns a FluentCall; the
+    props are looked up in tables made here, not at every access.
+    '''
+
+    def __init__(self, func, props=(), kwprops=None):
+        if props and kwprops:
+            raise SyntaxError("Can not set both props and kwprops at the same time.")
+        self.func = func
+        self.__doc__ = func.__doc__
+        self.props = frozenset(props)
+        self.kwprops = bool(kwprops)
+        self.choices = {}  # prop value -> names of the kwprops taking it, in order
+        for prop_name, prop_values in (kwprops or {}).items():
+            for value in prop_values:
+                self.choices.setdefault(value, []).append(prop_name)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return FluentCall(self, self.func.__get__(instance, owner))
+
+    def choose(self, binding, attr):
+        '''the binding with attr chosen as a prop.'''
+        if self.kwprops:
+            for prop_name in self.choices.get(attr, ()):
+                if prop_name not in binding.kwargs:
+                    kwargs = dict(binding.kwargs)
+                    kwargs[prop_name] = attr
+                    return FluentCall(self, binding.func, (), kwargs)
+        elif attr in self.props:
+            return FluentCall(self, binding.func, binding.args + (attr,))
+        raise AttributeError("%s parameter is duplicated or not allowed!" % attr)
+
+
+class FluentCall(object):
+
+    '''
+    Fluent method bound to its function and the props chosen so far.
+    Choosing a prop returns a new FluentCall, nothing is kept between
+    calls, so one binding can be shared across threads.
+    '''
+
+    __slots__ = ("method", "func", "args", "kwargs")
+
+    def __init__(self, method, func, args=(), kwargs=None):
+        self.method = method
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+
+    def __getattr__(self, attr):
+        return self.method.choose(self, attr)
+
+    def __call__(self, *args, **kwargs):
+        if self.kwargs:
+            kwargs.update(self.kwargs)
+        return self.func(*(self.args + args), **kwargs)
+
+
+def fluent_method(*props, **kwprops):
+    '''
+    Decorate a method as a FluentMethod. With props, obj.method.a.b(x)
+    calls method("a", "b", x); with kwprops such as action=["a", "b"],
+    obj.method.a(x) calls method(x, action="a").
+    '''
+    def decorator(func):
+        return FluentMethod(func, props, kwprops)
+    return decorator
+
+
 def param_to_property(*props, **kwprops):
+    '''fluent_method for a plain function, func.a.b() calls func("a", "b").'''
     if props and kwprops:
         raise SyntaxError("Can not set both props and kwprops at the same time.")
 
-    class Wrapper(object):
-
-        def __init__(self, func):
-            self.func = func
-            self.kwargs, self.args = {}, []
-
-        def __getattr__(self, attr):
-            if kwprops:
-                for prop_name, prop_values in kwprops.items():
-                    if attr in prop_values and prop_name not in self.kwargs:
-                        self.kwargs[prop_name] = attr
-                        return self
-            elif attr in props:
-                self.args.append(attr)
-                return self
-            raise AttributeError("%s parameter is duplicated or not allowed!" % attr)
-
-        def __call__(self, *args, **kwargs):
-            if kwprops:
-                kwargs.update(self.kwargs)
-                self.kwargs = {}
-                return self.func(*args, **kwargs)
-            else:
-                new_args, self.args = self.args + list(args), []
-                return self.func(*new_args, **kwargs)
-    return Wrapper
+    def decorator(func):
+        return FluentCall(FluentMethod(func, props, kwprops), func)
+    return decorator
 
 
 ERROR_CODE_BASE = -32000
 ERROR_CODE_FILE_NOT_FOUND = ERROR_CODE_BASE - 2
+ERROR_CODE_UNKNOWN_HANDLE = ERROR_CODE_BASE - 3  # selector handle the server does not hold
+ERROR_CODE_PARSE_ERROR = -32700
+ERROR_CODE_INVALID_REQUEST = -32600
+ERROR_CODE_METHOD_NOT_FOUND = -32601
+ERROR_CODE_INVALID_PARAMS = -32602
 
 class JsonRPCError(Exception):
 
@@ -91,27 +223,157 @@ class JsonRPCError(Exception):
         return "JsonRPC Error code: %d, Message: %s" % (self.code, self.message)
 
 
-def jsonrpc_call(url, timeout, call_desc, session=None):
-    rpc_id = str(uuid.uuid4())
-    data = {
-        'jsonrpc': '2.0', 'method': call_desc['method'], 'id': rpc_id,
-        'params': call_desc.get('args', [])}
+class InstrumentationError(IOError):
 
-    logging.debug('POST:{}'.format(json.dumps(data)))
-    req = session or requests
-    jsonresult = req.post(url, json=data, timeout=timeout).json()
+    '''The instrumentation ended before the rpc server started.'''
+
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+_rpc_ids = itertools.count(1)
+
+
+def debug_enabled():
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+
+def encode_params(params):
+    '''JSON text of rpc params, reusing the encoded text of FrozenSelector params.'''
+    if not isinstance(params, (list, tuple)) or not any(isinstance(p, FrozenSelector) for p in params):
+        return json.dumps(params)
+    return '[' + ', '.join(p.to_json() if isinstance(p, FrozenSelector) else json.dumps(p) for p in params) + ']'
+
+
+def jsonrpc_body(method, rpc_id, params):
+    '''JSON-RPC 2.0 request text, as json.dumps would give it.'''
+    return '{"jsonrpc": "2.0", "method": %s, "id": %s, "params": %s}' % (
+        json.dumps(method), json.dumps(rpc_id), encode_params(params))
+
+
+# The JSON-RPC core below builds request bodies, reads decoded responses and
+# records metrics; the transports (requests here, asyncio streams in aio)
+# only move the bytes.
 
-    logging.debug('  -> {}'.format(json.dumps(jsonresult)))
+def jsonrpc_request(call_desc):
+    '''(method, body) of a JSON-RPC call.'''
+    method = call_desc['method']
+    body = jsonrpc_body(method, str(next(_rpc_ids)), call_desc.get('args', []))
+    if debug_enabled():
+        logging.debug('POST:{}'.format(body))
+    return method, body
 
+
+def observe_rpc(name, begin, body, content, error):
+    '''record a call in metrics with the size of its request and response.'''
+    if begin is not None:
+        collector.observe('rpc', name, time.time() - begin, len(body), len(content or b''), error)
+
+
+def jsonrpc_result(method, begin, body, content, jsonresult):
+    '''result of a decoded JSON-RPC response, JsonRPCError raised for its error.'''
+    observe_rpc(method, begin, body, content, 'error' in jsonresult)
+    if debug_enabled():
+        logging.debug('  -> {}'.format(json.dumps(jsonresult)))
     error = jsonresult.get('error')
     if error:
-        edata = error.get('data', {})
-        etype = edata.get('exceptionTypeName', '')
-        emsg = error.get('message', '')
-        raise JsonRPCError(error.get('code'), '{}: {}'.format(etype, emsg))
+        raise jsonrpc_error(error)
     return jsonresult.get('result')
 
 
+def jsonrpc_call(url, timeout, call_desc, session=None):
+    method, body = jsonrpc_request(call_desc)
+    req = session or requests
+    begin = time.time() if collector.enabled else None
+    response = None
+    try:
+        response = req.post(url, data=body, headers=JSON_HEADERS, timeout=timeout)
+        jsonresult = response.json()
+    except Exception:
+        observe_rpc(method, begin, body, getattr(response, 'content', None), True)
+        raise
+    return jsonrpc_result(method, begin, body, getattr(response, 'content', None), jsonresult)
+
+
+def jsonrpc_error(error):
+    '''build JsonRPCError from the error member of a JSON-RPC response.'''
+    edata = error.get('data') or {}
+    etype = edata.get('exceptionTypeName', '')
+    emsg = error.get('message', '')
+    return JsonRPCError(error.get('code'), '{}: {}'.format(etype, emsg))
+
+
+def jsonrpc_batch_request(call_descs):
+    '''(ids, body) of a JSON-RPC 2.0 batch request of call_descs.'''
+    ids = [str(next(_rpc_ids)) for call_desc in call_descs]
+    body = '[' + ', '.join(
+        jsonrpc_body(call_desc['method'], rpc_id, call_desc.get('args', []))
+        for call_desc, rpc_id in zip(call_descs, ids)) + ']'
+    if debug_enabled():
+        logging.debug('POST:{}'.format(body))
+    return ids, body
+
+
+def jsonrpc_batch_results(ids, begin, body, content, jsonresult):
+    '''
+    (result, error) tuples of a decoded batch response in the order of ids,
+    error being a JsonRPCError or None.
+    None if the server did not answer with a batch response.
+    '''
+    observe_rpc('batch', begin, body, content, not isinstance(jsonresult, list))
+    if debug_enabled():
+        logging.debug('  -> {}'.format(json.dumps(jsonresult)))
+    if not isinstance(jsonresult, list):
+        return None
+    responses = dict((r.get('id'), r) for r in jsonresult if isinstance(r, dict))
+    results = []
+    for rpc_id in ids:
+        response = responses.get(rpc_id)
+        if response is None:
+            results.append((None, JsonRPCError(ERROR_CODE_BASE, 'no response in batch')))
+        elif response.get('error'):
+            results.append((None, jsonrpc_error(response['error'])))
+        else:
+            results.append((response.get('result'), None))
+    return results
+
+
+def jsonrpc_batch_call(url, timeout, call_descs, session=None):
+    '''
+    Send call_descs as one JSON-RPC 2.0 batch request.
+    Return a list of (result, error) tuples in the order of call_descs,
+    error being a JsonRPCError or None.
+    Return None if the server does not accept batch requests.
+    '''
+    ids, body = jsonrpc_batch_request(call_descs)
+    req = session or requests
+    begin = time.time() if collector.enabled else None
+    response = None
+    try:
+        response = req.post(url, data=body, headers=JSON_HEADERS, timeout=timeout)
+        jsonresult = response.json()
+    except Exception as e:
+        observe_rpc('batch', begin, body, getattr(response, 'content', None), True)
+        if isinstance(e, ValueError):
+            return None
+        raise
+    return jsonrpc_batch_results(ids, begin, body, getattr(response, 'content', None), jsonresult)
+
+
+@contextlib.contextmanager
+def running_handlers(handlers, method):
+    '''
+    the not found handlers to run after method failed with
+    ERROR_CODE_FILE_NOT_FOUND, switched off meanwhile so the calls
+    they make are not handled again.
+    '''
+    begin = time.time() if collector.enabled else None
+    handlers['on'] = False
+    try:
+        yield list(handlers['handlers'])
+    finally:
+        handlers['on'] = True
+        if begin is not None:
+            collector.observe('fnf', method, time.time() - begin)
+
 
 def add_fnf_handling(call, handlers):
 
@@ -121,27 +383,152 @@ def add_fnf_handling(call, handlers):
         except JsonRPCError as e:
             if e.code != ERROR_CODE_FILE_NOT_FOUND:
                 raise
-        try:
-            handlers['on'] = False
+        with running_handlers(handlers, method) as device_handlers:
             # any handler returns True will break the left handlers
-            any(handler(handlers.get('device', None)) for handler in handlers['handlers'])
-        finally:
-            handlers['on'] = True
+            any(handler(handlers.get('device', None)) for handler in device_handlers)
         return call(method, *args, **kwargs)
     return wrap
 
 
-def add_recovery(call, restart_server):
-    
+# errors of the call itself, which a healthy server reports as well
+APPLICATION_ERROR_CODES = (
+    ERROR_CODE_FILE_NOT_FOUND, ERROR_CODE_PARSE_ERROR, ERROR_CODE_INVALID_REQUEST,
+    ERROR_CODE_METHOD_NOT_FOUND, ERROR_CODE_INVALID_PARAMS)
+APPLICATION_EXCEPTIONS = (
+    'UiObjectNotFoundException', 'StaleObjectException', 'IllegalArgumentException',
+    'NoSuchMethodException', 'ClassNotFoundException', 'NotImplementedException',
+    'NumberFormatException', 'JsonMappingException')
+
+
+class RecoveryPolicy(object):
+
+    '''
+    Recover from a failed JSON-RPC call with the cheapest fix first.
+    Failures are classified as application, transport, forward, server or
+    apk, which gives the first level of the ladder:
+    retry -> forward (redo adb forward) -> restart (instrumentation) -> reinstall.
+    Application errors are raised without recovery.
+    '''
+
+    LEVELS = ('retry', 'forward', 'restart', 'reinstall')
+    START_LEVELS = {'transport': 'retry', 'forward': 'forward', 'server': 'restart', 'apk': 'reinstall'}
+
+    def __init__(self, max_attempts=len(LEVELS), backoff=(0.1, 2.0)):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.counters = collections.Counter()
+        self.recovery_time = 0.0
+
+    def classify(self, error):
+        if isinstance(error, JsonRPCError):
+            etype = error.message.split(':', 1)[0].strip().split('.')[-1]
+            if error.code in APPLICATION_ERROR_CODES or etype in APPLICATION_EXCEPTIONS:
+                return 'application'
+            return 'server'
+        if isinstance(error, InstrumentationError):
+            return 'apk'
+        if isinstance(error, requests.exceptions.Timeout):
+            return 'transport'
+        if isinstance(error, requests.exceptions.ConnectionError):
+            # nothing listens on the local port once the adb forward is gone
+            return 'forward' if 'refused' in str(error).lower() else 'server'
+        if isinstance(error, requests.exceptions.RequestException):
+            return 'transport'
+        return 'server'
+
+    def start_level(self, error):
+        '''index in LEVELS to recover the error from, None for application errors.'''
+        kind = self.classify(error)
+        self.counters['error.' + kind] += 1
+        if kind == 'application':
+            return None
+        return self.LEVELS.index(self.START_LEVELS[kind])
+
+    def delay(self, attempt):
+        '''jittered exponential backoff.'''
+        return min(self.backoff[0] * 2 ** attempt, self.backoff[1]) * random.uniform(0.5, 1.0)
+
+    def record(self, outcome, elapsed):
+        self.counters[outcome] += 1
+        self.recovery_time += elapsed
+        if collector.enabled:
+            collector.observe('recovery', outcome, elapsed, error=outcome == 'failed')
+
+    def steps(self, error):
+        '''
+        Generator of the ladder climbed from error, independent of the
+        transport. It yields (delay, level): sleep delay seconds, perform
+        level unless it is retry, call again and send the error of the
+        attempt, None once it succeeded. Raise the error to give up.
+        '''
+        logging.debug('{} during JSONRPC call: {}'.format(error.__class__.__name__, error))
+        level = self.start_level(error)
+        if level is None:
+            raise error
+        begin = time.time()
+        for attempt in range(self.max_attempts):
+            name = self.LEVELS[level]
+            self.counters['level.' + name] += 1
+            logging.debug('Recovering with {} from: {}'.format(name, error))
+            attempt_begin = time.time()
+            error = yield (self.delay(attempt) if name in ('retry', 'forward') else 0, name)
+            if collector.enabled:
+                collector.observe('recovery', name, time.time() - attempt_begin, error=error is not None)
+            if error is None:
+                self.record('recovered', time.time() - begin)
+                return
+            next_level = self.start_level(error)
+            if next_level is None:  # the call went through but failed on its own
+                self.record('failed', time.time() - begin)
+                raise error
+            level = max(level + 1, next_level)
+            if level >= len(self.LEVELS):
+                break
+        self.record('failed', time.time() - begin)
+        raise error
+
+    def recover(self, error, recover, call):
+        '''
+        Climb the ladder until call() succeeds.
+        recover(level) performs the forward/restart/reinstall levels.
+        '''
+        steps, outcome = self.steps(error), None
+        while True:
+            try:
+                delay, level = steps.send(outcome)
+            except StopIteration:
+                return result
+            outcome = None
+            try:
+                if delay:
+                    time.sleep(delay)
+                if level != 'retry':
+                    recover(level)
+                result = call()
+            except (IOError, JsonRPCError) as e:
+                outcome = e
+
+    def stats(self):
+        '''counters of errors, levels and outcomes, and the time spent recovering.'''
+        stats = dict(self.counters)
+        stats['recovery_time'] = self.recovery_time
+        return stats
+
+
+# errors of a call which RecoveryPolicy recovers from
+RECOVERABLE_ERRORS = (requests.exceptions.RequestException, JsonRPCError)
+
+
+def add_recovery(call, recover, policy=None):
+    '''recover(level) is called with the levels of RecoveryPolicy.'''
+    policy = policy or RecoveryPolicy()
+
     def wrap(method, *args, **kwargs):
         try:
             return call(method, *args, **kwargs)
-        except requests.exceptions.RequestException as e:
-            logging.debug('RequestException during JSONRPC call: {}'.format(e))
-        except JsonRPCError as e:
-            logging.debug('JsonRPCError during JSONRPC call: {}'.format(e))
-        restart_server()
-        return call(method, *args, **kwargs)
+        except RECOVERABLE_ERRORS as e:
+            error = e
+        return policy.recover(error, recover, lambda: call(method, *args, **kwargs))
     return wrap
 
 
@@ -151,43 +538,187 @@ class JsonRPCClient(object):
         self.__call = call
 
     def __getattr__(self, method):
+        rpc_call = self.__call
         def call(*args, **kwargs):
+            return rpc_call(method, *args, **kwargs)
+        self.__dict__[method] = call  # later lookups skip __getattr__
+        return call
+
+
+class JsonRPCClientCache(object):
+
+    '''
+    JsonRPCClients by timeout, built by factory(timeout). Timeouts are
+    rounded up to 0.1 second and the least recently used client is dropped
+    beyond size, so computed timeouts do not grow the cache.
+    '''
+
+    def __init__(self, factory, size=JSONRPC_CLIENT_CACHE_SIZE):
+        self.factory = factory
+        self.size = size
+        self.clients = collections.OrderedDict()
+
+    def get(self, timeout=None):
+        if timeout is not None:
+            timeout = math.ceil(timeout * 10) / 10.0
+        client = self.clients.pop(timeout, None)
+        if client is None:
+            client = self.factory(timeout)
+            while len(self.clients) >= self.size:
+                self.clients.popitem(last=False)
+        self.clients[timeout] = client
+        return client
+
+    def clear(self):
+        self.clients.clear()
+
+    def __len__(self):
+        return len(self.clients)
+
+
+class JsonRPCFuture(object):
+
+    '''Result of a call queued in JsonRPCBatch, resolved when the batch is sent.'''
+
+    def __init__(self, method):
+        self.method = method
+        self.__done = False
+        self.__result = None
+        self.__error = None
+
+    def set_result(self, result):
+        self.__result, self.__done = result, True
+
+    def set_exception(self, error):
+        self.__error, self.__done = error, True
+
+    def done(self):
+        return self.__done
+
+    def exception(self):
+        if not self.__done:
+            raise RuntimeError("%s is not sent yet." % self.method)
+        return self.__error
+
+    def result(self):
+        if self.exception() is not None:
+            raise self.__error
+        return self.__result
+
+
+class JsonRPCBatch(JsonRPCClient):
+
+    '''
+    Queue JSON-RPC calls and send them as one JSON-RPC 2.0 batch request.
+    Usage:
+    with d.batch() as b:
+        info = b.deviceInfo()
+        found = b.exist(Selector(text="OK"))
+    info.result(), found.result()
+    '''
+
+    def __init__(self, send_batch, call, wrap):
+        super(JsonRPCBatch, self).__init__(self.__queue_call)
+        self.__send_batch = send_batch
+        self.__call = call
+        self.__wrap = wrap
+        self.__queue = []
+
+    def __queue_call(self, method, *args, **kwargs):
+        future = JsonRPCFuture(method)
+        self.__queue.append((method, args, kwargs, future))
+        return future
+
+    def entry_call(self, outcome):
+        '''call which answers the first attempt from the batch response.'''
+        pending = [] if outcome is None else [outcome]
+
+        def call(method, *args, **kwargs):
+            if pending:
+                result, error = pending.pop()
+                if error is not None:
+                    raise error
+                return result
             return self.__call(method, *args, **kwargs)
         return call
 
+    def take(self):
+        '''the queued (method, args, kwargs, future) entries, emptying the queue.'''
+        queue, self.__queue = self.__queue, []
+        return queue
+
+    def send(self, queue):
+        '''send_batch of the queued entries.'''
+        return self.__send_batch([(method, args, kwargs) for method, args, kwargs, _ in queue])
+
+    def entry_calls(self, queue, results):
+        '''
+        per entry the wrapped call whose first attempt is answered from
+        results, so failed entries are handled and recovered as single calls.
+        '''
+        if results is None:  # fall back to one call per entry
+            results = [None] * len(queue)
+        return [self.__wrap(self.entry_call(outcome)) for outcome in results]
+
+    def execute(self):
+        '''send the queued calls and resolve their futures.'''
+        queue = self.take()
+        if not queue:
+            return
+        for (method, args, kwargs, future), call in zip(queue, self.entry_calls(queue, self.send(queue))):
+            try:
+                future.set_result(call(method, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.take()
+
+
+# selector field -> (UiSelector mask bit, default)
+SELECTOR_FIELDS = {
+    "text": (0x01, None),  # MASK_TEXT,
+    "textContains": (0x02, None),  # MASK_TEXTCONTAINS,
+    "textMatches": (0x04, None),  # MASK_TEXTMATCHES,
+    "textStartsWith": (0x08, None),  # MASK_TEXTSTARTSWITH,
+    "className": (0x10, None),  # MASK_CLASSNAME
+    "classNameMatches": (0x20, None),  # MASK_CLASSNAMEMATCHES
+    "description": (0x40, None),  # MASK_DESCRIPTION
+    "descriptionContains": (0x80, None),  # MASK_DESCRIPTIONCONTAINS
+    "descriptionMatches": (0x0100, None),  # MASK_DESCRIPTIONMATCHES
+    "descriptionStartsWith": (0x0200, None),  # MASK_DESCRIPTIONSTARTSWITH
+    "checkable": (0x0400, False),  # MASK_CHECKABLE
+    "checked": (0x0800, False),  # MASK_CHECKED
+    "clickable": (0x1000, False),  # MASK_CLICKABLE
+    "longClickable": (0x2000, False),  # MASK_LONGCLICKABLE,
+    "scrollable": (0x4000, False),  # MASK_SCROLLABLE,
+    "enabled": (0x8000, False),  # MASK_ENABLED,
+    "focusable": (0x010000, False),  # MASK_FOCUSABLE,
+    "focused": (0x020000, False),  # MASK_FOCUSED,
+    "selected": (0x040000, False),  # MASK_SELECTED,
+    "packageName": (0x080000, None),  # MASK_PACKAGENAME,
+    "packageNameMatches": (0x100000, None),  # MASK_PACKAGENAMEMATCHES,
+    "resourceId": (0x200000, None),  # MASK_RESOURCEID,
+    "resourceIdMatches": (0x400000, None),  # MASK_RESOURCEIDMATCHES,
+    "index": (0x800000, 0),  # MASK_INDEX,
+    "instance": (0x01000000, 0)  # MASK_INSTANCE,
+}
+# selector keys which are not fields
+SELECTOR_META = ("mask", "childOrSibling", "childOrSiblingSelector")
+
 
 class Selector(dict):
 
     """The class is to build parameters for UiSelector passed to Android device.
     """
-    __fields = {
-        "text": (0x01, None),  # MASK_TEXT,
-        "textContains": (0x02, None),  # MASK_TEXTCONTAINS,
-        "textMatches": (0x04, None),  # MASK_TEXTMATCHES,
-        "textStartsWith": (0x08, None),  # MASK_TEXTSTARTSWITH,
-        "className": (0x10, None),  # MASK_CLASSNAME
-        "classNameMatches": (0x20, None),  # MASK_CLASSNAMEMATCHES
-        "description": (0x40, None),  # MASK_DESCRIPTION
-        "descriptionContains": (0x80, None),  # MASK_DESCRIPTIONCONTAINS
-        "descriptionMatches": (0x0100, None),  # MASK_DESCRIPTIONMATCHES
-        "descriptionStartsWith": (0x0200, None),  # MASK_DESCRIPTIONSTARTSWITH
-        "checkable": (0x0400, False),  # MASK_CHECKABLE
-        "checked": (0x0800, False),  # MASK_CHECKED
-        "clickable": (0x1000, False),  # MASK_CLICKABLE
-        "longClickable": (0x2000, False),  # MASK_LONGCLICKABLE,
-        "scrollable": (0x4000, False),  # MASK_SCROLLABLE,
-        "enabled": (0x8000, False),  # MASK_ENABLED,
-        "focusable": (0x010000, False),  # MASK_FOCUSABLE,
-        "focused": (0x020000, False),  # MASK_FOCUSED,
-        "selected": (0x040000, False),  # MASK_SELECTED,
-        "packageName": (0x080000, None),  # MASK_PACKAGENAME,
-        "packageNameMatches": (0x100000, None),  # MASK_PACKAGENAMEMATCHES,
-        "resourceId": (0x200000, None),  # MASK_RESOURCEID,
-        "resourceIdMatches": (0x400000, None),  # MASK_RESOURCEIDMATCHES,
-        "index": (0x800000, 0),  # MASK_INDEX,
-        "instance": (0x01000000, 0)  # MASK_INSTANCE,
-    }
-    __mask, __childOrSibling, __childOrSiblingSelector = "mask", "childOrSibling", "childOrSiblingSelector"
+    __fields = SELECTOR_FIELDS
+    __mask, __childOrSibling, __childOrSiblingSelector = SELECTOR_META
 
     def __init__(self, **kwargs):
         super(Selector, self).__setitem__(self.__mask, 0)
@@ -218,6 +749,12 @@ class Selector(dict):
             selector[self.__childOrSiblingSelector].append(s.clone())
         return selector
 
+    def freeze(self):
+        '''FrozenSelector equal to this selector and its child/sibling chain.'''
+        return FrozenSelector.build(
+            dict((k, v) for k, v in self.items() if k not in SELECTOR_META),
+            self[self.__childOrSibling], [s.freeze() for s in self[self.__childOrSiblingSelector]])
+
     def child(self, **kwargs):
         self[self.__childOrSibling].append("child")
         self[self.__childOrSiblingSelector].append(Selector(**kwargs))
@@ -231,6 +768,133 @@ class Selector(dict):
     child_selector, from_parent = child, sibling
 
 
+def _immutable(self, *args, **kwargs):
+    raise TypeError("FrozenSelector is immutable.")
+
+
+class _FrozenList(list):
+
+    '''chain list of FrozenSelector, equal to the list of a Selector.'''
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = clear = _immutable
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+
+class FrozenSelector(dict):
+
+    '''
+    Immutable Selector taking the same kwargs. It hashes and compares by
+    its fields and chain, so it can key caches. child, sibling and replace
+    return new selectors, and its JSON text is encoded once then reused
+    in every rpc it is sent in.
+    '''
+
+    __slots__ = ("__hash", "__json")
+
+    def __init__(self, **kwargs):
+        self.__fill(kwargs, _FrozenList(), _FrozenList())
+
+    @classmethod
+    def build(cls, fields, relations=(), selectors=()):
+        '''selector of a field dict and a child/sibling chain of FrozenSelector.'''
+        selector = cls.__new__(cls)
+        selector.__fill(fields, _FrozenList(relations), _FrozenList(selectors))
+        return selector
+
+    def __fill(self, fields, relations, selectors):
+        mask = 0
+        for k in fields:
+            if k not in SELECTOR_FIELDS:
+                raise ReferenceError("%s is not allowed." % k)
+            mask |= SELECTOR_FIELDS[k][0]
+        # same key order as Selector, fields sorted so equal selectors encode alike
+        dict.__setitem__(self, "mask", mask)
+        dict.__setitem__(self, "childOrSibling", relations)
+        dict.__setitem__(self, "childOrSiblingSelector", selectors)
+        for k in sorted(fields):
+            dict.__setitem__(self, U(k), U(fields[k]))
+        self.__hash = self.__json = None
+
+    def fields(self):
+        '''dict of the fields, without mask and chain.'''
+        return dict((k, v) for k, v in self.items() if k not in SELECTOR_META)
+
+    def replace(self, **kwargs):
+        '''copy with the fields of kwargs set.'''
+        fields = self.fields()
+        fields.update(kwargs)
+        return self.build(fields, self["childOrSibling"], self["childOrSiblingSelector"])
+
+    def pinned(self, instance):
+        '''
+        copy picking the instance-th of the matched objects, the instance
+        being set on the last link of the chain, which matches them.
+        '''
+        selectors = self["childOrSiblingSelector"]
+        if not selectors:
+            return self.replace(instance=instance)
+        return self.build(self.fields(), self["childOrSibling"],
+                          list(selectors[:-1]) + [selectors[-1].replace(instance=instance)])
+
+    def __chain(self, relation, kwargs):
+        return self.build(self.fields(), list(self["childOrSibling"]) + [relation],
+                          list(self["childOrSiblingSelector"]) + [FrozenSelector(**kwargs)])
+
+    def child(self, **kwargs):
+        return self.__chain("child", kwargs)
+
+    def sibling(self, **kwargs):
+        return self.__chain("sibling", kwargs)
+
+    child_selector, from_parent = child, sibling
+
+    def clone(self):
+        return self
+
+    def freeze(self):
+        return self
+
+    def thaw(self):
+        '''mutable Selector equal to this one.'''
+        selector = Selector(**self.fields())
+        for relation, sub_selector in zip(self["childOrSibling"], self["childOrSiblingSelector"]):
+            selector["childOrSibling"].append(relation)
+            selector["childOrSiblingSelector"].append(sub_selector.thaw())
+        return selector
+
+    def to_json(self):
+        if self.__json is None:
+            self.__json = json.dumps(self)
+        return self.__json
+
+    def __hash__(self):
+        if self.__hash is None:
+            self.__hash = hash((tuple(sorted(self.fields().items())),
+                                self["childOrSibling"], self["childOrSiblingSelector"]))
+        return self.__hash
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenSelector.build,
+                (self.fields(), list(self["childOrSibling"]), list(self["childOrSiblingSelector"])))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    if sys.version_info >= (3, 9):
+        __ior__ = _immutable
+
+    def __repr__(self):
+        return "FrozenSelector(%s)" % dict.__repr__(self)
+
+
 def rect(top=0, left=0, bottom=100, right=100):
     return {"top": top, "left": left, "bottom": bottom, "right": right}
 
@@ -247,6 +911,30 @@ def point(x=0, y=0):
     return {"x": x, "y": y}
 
 
+def corner_point(bounds, corner=None):
+    '''(x, y) inside bounds near the corner tl/topleft or br/bottomright, the center otherwise.'''
+    if corner in ["tl", "topleft"]:
+        return (5 * bounds["left"] + bounds["right"]) / 6, (5 * bounds["top"] + bounds["bottom"]) / 6
+    elif corner in ["br", "bottomright"]:
+        return (bounds["left"] + 5 * bounds["right"]) / 6, (bounds["top"] + 5 * bounds["bottom"]) / 6
+    return (bounds["left"] + bounds["right"]) / 2, (bounds["top"] + bounds["bottom"]) / 2
+
+
+def adb_command_name(args):
+    '''adb command of an adb command line for metrics, e.g. "shell am".'''
+    args = list(args)
+    while args[:1] in (["-s"], ["-H"], ["-P"]):
+        args = args[2:]
+    return " ".join(args[:2]) if args[:1] == ["shell"] else " ".join(args[:1])
+
+
+def flush_output(result, streamed, on_output):
+    '''pass to on_output the stdout of a remote run result past the streamed length.'''
+    output = result.get("stdOutString") if isinstance(result, dict) else None
+    if on_output is not None and output and len(output) > streamed:
+        on_output(output[streamed:])
+
+
 class Adb(object):
 
     def __init__(self, serial=None, adb_server_host=None, adb_server_port=None):
@@ -296,7 +984,16 @@ class Adb(object):
         if os.name != "nt":
             cmd_line = [" ".join(cmd_line)]
         logging.debug('POPEN:{}'.format(cmd_line))
-        return subprocess.Popen(cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if not collector.enabled:
+            return subprocess.Popen(cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        begin = time.time()
+        try:
+            process = subprocess.Popen(cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            collector.observe('adb', adb_command_name(args), time.time() - begin, error=True)
+            raise
+        collector.observe('adb', adb_command_name(args), time.time() - begin)
+        return process
 
     def device_serial(self):
         if not self.default_serial:
@@ -337,20 +1034,164 @@ class Adb(object):
         return [match.group(i) for i in range(4)]
 
 
-_init_local_port = LOCAL_PORT - 1
+def adb_class(adb_backend=None):
+    '''Adb or AdbSocket, see ADB_BACKEND.'''
+    return AdbSocket if (adb_backend or ADB_BACKEND) == 'socket' else Adb
 
 
-def next_local_port(adbHost=None):
-    def is_port_listening(port):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = s.connect_ex((str(adbHost) if adbHost else '127.0.0.1', port))
+def is_port_listening(host, port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        return s.connect_ex((str(host) if host else '127.0.0.1', port)) == 0
+    finally:
         s.close()
-        return result == 0
-    global _init_local_port
-    _init_local_port = _init_local_port + 1 if _init_local_port < 32764 else LOCAL_PORT
-    while is_port_listening(_init_local_port):
-        _init_local_port += 1
-    return _init_local_port
+
+
+def free_local_port(adbHost=None, exclude=()):
+    '''
+    a port the OS reports free, not in exclude. With a remote adb server the
+    forward listens there, so the port must not be listening on it either.
+    '''
+    for _ in range(100):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        finally:
+            s.close()
+        if port in exclude:
+            continue
+        if str(adbHost or 'localhost') in ('localhost', '127.0.0.1') or not is_port_listening(adbHost, port):
+            return port
+    raise IOError("No free local port found.")
+
+
+def pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':  # os.kill would terminate it, entries expire by PORT_ENTRY_TTL
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class PortRegistry(object):
+
+    '''
+    Local ports allocated per (adb host, serial, device port), kept in a JSON
+    file shared by the processes of the user and guarded by a lock file.
+    Entries whose processes are gone, or older than PORT_ENTRY_TTL, are dropped
+    on the next allocation.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(RUNTIME_DIR, 'ports.json')
+        self.__lock = threading.Lock()  # flock does not exclude threads sharing the file
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.__lock:
+            dirname = os.path.dirname(self.path)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname, 0o700)
+                except OSError:
+                    if not os.path.isdir(dirname):
+                        raise
+            with open(self.path + '.lock', 'a+') as f:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                try:
+                    yield
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                    else:
+                        f.seek(0)
+                        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    @staticmethod
+    def key(adbHost, serial, device_port):
+        return '%s|%s|%d' % (adbHost or 'localhost', serial or '', device_port)
+
+    def entries(self):
+        '''{key: {"port", "pids", "time"}}, read without the lock.'''
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def __save(self, entries):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entries, f)
+        if os.name == 'nt' and os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+
+    @staticmethod
+    def clean(entries):
+        '''entries without dead processes, expired and malformed entries.'''
+        now = time.time()
+        alive = {}
+        for key, entry in entries.items():
+            try:
+                pids = [pid for pid in entry['pids'] if pid_alive(pid)]
+                if pids and now - entry['time'] < PORT_ENTRY_TTL:
+                    alive[key] = {'port': int(entry['port']), 'pids': pids, 'time': entry['time']}
+            except (KeyError, TypeError, ValueError):
+                pass
+        return alive
+
+    def allocate(self, adbHost=None, serial=None, device_port=DEVICE_PORT):
+        '''
+        the port registered for the key by a live process, otherwise a new
+        free port no other key holds.
+        '''
+        key = self.key(adbHost, serial, device_port)
+        with self.locked():
+            entries = self.clean(self.entries())
+            entry = entries.get(key)
+            if entry is None:
+                taken = set(e['port'] for e in entries.values())
+                entry = entries[key] = {'port': free_local_port(adbHost, taken), 'pids': []}
+            if os.getpid() not in entry['pids']:
+                entry['pids'].append(os.getpid())
+            entry['time'] = time.time()
+            self.__save(entries)
+        return entry['port']
+
+    def release(self, adbHost=None, serial=None, device_port=DEVICE_PORT):
+        '''unregister this process from the key.'''
+        key = self.key(adbHost, serial, device_port)
+        with self.locked():
+            entries = self.clean(self.entries())
+            entry = entries.get(key)
+            if entry is not None and os.getpid() in entry['pids']:
+                entry['pids'].remove(os.getpid())
+                if not entry['pids']:
+                    del entries[key]
+                self.__save(entries)
+
+
+port_registry = PortRegistry()
+
+
+def next_local_port(adbHost=None, serial=None, device_port=None):
+    '''local port to forward to device_port of the device, see PortRegistry.'''
+    try:
+        return port_registry.allocate(adbHost, serial, device_port or DEVICE_PORT)
+    except (IOError, OSError) as e:
+        logging.debug('Port registry not available: {}'.format(e))
+        return free_local_port(adbHost)
 
 
 class NotFoundHandler(object):
@@ -367,6 +1208,303 @@ class NotFoundHandler(object):
         return self.__handlers[instance.adb.device_serial()]
 
 
+class ApkStager(object):
+
+    '''
+    Content-addressed apk upload for remote_exec_apk. An apk is named by its
+    sha256 and uploaded once in chunk_size pieces with stageApkChunk, then
+    runStagedApk refers to it, so running it again is one small call.
+    supported turns False for servers without the staging methods.
+    '''
+
+    def __init__(self, chunk_size=APK_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.supported = True
+        self.staged = set()  # digests the server is known to keep
+        self.__digests = {}
+
+    def digest(self, path):
+        '''sha256 of the file, computed again only if its size or mtime changed.'''
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+        digest = self.__digests.get(key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    sha256.update(chunk)
+            digest = self.__digests[key] = sha256.hexdigest()
+        return digest
+
+    def chunks(self, path):
+        '''(offset, base64 data) of the file, read chunk_size bytes at a time.'''
+        offset = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                yield offset, base64.b64encode(chunk).decode('ascii')
+                offset += len(chunk)
+
+
+class SelectorRegistry(object):
+
+    '''
+    Selectors registered on the server with registerSelector. A registered
+    FrozenSelector is sent as {"handle": handle} in rpc params instead of
+    its whole JSON. At most capacity selectors are kept, the least recently
+    used is unregistered to make room, so the server holds the same set.
+    supported turns False for servers without registerSelector.
+    '''
+
+    def __init__(self, capacity=SELECTOR_REGISTRY_SIZE):
+        self.capacity = capacity
+        self.supported = True
+        self.handles = collections.OrderedDict()  # FrozenSelector -> handle, oldest use first
+
+    def lookup(self, selector):
+        '''handle of the selector, now the most recently used, or None.'''
+        handle = self.handles.pop(selector, None)
+        if handle is not None:
+            self.handles[selector] = handle
+        return handle
+
+    def add(self, selector, handle):
+        '''record a registered selector. return the handles evicted for it.'''
+        self.handles[selector] = handle
+        evicted = []
+        while len(self.handles) > self.capacity:
+            evicted.append(self.handles.popitem(last=False)[1])
+        return evicted
+
+    def remove(self, selector):
+        return self.handles.pop(selector, None)
+
+    def reset(self):
+        '''forget the handles the server lost. return their selectors, oldest use first.'''
+        selectors = list(self.handles)
+        self.handles.clear()
+        return selectors
+
+    def substitute(self, args):
+        '''args with registered selectors replaced by their handles, args itself if there are none.'''
+        if not self.handles:
+            return args
+        sent = None
+        for i, arg in enumerate(args):
+            if isinstance(arg, FrozenSelector):
+                handle = self.lookup(arg)
+                if handle is not None:
+                    sent = sent or list(args)
+                    sent[i] = {'handle': handle}
+        return args if sent is None else sent
+
+
+class InstallCache(object):
+
+    '''
+    Tell whether the bundled apks are already installed on the device.
+    The apks are fingerprinted by content, and the device state is the
+    package listing (apk paths change whenever a package is reinstalled).
+    Both are recorded per serial after each install.
+    '''
+
+    def __init__(self, adb, apk_paths, cache_dir=None, ttl=None):
+        self.adb = adb
+        self.apk_paths = apk_paths
+        self.cache_dir = cache_dir or CACHE_DIR
+        self.ttl = INSTALL_CACHE_TTL if ttl is None else ttl
+        self.__fingerprint = None
+
+    def fingerprint(self):
+        '''sha1 of the apk files, None if any of them is missing.'''
+        if self.__fingerprint is None:
+            sha1 = hashlib.sha1()
+            for path in self.apk_paths:
+                if not os.path.isfile(path):
+                    return None
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 16), b''):
+                        sha1.update(chunk)
+            self.__fingerprint = sha1.hexdigest()
+        return self.__fingerprint
+
+    # adb command listing the installed apk paths of the test server packages
+    state_command = ("shell", "pm", "list", "packages", "-f", MAINPACKAGE)
+
+    @staticmethod
+    def parse_state(out):
+        if isinstance(out, bytes):
+            out = out.decode("utf-8", "replace")
+        return sorted(line.strip() for line in out.splitlines() if line.strip())
+
+    def device_state(self):
+        '''installed apk paths of the test server packages, in one query.'''
+        return self.parse_state(self.adb.cmd(*self.state_command).communicate()[0])
+
+    def __record_path(self):
+        serial = re.sub(r'[^\w.-]', '_', str(self.adb.device_serial()))
+        return os.path.join(self.cache_dir, 'install-%s.json' % serial)
+
+    def __load(self):
+        try:
+            with open(self.__record_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __save(self, state):
+        record = {'fingerprint': self.fingerprint(), 'state': state, 'time': time.time()}
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(self.__record_path(), 'w') as f:
+                json.dump(record, f)
+        except (IOError, OSError) as e:
+            logging.debug('Install record not saved: {}'.format(e))
+
+    def check(self):
+        '''
+        True or False from the local record alone,
+        None if the device state is needed to tell (see confirm).
+        '''
+        fingerprint = self.fingerprint()
+        record = self.__load()
+        if fingerprint is None or not record or record.get('fingerprint') != fingerprint:
+            return False
+        if time.time() - record.get('time', 0) < self.ttl:
+            return True
+        return None
+
+    def confirm(self, state):
+        '''True if state is the recorded device state.'''
+        record = self.__load()
+        if not state or not record or state != record.get('state'):
+            return False
+        self.__save(state)
+        return True
+
+    def installed(self, confirm=False):
+        '''
+        True if the device has the same apks as the last recorded install.
+        With confirm the device state is queried even within the ttl.
+        '''
+        known = self.check()
+        if known is None or (confirm and known):
+            return self.confirm(self.device_state())
+        return known
+
+    def update(self, state=None):
+        '''record the device state after the apks are installed.'''
+        if self.fingerprint() is None:
+            return
+        if state is None:
+            state = self.device_state()
+        if state:
+            self.__save(state)
+
+    def invalidate(self):
+        try:
+            os.remove(self.__record_path())
+        except (IOError, OSError):
+            pass
+
+
+class ServerReadiness(object):
+
+    '''
+    Future of the rpc server start.
+    The am instrument output is read in the background: the ready line
+    triggers a ping at once, and the end of the instrumentation fails the
+    start without waiting for the timeout. Otherwise the server is pinged
+    with a short timeout and exponential backoff.
+    The reader stops at the ready line or once the start is resolved;
+    close() waits for it before anyone else reads the pipe.
+    '''
+
+    def __init__(self, process, ping, timeout, ready_pattern=READY_PATTERN):
+        self.process = process
+        self.ping = ping
+        self.timeout = timeout
+        self.ready_regex = re.compile(ready_pattern)
+        self.output = []
+        self.__wakeup = threading.Event()
+        self.__exited = threading.Event()
+        self.__done = threading.Event()
+        self.__error = None
+        self.__reader = None
+        for target in (self.__read, self.__wait):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self.__reader = self.__reader or thread
+
+    def __read(self):
+        try:
+            for line in self.process.stdout:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8', 'replace')
+                self.output.append(line)
+                if self.ready_regex.search(line):
+                    self.__wakeup.set()
+                    return
+                if line.startswith(INSTRUMENTATION_END_MARKERS):
+                    break
+                if self.__done.is_set():
+                    return
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('Instrument output closed: {}'.format(e))
+        self.__exited.set()
+        self.__wakeup.set()
+
+    def __wait(self):
+        due = time.time() + self.timeout
+        delay = PING_BACKOFF[0]
+        while True:
+            exited = self.__exited.is_set()
+            if self.ping() == "pong":
+                self.__done.set()
+                return
+            if exited or time.time() >= due:
+                break
+            woken = self.__wakeup.wait(min(delay, max(due - time.time(), 0)))
+            self.__wakeup.clear()
+            delay = PING_BACKOFF[0] if woken else min(delay * 2, PING_BACKOFF[1])
+        logging.debug('Instrument output=[{}]'.format(''.join(self.output)))
+        try:
+            self.process.kill()
+        except (OSError, AttributeError):
+            pass
+        if exited:
+            self.__error = InstrumentationError("RPC server not started! (instrumentation ended)")
+        else:
+            self.__error = IOError("RPC server not started!")
+        self.__done.set()
+
+    def done(self):
+        return self.__done.is_set()
+
+    def close(self, timeout=None):
+        '''
+        wait up to timeout for the reader to stop, the start being resolved.
+        return True once it stopped, so the pipe may be read elsewhere.
+        '''
+        if not self.__done.wait(timeout):
+            return False
+        self.__reader.join(timeout)
+        return not self.__reader.is_alive()
+
+    def wait(self, timeout=None):
+        '''wait until resolved. return True if resolved.'''
+        return self.__done.wait(timeout)
+
+    def exception(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise IOError("RPC server not started in %s seconds." % timeout)
+        return self.__error
+
+    def result(self, timeout=None):
+        '''wait for the server. raise IOError if it did not start.'''
+        if self.exception(timeout) is not None:
+            raise self.__error
 
 
 class AutomatorServer(object):
@@ -383,36 +1521,136 @@ class AutomatorServer(object):
     def __init__(self,
             serial=None, local_port=None, device_port=None,
             adb_server_host=None, adb_server_port=None,
-            auto_restart=True):
+            auto_restart=True, adb_backend=None):
         self.uiautomator_process = None
+        self.__readiness = None
         self.session = None
-        self.adb = Adb(serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
+        self.__install_cache = None
+        self.adb = adb_class(adb_backend)(
+            serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
         self.device_port = int(device_port) if device_port else DEVICE_PORT
+        self.__port_key, self.__port_released = None, False
         if local_port:
             self.local_port = local_port
         else:
+            try:  # the serial adb resolves from ANDROID_SERIAL or the only attached device
+                device_serial = self.adb.device_serial()
+            except EnvironmentError:
+                device_serial = serial
+            self.local_port = None
             try:  # first we will try to use the local port already adb forwarded
                 for s, lp, rp in self.adb.forward_list():
-                    if s == self.adb.device_serial() and rp == 'tcp:%d' % self.device_port:
+                    if s == device_serial and rp == 'tcp:%d' % self.device_port:
                         self.local_port = int(lp[4:])
                         break
-                else:
-                    self.local_port = next_local_port(adb_server_host)
             except:
-                self.local_port = next_local_port(adb_server_host)
+                pass
+            if self.local_port is None:
+                self.__port_key = (adb_server_host, device_serial, self.device_port)
+                self.local_port = next_local_port(*self.__port_key)
         self.auto_restart = auto_restart
-
-    def jsonrpc(self, timeout=None):
+        self.batch_supported = True
+        self.long_poll_supported = True
+        self.apk_stager = ApkStager()
+        self.selector_registry = SelectorRegistry()
+        self.recovery_policy = RecoveryPolicy()
+        self.__clients = JsonRPCClientCache(lambda timeout: JsonRPCClient(self.__wrap(self.__call(timeout))))
+        self.__clients_adb = None
+
+    def __call(self, timeout):
         to = timeout or JSONRPC_TIMEOUT
+        registry = self.selector_registry
         def call(method, *args, **kwargs):
+            if self.session is None:
+                self.session = requests.Session()
+            sent = registry.substitute(args)
+            if sent is not args:
+                try:
+                    return jsonrpc_call(self.rpc_uri, to, {'method': method, 'args': sent}, self.session)
+                except JsonRPCError as e:
+                    if e.code != ERROR_CODE_UNKNOWN_HANDLE:
+                        raise
+                    logging.debug('Selector handles lost, registering them again: {}'.format(e))
+                self.reregister_selectors()
+                args = registry.substitute(args)
             call_desc = {
                 'method': method, 'args': args or kwargs}
+            return jsonrpc_call(self.rpc_uri, to, call_desc, self.session)
+        return call
+
+    def __register(self, call, selector):
+        registry = self.selector_registry
+        handle = registry.lookup(selector)
+        if handle is not None or not registry.supported:
+            return handle
+        try:
+            handle = call('registerSelector', selector)
+        except JsonRPCError as e:
+            if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                raise
+            logging.debug('Selector registry not supported: {}'.format(e))
+            registry.supported = False
+            return None
+        for evicted in registry.add(selector, handle):
+            try:
+                call('unregisterSelector', evicted)
+            except JsonRPCError as e:
+                logging.debug('Selector handle {} not unregistered: {}'.format(evicted, e))
+        return handle
+
+    def register_selector(self, selector):
+        '''
+        register the selector with the server, calls sending an equal
+        FrozenSelector carry its handle from then on.
+        return the handle, None if the server has no selector registry.
+        '''
+        return self.__register(self.__call(None), selector.freeze())
+
+    def unregister_selector(self, selector):
+        handle = self.selector_registry.remove(selector.freeze())
+        if handle is not None:
+            self.__call(None)('unregisterSelector', handle)
+
+    def reregister_selectors(self):
+        '''register the selectors of selector_registry again, after the server lost them.'''
+        call = self.__call(None)
+        for selector in self.selector_registry.reset():
+            try:
+                self.__register(call, selector)
+            except (JsonRPCError, requests.exceptions.RequestException) as e:
+                logging.debug('Selector not registered again: {}'.format(e))
+
+    def __wrap(self, call):
+        return add_recovery(
+            add_fnf_handling(call, self.handlers), lambda level: self.recover(level), self.recovery_policy)
+
+    def jsonrpc(self, timeout=None):
+        '''JsonRPCClient with not found handling and recovery, see JsonRPCClientCache.'''
+        if self.__clients_adb is not self.adb:  # handlers are looked up by serial
+            self.__clients.clear()
+            self.__clients_adb = self.adb
+        return self.__clients.get(timeout)
+
+    def jsonrpc_batch(self, timeout=None):
+        '''JsonRPCBatch which sends its calls in one request if the server accepts it.'''
+        to = timeout or JSONRPC_TIMEOUT
+        def send_batch(calls):
+            if not self.batch_supported:
+                return None
+            call_descs = [
+                {'method': method, 'args': args or kwargs} for method, args, kwargs in calls]
             if self.session is None:
                 self.session = requests.Session()
-            return jsonrpc_call(self.rpc_uri, to, call_desc, self.session)
-        wrapped_call = add_recovery(
-            add_fnf_handling(call, self.handlers), self.restart)
-        return JsonRPCClient(wrapped_call)
+            try:
+                results = jsonrpc_batch_call(self.rpc_uri, to, call_descs, self.session)
+            except requests.exceptions.RequestException as e:
+                logging.debug('RequestException during JSONRPC batch call: {}'.format(e))
+                return None
+            if results is None:
+                logging.debug('JSONRPC batch rejected, falling back to single calls.')
+                self.batch_supported = False
+            return results
+        return JsonRPCBatch(send_batch, self.__call(timeout), self.__wrap)
 
     def sdk_version(self):
         '''sdk version of connected device.'''
@@ -423,16 +1661,49 @@ class AutomatorServer(object):
                 pass
         return self.__sdk
 
-    def install(self):
-        base_dir = os.path.dirname(__file__)
-        for apk in self.__apk_files:
-            dirpath = os.path.join(base_dir, self.__apk_dir)
-            apkpath = os.path.join(dirpath, apk)
-            self.adb.cmd("install", "-r", "-t", apkpath).communicate()
+    @property
+    def install_cache(self):
+        if self.__install_cache is None or self.__install_cache.adb is not self.adb:
+            dirpath = os.path.join(os.path.dirname(__file__), self.__apk_dir)
+            self.__install_cache = InstallCache(
+                self.adb, [os.path.join(dirpath, apk) for apk in self.__apk_files])
+        return self.__install_cache
+
+    def install(self, force=False, confirm=False):
+        '''
+        install the apks unless the device already has the same build,
+        see InstallCache.installed for confirm.
+        False if the install was skipped, True otherwise.
+        '''
+        cache = self.install_cache
+        if not force and cache.installed(confirm):
+            logging.debug('Apks already installed, skip install.')
+            return False
+        success = True
+        for apkpath in cache.apk_paths:
+            out = self.adb.cmd("install", "-r", "-t", apkpath).communicate()[0]
+            success = success and isinstance(out, bytes) and b'Success' in out
+        if success:
+            cache.update()
+        else:
+            cache.invalidate()
+        return True
 
     def set_forwarding(self):
+        if self.__port_released:  # stopped, claim the port again
+            self.__port_released = False
+            self.local_port = next_local_port(*self.__port_key)
         self.adb.forward(self.local_port, self.device_port)
 
+    def release_port(self):
+        '''unregister this process from the port registry entry of the local port.'''
+        if self.__port_key is not None and not self.__port_released:
+            self.__port_released = True
+            try:
+                port_registry.release(*self.__port_key)
+            except (IOError, OSError) as e:
+                logging.debug('Port registry not available: {}'.format(e))
+
     def start_instrumentation(self):
         cmd = ['shell', 'am', 'instrument']
         instrument_opts = ['-r', '-w', '-e', 'port', str(DEVICE_PORT)]
@@ -451,58 +1722,99 @@ class AutomatorServer(object):
             if signal_server:
                 try:
                     jsonrpc_call(self.rpc_uri, timeout=5, call_desc={'method': 'stopServer'})
+                    if not self.__close_readiness():
+                        raise IOError("Instrument output still read.")
                     self.uiautomator_process.communicate(timeout=STOP_TIMEOUT)
                 except:
                     self.uiautomator_process.kill()
             else:
                 self.uiautomator_process.kill()
             self.uiautomator_process = None
+        self.__close_readiness()
         self.force_stop(MAINPACKAGE)
         self.force_stop(TESTPACKAGE)
 
-    def wait_device(self, timeout):
-        due = time.time() + timeout
-        while not self.alive and time.time() < due:
-            time.sleep(0.1)
-        if not self.alive:
-            self.uiautomator_process.kill()
-            try:
-                out, err = self.uiautomator_process.communicate(timeout=10)
-                logging.debug('Instrument stdout/stderr=[{}/{}]'.format(out, err))
-                raise IOError("RPC server not started!")
-            except subprocess.TimeoutExpired:
-                self.uiautomator_process.kill()
-                raise IOError("RPC server not started! (communicate)")
+    def __close_readiness(self):
+        '''stop the output reader of the last readiness. return True once it stopped.'''
+        if self.__readiness is not None:
+            if not self.__readiness.close(STOP_TIMEOUT):
+                return False
+            self.__readiness = None
+        return True
 
+    def readiness(self, timeout):
+        '''ServerReadiness of the running instrumentation.'''
+        self.__readiness = ServerReadiness(
+            self.uiautomator_process, lambda: self.ping(timeout=PING_TIMEOUT), timeout)
+        return self.__readiness
 
-    def start(self, timeout=JSONRPC_TIMEOUT):
-        self.install()
+    def wait_device(self, timeout):
+        self.readiness(timeout).result()
+
+    def start(self, timeout=JSONRPC_TIMEOUT, wait=True):
+        '''
+        Install, forward and start the rpc server.
+        With wait=False return the ServerReadiness instead of waiting,
+        so other setup can run while the server starts.
+        A skipped install trusts the install record, so when the server
+        does not come up the apks are installed again and it is started
+        once more. With wait=False there is no second chance, and the
+        record is confirmed against the device before it is trusted.
+        '''
+        installed = self.install(confirm=not wait)
         self.set_forwarding()
         self.start_instrumentation()
-        self.wait_device(timeout)
+        if not wait:
+            return self.readiness(timeout)
+        try:
+            self.wait_device(timeout)
+        except IOError:
+            if installed:
+                raise
+            logging.debug('RPC server not started, reinstall the apks.')
+            self.install_cache.invalidate()
+            self.stop_instrumentation()
+            self.install(force=True)
+            self.start_instrumentation()
+            self.wait_device(timeout)
+
+    def recover(self, level):
+        '''recovery action of RecoveryPolicy level forward, restart or reinstall.'''
+        if level == 'forward':
+            self.set_forwarding()
+        else:
+            self.restart(reinstall=level == 'reinstall')
 
-    def restart(self):
+    def restart(self, reinstall=None):
+        '''
+        Restart the instrumentation. The apks are reinstalled when it does
+        not come up (reinstall=None), always (True) or never (False).
+        '''
         self.set_forwarding()
         if not self.auto_restart:
             return
 
-        self.stop_instrumentation()
-        self.start_instrumentation()
+        if not reinstall:
+            self.stop_instrumentation()
+            self.start_instrumentation()
 
-        try:
-            self.wait_device(timeout=RESTART_TIMEOUT_AFTER_INSTRUMENT_RESET)
-            return
-        except IOError:
-            pass
+            try:
+                self.wait_device(timeout=RESTART_TIMEOUT_AFTER_INSTRUMENT_RESET)
+                self.reregister_selectors()
+                return
+            except IOError:
+                if reinstall is False:
+                    raise
 
         self.stop_instrumentation()
-        self.install()
+        self.install(force=True)
         self.start_instrumentation()
         self.wait_device(timeout=RESTART_TIMEOUT_AFTER_REINSTALL)
+        self.reregister_selectors()
 
-    def ping(self):
+    def ping(self, timeout=JSONRPC_TIMEOUT):
         try:
-            return jsonrpc_call(url=self.rpc_uri, timeout=JSONRPC_TIMEOUT,
+            return jsonrpc_call(url=self.rpc_uri, timeout=timeout,
                 call_desc={'method': 'ping'})
         except:
             return None
@@ -515,6 +1827,7 @@ class AutomatorServer(object):
     def stop(self):
         '''Stop the rpc server.'''
         self.stop_instrumentation(signal_server=True)
+        self.release_port()
 
     @property
     def rpc_uri(self):
@@ -524,10 +1837,292 @@ class AutomatorServer(object):
     def screenshot_uri(self):
         return "http://%s:%d/screenshot.png" % (self.adb.adb_server_host, self.local_port)
 
-    def screenshot(self, scale=1.0, quality=100):
-        result = requests.get(
-            '{}?scale={}&quality={}'.format(self.screenshot_uri, scale, quality))
-        return result.content
+    def screenshot(self, scale=1.0, quality=100, out=None, timeout=None):
+        '''
+        image from the screenshot endpoint, fetched over the keep-alive session.
+        With out, the body is streamed to out.write in chunks and the number
+        of bytes written is returned, the content otherwise.
+        None if the endpoint did not answer with an image, or if the body
+        broke off, in which case out may hold a part of it.
+        '''
+        if self.session is None:
+            self.session = requests.Session()
+        try:
+            response = self.session.get(
+                self.screenshot_uri, params={'scale': scale, 'quality': quality},
+                timeout=timeout or JSONRPC_TIMEOUT, stream=True)
+            with contextlib.closing(response):
+                if response.status_code != 200:
+                    return None
+                if out is None:
+                    return response.content or None
+                size = 0
+                for chunk in response.iter_content(SCREENSHOT_CHUNK_SIZE):
+                    out.write(chunk)
+                    size += len(chunk)
+                return size or None
+        except requests.exceptions.RequestException as e:
+            logging.debug('Screenshot request failed: {}'.format(e))
+            return None
+
+
+class CaptureOutput(object):
+
+    '''
+    out of a capture, rewound to where it started when an attempt fails
+    midway, so a fallback does not write after a partial image. Outputs
+    which cannot seek are written through an io.BytesIO and receive only
+    the image of the attempt which succeeded.
+    '''
+
+    def __init__(self, out):
+        self.out = out
+        try:
+            seekable = out.seekable()
+        except (AttributeError, IOError, ValueError):
+            seekable = False
+        self.buffer = out if seekable else io.BytesIO()
+        self.start = self.buffer.tell()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def rewind(self):
+        '''drop what a failed attempt wrote.'''
+        self.buffer.seek(self.start)
+        self.buffer.truncate()
+
+    def commit(self):
+        if self.buffer is not self.out:
+            self.out.write(self.buffer.getvalue())
+
+
+class Capture(object):
+
+    '''
+    outcome of a screenshot capture: the source which gave the image
+    ("http" or "screencap", None if both failed), its size in bytes and
+    the (source, seconds) spent on each attempt.
+    '''
+
+    __slots__ = ('source', 'size', 'timings')
+
+    def __init__(self, source, size, timings):
+        self.source = source
+        self.size = size
+        self.timings = timings
+
+    @property
+    def ok(self):
+        return self.source is not None
+
+    @property
+    def seconds(self):
+        return sum(seconds for _, seconds in self.timings)
+
+    def __repr__(self):
+        return 'Capture(%r, size=%r, seconds=%.3f)' % (self.source, self.size, self.seconds)
+
+
+def capture_done(source, size, timings):
+    '''Capture of the attempts, recorded in the metrics as well.'''
+    capture = Capture(source, size or 0, timings)
+    if collector.enabled:
+        collector.observe('screenshot', source or 'failed', capture.seconds, bytes_in=capture.size, error=not capture.ok)
+    return capture
+
+
+class Frame(object):
+
+    '''screenshot of a CaptureStream: its number, the time it was taken at and the image bytes.'''
+
+    __slots__ = ('index', 'time', 'data', 'seconds')
+
+    def __init__(self, index, time, data, seconds):
+        self.index = index
+        self.time = time
+        self.data = data
+        self.seconds = seconds  # spent capturing it
+
+    @property
+    def extension(self):
+        return '.png' if self.data[:8] == b'\x89PNG\r\n\x1a\n' else '.jpg'
+
+    def __repr__(self):
+        return 'Frame(%d, time=%.3f, size=%d)' % (self.index, self.time, len(self.data))
+
+
+class CaptureStream(object):
+
+    '''
+    Screenshots taken by a background thread at up to fps per second and
+    kept with their time in a ring buffer of the last size frames; the
+    oldest frame is dropped when it is full. Slots missed by a slow capture
+    are skipped, so frames stay on the fps grid.
+    Usage:
+    with d.capture_stream(fps=10, scale=0.5, quality=50, failure_dir="out") as stream:
+        ...  # the last failure_seconds of frames are saved to out if this raises
+    for frame in stream.frames(): ...
+    '''
+
+    def __init__(self, capture, fps, size=CAPTURE_BUFFER_FRAMES, failure_dir=None, failure_seconds=5):
+        self.__capture = capture  # capture(out) -> Capture
+        self.interval = 1.0 / fps
+        self.buffer = collections.deque(maxlen=size)
+        self.failure_dir = failure_dir
+        self.failure_seconds = failure_seconds
+        self.captured = self.dropped = self.errors = 0
+        self.__changed = threading.Condition()
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self.__stopped.clear()
+            self.__thread = threading.Thread(target=self.__run, name='capture-stream')
+            self.__thread.daemon = True
+            self.__thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        with self.__changed:
+            self.__changed.notify_all()
+
+    def __run(self):
+        due = time.time()
+        while not self.__stopped.is_set():
+            begin = time.time()
+            out = io.BytesIO()
+            try:
+                capture = self.__capture(out)
+            except Exception as e:
+                logging.debug('Capture failed: {}'.format(e))
+                capture = None
+            with self.__changed:
+                if capture is not None and capture.ok:
+                    if len(self.buffer) == self.buffer.maxlen:
+                        self.dropped += 1
+                    self.buffer.append(Frame(self.captured, begin, out.getvalue(), capture.seconds))
+                    self.captured += 1
+                else:
+                    self.errors += 1
+                self.__changed.notify_all()
+            now = time.time()
+            due += self.interval
+            if due < now:  # skip the slots missed meanwhile
+                due += (now - due) // self.interval * self.interval + self.interval
+            self.__stopped.wait(due - now)
+
+    def frames(self, timeout=None):
+        '''
+        generator of the buffered frames and then of new ones as they come,
+        until the stream stops or no frame comes for timeout seconds.
+        Frames dropped before they are read are skipped.
+        '''
+        index = 0
+        while True:
+            due = time.time() + timeout if timeout is not None else None
+            with self.__changed:
+                pending = [frame for frame in self.buffer if frame.index >= index]
+                while not pending and self.running:
+                    left = due - time.time() if due is not None else None
+                    if left is not None and left <= 0:
+                        break
+                    self.__changed.wait(left)
+                    pending = [frame for frame in self.buffer if frame.index >= index]
+            if not pending:
+                return
+            for frame in pending:
+                yield frame
+            index = pending[-1].index + 1
+
+    def last(self, seconds):
+        '''buffered frames taken in the last seconds.'''
+        since = time.time() - seconds
+        with self.__changed:
+            return [frame for frame in self.buffer if frame.time >= since]
+
+    def save(self, directory, seconds=None):
+        '''write the buffered frames, or those of the last seconds, to directory. return the file names.'''
+        frames = self.last(seconds if seconds is not None else float('inf'))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = []
+        for frame in frames:
+            name = os.path.join(directory, 'frame-%06d-%d%s' % (
+                frame.index, int(frame.time * 1000), frame.extension))
+            with open(name, 'wb') as f:
+                f.write(frame.data)
+            names.append(name)
+        return names
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        if exc_type is not None and self.failure_dir:
+            self.save(self.failure_dir, self.failure_seconds)
+
+
+class DeviceInfo(dict):
+
+    '''deviceInfo result. refresh() reads it from the device again.'''
+
+    def __init__(self, cache, info):
+        super(DeviceInfo, self).__init__(info)
+        self.__cache = cache
+
+    def refresh(self):
+        info = self.__cache.fetch()
+        self.clear()
+        self.update(info)
+        return self
+
+
+class DeviceInfoCache(object):
+
+    '''
+    deviceInfo kept for ttl seconds, dropped by the actions which change it
+    (rotation, screen on/off, key presses). STATIC_INFO_FIELDS are kept for
+    the session and VOLATILE_INFO_FIELDS are always read from the device.
+    ttl=0 disables caching.
+    '''
+
+    def __init__(self, fetch, ttl=INFO_TTL):
+        self.__fetch = fetch
+        self.ttl = ttl
+        self.static = {}
+        self.__info = None
+        self.__time = 0
+
+    def fetch(self):
+        info = self.__fetch()
+        if self.ttl:
+            self.__info, self.__time = info, time.time()
+            self.static = dict((k, info[k]) for k in STATIC_INFO_FIELDS if k in info)
+        return info
+
+    def get(self, field=None):
+        '''the info, from the cache if it is fresh enough to answer field.'''
+        if not self.ttl or field in VOLATILE_INFO_FIELDS:
+            return self.fetch()
+        if field in self.static:
+            return self.static
+        if self.__info is None or time.time() - self.__time >= self.ttl:
+            return self.fetch()
+        return self.__info
+
+    def invalidate(self):
+        '''drop the cached info but the static fields.'''
+        self.__info = None
 
 
 class AutomatorDevice(object):
@@ -549,7 +2144,9 @@ class AutomatorDevice(object):
             serial=None, local_port=None, device_port=None,
             adb_server_host=None, adb_server_port=None,
             auto_restart_server=True,
-            jsonrpc_timeout=None, server=None):
+            jsonrpc_timeout=None, server=None, adb_backend=None, info_ttl=None):
+        self.info_cache = DeviceInfoCache(
+            lambda: self.jsonrpc().deviceInfo(), INFO_TTL if info_ttl is None else info_ttl)
         if server is not None:
             self.server = server
         else:
@@ -559,7 +2156,8 @@ class AutomatorDevice(object):
                 device_port=device_port,
                 adb_server_host=adb_server_host,
                 adb_server_port=adb_server_port,
-                auto_restart=auto_restart_server
+                auto_restart=auto_restart_server,
+                adb_backend=adb_backend
             )
         self.jsonrpc_timeout = jsonrpc_timeout
 
@@ -567,15 +2165,63 @@ class AutomatorDevice(object):
         timeout = timeout or self.jsonrpc_timeout
         return self.server.jsonrpc(timeout=timeout)
 
+    def batch(self, timeout=None):
+        '''
+        Send the JSON-RPC calls made in the block as one batch request.
+        Usage:
+        with d.batch() as b:
+            info = b.deviceInfo()
+            clicked = b.click(Selector(text="OK"))
+        info.result()  # raises JsonRPCError if the call failed
+        '''
+        timeout = timeout or self.jsonrpc_timeout
+        return self.server.jsonrpc_batch(timeout=timeout)
+
+    def register(self, selector=None, **kwargs):
+        '''
+        Register a selector with the server: a Selector, a ui object or the
+        kwargs of d(). Later calls sending it (exists, click, info, wait ...)
+        carry a short handle instead of the whole selector. Handles are
+        registered again after the server restarts.
+        return the handle, None if the server has no selector registry.
+        Usage:
+        d.register(text="OK")
+        d(text="OK").click()  # sends the handle
+        '''
+        return self.server.register_selector(self.__selector_of(selector, kwargs))
+
+    def unregister(self, selector=None, **kwargs):
+        '''drop a selector given to register.'''
+        return self.server.unregister_selector(self.__selector_of(selector, kwargs))
+
+    @staticmethod
+    def __selector_of(selector, kwargs):
+        if selector is None:
+            return FrozenSelector(**kwargs)
+        return getattr(selector, 'selector', selector)
+
+    def metrics(self):
+        '''
+        Call counts, bytes and latency percentiles per rpc method and adb
+        command, and time spent in recovery and not found handlers.
+        The figures are process wide and collected only while the collector is
+        enabled: UIAUTOMATOR_METRICS=1 or uiautomatorminus.metrics.collector.enable().
+        '''
+        return collector.snapshot()
+
     def timeout(self, timeout):
-        return AutomatorDevice(server=self.server, jsonrpc_timeout=timeout)
+        device = AutomatorDevice(server=self.server, jsonrpc_timeout=timeout)
+        device.info_cache = self.info_cache
+        return device
 
     def __call__(self, **kwargs):
-        return AutomatorDeviceObject(self, Selector(**kwargs))
+        return AutomatorDeviceObject(self, FrozenSelector(**kwargs))
 
     def __getattr__(self, attr):
         '''alias of fields in info property.'''
-        info = self.info
+        if attr == 'info_cache':  # not set yet
+            raise AttributeError(attr)
+        info = self.info_cache.get(self.__alias.get(attr, attr))
         if attr in info:
             return info[attr]
         elif attr in self.__alias:
@@ -585,8 +2231,11 @@ class AutomatorDevice(object):
 
     @property
     def info(self):
-        '''Get the device info.'''
-        return self.jsonrpc().deviceInfo()
+        '''
+        Get the device info, cached for info_ttl seconds if enabled.
+        d.info.refresh() reads it from the device again.
+        '''
+        return DeviceInfo(self.info_cache, self.info_cache.get())
 
     def click(self, x, y):
         '''click at arbitrary coordinates.'''
@@ -613,31 +2262,104 @@ class AutomatorDevice(object):
     def dump(self, filename=None, compressed=True, pretty=True):
         '''dump device window and pull to local file.'''
         content = self.jsonrpc().dumpWindowHierarchy(compressed, None)
+        raw = content.encode("utf-8")
         if filename:
             with open(filename, "wb") as f:
-                f.write(content.encode("utf-8"))
+                f.write(raw)
         if pretty and "\n " not in content:
-            xml_text = xml.dom.minidom.parseString(content.encode("utf-8"))
-            content = U(xml_text.toprettyxml(indent='  '))
+            content = U(pretty_xml(raw))
         return content
 
+    def dump_nodes(self, filename=None, compressed=True):
+        '''
+        dump device window, to the local file if given, and return a
+        generator of its hierarchy Node in document order.
+        Usage:
+        for node in d.dump_nodes():
+            print(node.get("text"))
+        '''
+        raw = self.jsonrpc().dumpWindowHierarchy(compressed, None).encode("utf-8")
+        if filename:
+            with open(filename, "wb") as f:
+                f.write(raw)
+        return iter_nodes(raw)
+
+    def snapshot(self, compressed=False, compact=False):
+        '''
+        Dump the window hierarchy once and evaluate selectors on it locally.
+        compact keeps it as a CompactHierarchy, for snapshots held in numbers.
+        Usage:
+        snap = d.snapshot()
+        snap(text="OK").exists  # no RPC
+        snap(className="android.widget.TextView").count  # no RPC
+        snap(text="OK").click()  # sent to the device
+        '''
+        content = self.jsonrpc().dumpWindowHierarchy(compressed, None)
+        hierarchy = (CompactHierarchy if compact else Hierarchy).parse(content)
+        return Snapshot(self, hierarchy, compressed)
+
+    def at(self, x, y):
+        '''the top most object containing the point (x, y), from a new snapshot.'''
+        return self.snapshot().at(x, y)
+
     def screenshot(self, filename, scale=1.0, quality=100):
-        '''take screenshot.'''
-        result = self.server.screenshot(filename, scale, quality)
-        if result:
-            return result
-
-        device_file = self.jsonrpc().takeScreenshot("screenshot.png",
-                                                         scale, quality)
-        if not device_file:
-            return None
-        p = self.server.adb.cmd("pull", device_file, filename)
-        p.wait()
-        self.server.adb.cmd("shell", "rm", device_file).wait()
-        return filename if p.returncode is 0 else None
+        '''take screenshot to filename. return filename, or None if it failed.'''
+        with open(filename, "wb") as f:
+            capture = self.capture(f, scale, quality)
+        if capture.ok:
+            return filename
+        os.remove(filename)
+        return None
+
+    def capture(self, out, scale=1.0, quality=100):
+        '''
+        Write a screenshot to out, an object with write such as an open file
+        or io.BytesIO, and return its Capture with the timings.
+        The screenshot endpoint is streamed over the server session; if it
+        fails, adb exec-out screencap -p (png at full size) is streamed instead.
+        '''
+        out, timings = CaptureOutput(out), []
+        begin = time.time()
+        size = self.server.screenshot(scale, quality, out=out)
+        timings.append(('http', time.time() - begin))
+        if size:
+            out.commit()
+            return capture_done('http', size, timings)
+        out.rewind()
+        begin = time.time()
+        size = self.__screencap(out)
+        timings.append(('screencap', time.time() - begin))
+        if size:
+            out.commit()
+        else:
+            out.rewind()
+        return capture_done('screencap' if size else None, size, timings)
+
+    def capture_stream(self, fps=5, scale=1.0, quality=100, size=CAPTURE_BUFFER_FRAMES,
+                       failure_dir=None, failure_seconds=5):
+        '''
+        CaptureStream taking screenshots in the background, started.
+        Usage:
+        with d.capture_stream(fps=10, scale=0.5, quality=50) as stream:
+            d(text="Settings").click()
+        stream.save("frames")
+        '''
+        stream = CaptureStream(lambda out: self.capture(out, scale, quality), fps, size,
+                               failure_dir, failure_seconds)
+        return stream.start()
+
+    def __screencap(self, out):
+        '''stream the output of screencap to out. return the bytes written, 0 if it failed.'''
+        process = self.server.adb.cmd("exec-out", "screencap", "-p")
+        size = 0
+        for chunk in iter(lambda: process.stdout.read(SCREENSHOT_CHUNK_SIZE), b''):
+            out.write(chunk)
+            size += len(chunk)
+        return size if process.wait() == 0 else 0
 
     def freeze_rotation(self, freeze=True):
         '''freeze or unfreeze the device rotation in current status.'''
+        self.info_cache.invalidate()
         self.jsonrpc().freezeRotation(freeze)
 
     @property
@@ -657,6 +2379,7 @@ class AutomatorDevice(object):
         for values in self.__orientation:
             if value in values:
                 # can not set upside-down until api level 18.
+                self.info_cache.invalidate()
                 self.jsonrpc().setOrientation(values[1])
                 break
         else:
@@ -671,105 +2394,37 @@ class AutomatorDevice(object):
         '''clear the last traversed text.'''
         self.jsonrpc().clearLastTraversedText()
 
-    @property
-    def open(self):
+    @fluent_method(action=["notification", "quick_settings"])
+    def open(self, action):
         '''
         Open notification or quick settings.
         Usage:
         d.open.notification()
         d.open.quick_settings()
         '''
-        @param_to_property(action=["notification", "quick_settings"])
-        def _open(action):
-            if action == "notification":
-                return self.jsonrpc().openNotification()
-            else:
-                return self.jsonrpc().openQuickSettings()
-        return _open
+        self.info_cache.invalidate()
+        if action == "notification":
+            return self.jsonrpc().openNotification()
+        else:
+            return self.jsonrpc().openQuickSettings()
 
     @property
     def handlers(self):
-        obj = self
-
-        class Handlers(object):
-
-            def on(self, fn):
-                if fn not in obj.server.handlers['handlers']:
-                    obj.server.handlers['handlers'].append(fn)
-                obj.server.handlers['device'] = obj
-                return fn
-
-            def off(self, fn):
-                if fn in obj.server.handlers['handlers']:
-                    obj.server.handlers['handlers'].remove(fn)
-
-        return Handlers()
+        return AutomatorHandlers(self)
 
     @property
     def watchers(self):
-        obj = self
-
-        class Watchers(list):
-
-            def __init__(self):
-                for watcher in obj.jsonrpc().getWatchers():
-                    self.append(watcher)
-
-            @property
-            def triggered(self):
-                return obj.jsonrpc().hasAnyWatcherTriggered()
-
-            def remove(self, name=None):
-                if name:
-                    obj.jsonrpc().removeWatcher(name)
-                else:
-                    for name in self:
-                        obj.jsonrpc().removeWatcher(name)
-
-            def reset(self):
-                obj.jsonrpc().resetWatcherTriggers()
-                return self
-
-            def run(self):
-                obj.jsonrpc().runWatchers()
-                return self
-        return Watchers()
+        return AutomatorWatchers(self, self.jsonrpc().getWatchers())
 
     def watcher(self, name):
-        obj = self
-
-        class Watcher(object):
-
-            def __init__(self):
-                self.__selectors = []
-
-            @property
-            def triggered(self):
-                return obj.jsonrpc().hasWatcherTriggered(name)
-
-            def remove(self):
-                obj.jsonrpc().removeWatcher(name)
-
-            def when(self, **kwargs):
-                self.__selectors.append(Selector(**kwargs))
-                return self
-
-            def click(self, **kwargs):
-                obj.jsonrpc().registerClickUiObjectWatcher(name, self.__selectors, Selector(**kwargs))
+        return AutomatorWatcher(self, name)
 
-            @property
-            def press(self):
-                @param_to_property(
-                    "home", "back", "left", "right", "up", "down", "center",
-                    "search", "enter", "delete", "del", "recent", "volume_up",
-                    "menu", "volume_down", "volume_mute", "camera", "power")
-                def _press(*args):
-                    obj.jsonrpc().registerPressKeyskWatcher(name, self.__selectors, args)
-                return _press
-        return Watcher()
-
-    @property
-    def press(self):
+    @fluent_method(
+        key=["home", "back", "left", "right", "up", "down", "center",
+             "menu", "search", "enter", "delete", "del", "recent",
+             "volume_up", "volume_down", "volume_mute", "camera", "power"]
+    )
+    def press(self, key, meta=None):
         '''
         press key via name or key code. Supported key name includes:
         home, back, left, right, up, down, center, menu, search, enter,
@@ -780,24 +2435,20 @@ class AutomatorDevice(object):
         d.press.menu()  # press home key
         d.press(89)     # press keycode
         '''
-        @param_to_property(
-            key=["home", "back", "left", "right", "up", "down", "center",
-                 "menu", "search", "enter", "delete", "del", "recent",
-                 "volume_up", "volume_down", "volume_mute", "camera", "power"]
-        )
-        def _press(key, meta=None):
-            if isinstance(key, int):
-                return self.jsonrpc().pressKeyCode(key, meta) if meta else self.jsonrpc().pressKeyCode(key)
-            else:
-                return self.jsonrpc().pressKey(str(key))
-        return _press
+        self.info_cache.invalidate()
+        if isinstance(key, int):
+            return self.jsonrpc().pressKeyCode(key, meta) if meta else self.jsonrpc().pressKeyCode(key)
+        else:
+            return self.jsonrpc().pressKey(str(key))
 
     def wakeup(self):
         '''turn on screen in case of screen off.'''
+        self.info_cache.invalidate()
         self.jsonrpc().wakeUp()
 
     def sleep(self):
         '''turn off screen in case of screen on.'''
+        self.info_cache.invalidate()
         self.jsonrpc().sleep()
 
     @property
@@ -811,91 +2462,558 @@ class AutomatorDevice(object):
         d.screen == 'on'  # Check if the screen is on, same as 'd.screenOn'
         d.screen == 'off'  # Check if the screen is off, same as 'not d.screenOn'
         '''
-        devive_self = self
-
-        class _Screen(object):
-            def on(self):
-                return devive_self.wakeup()
-
-            def off(self):
-                return devive_self.sleep()
+        return AutomatorScreen(self)
 
-            def __call__(self, action):
-                if action == "on":
-                    return self.on()
-                elif action == "off":
-                    return self.off()
-                else:
-                    raise AttributeError("Invalid parameter: %s" % action)
-
-            def __eq__(self, value):
-                info = devive_self.info
-                if "screenOn" not in info:
-                    raise EnvironmentError("Not supported on Android 4.3 and belows.")
-                if value in ["on", "On", "ON"]:
-                    return info["screenOn"]
-                elif value in ["off", "Off", "OFF"]:
-                    return not info["screenOn"]
-                raise ValueError("Invalid parameter. It can only be compared with on/off.")
-
-            def __ne__(self, value):
-                return not self.__eq__(value)
-
-        return _Screen()
-
-    @property
-    def wait(self):
+    @fluent_method(action=["idle", "update", "stable"])
+    def wait(self, action, timeout=None, package_name=None, window_ms=STABLE_WINDOW, matches=STABLE_MATCHES,
+             ignore=()):
         '''
-        Waits for the current application to idle or window update event occurs.
+        Waits for the current application to idle or window update event occurs,
+        or until consecutive window dumps stop changing.
         Usage:
         d.wait.idle(timeout=1000)
         d.wait.update(timeout=1000, package_name="com.android.settings")
+        d.wait.stable(window_ms=500, timeout=10000)  # matches dumps equal over window_ms
+        d.wait.stable(ignore=["focused"])  # attributes not compared
         '''
-        @param_to_property(action=["idle", "update"])
-        def _wait(action, timeout=1000, package_name=None):
-            http_timeout = timeout / 1000 + JSONRPC_TIMEOUT
-            if action == "idle":
-                return self.jsonrpc(timeout=http_timeout).waitForIdle(timeout)
-            elif action == "update":
-                return self.jsonrpc(timeout=http_timeout).waitForWindowUpdate(package_name, timeout)
-        return _wait
+        if action == "stable":
+            return self.__wait_stable(window_ms, 10000 if timeout is None else timeout, matches, ignore)
+        if timeout is None:
+            timeout = 1000
+        http_timeout = timeout / 1000 + JSONRPC_TIMEOUT
+        if action == "idle":
+            return self.jsonrpc(timeout=http_timeout).waitForIdle(timeout)
+        elif action == "update":
+            return self.jsonrpc(timeout=http_timeout).waitForWindowUpdate(package_name, timeout)
+
+    def __wait_stable(self, window_ms, timeout, matches, ignore):
+        tracker = StabilityTracker(window_ms / 1000.0, matches, ignore)
+        deadline = time.time() + timeout / 1000.0
+        while True:
+            content = self.jsonrpc().dumpWindowHierarchy(True, None)
+            stable, delay = tracker.observe(content, time.time())
+            if stable:
+                return True
+            if time.time() + delay >= deadline:
+                return False
+            time.sleep(delay)
 
     def exists(self, **kwargs):
         '''Check if the specified ui object by kwargs exists.'''
         return self(**kwargs).exists
 
-    def remote_exec(self, text, timeout=60000):
+    def remote_exec(self, text, timeout=60000, on_output=None):
+        '''
+        run a script on the device and return its stdout.
+        on_output, if given, is called with the stdout chunks as they are written.
+        '''
         token = self.jsonrpc().runScript(text)
-        start_time = time.time()
-        timeout_sec = timeout / 1000
-        while time.time() - start_time < timeout_sec:
-            result = self.jsonrpc().getScriptResult(token)
-            if result is not None:
-                if result.get('resultCode') == 0:
-                    return result['stdOutString']
-                else:
-                    raise RuntimeError(
-                        'Remote script execution failed: code={resultCode}, message={stdErrString}'.format(**result))
-            time.sleep(1.0)
-        raise RuntimeError('Remote script execution timeout')
-
-    def remote_exec_apk(self, apk_path, class_name, args_dict, timeout=60000):
+        result, streamed = self.__wait_result(
+            token, 'getScriptResult', 'waitScriptResult', timeout, on_output)
+        flush_output(result, streamed, on_output)
+        if result.get('resultCode') == 0:
+            return result['stdOutString']
+        else:
+            raise RuntimeError(
+                'Remote script execution failed: code={resultCode}, message={stdErrString}'.format(**result))
+
+    def remote_exec_apk(self, apk_path, class_name, args_dict, timeout=60000, on_output=None):
+        '''run a class of the apk on the device and return its result, see remote_exec for on_output.'''
+        token = self.__run_apk(apk_path, class_name, args_dict)
+        result, streamed = self.__wait_result(
+            token, 'getRunApkResult', 'waitRunApkResult', timeout, on_output)
+        flush_output(result, streamed, on_output)
+        return result
+
+    def __wait_result(self, token, poll_method, wait_method, timeout, on_output):
+        '''
+        Wait for the result of a remote run. wait_method is a long poll which
+        answers once the result is ready or after wait milliseconds, with the
+        output written since offset. Servers without it are polled with
+        poll_method, backing off from RESULT_POLL_BACKOFF[0].
+        return the result and the length of the output passed to on_output.
+        '''
+        due = time.time() + timeout / 1000.0
+        offset, delay = 0, RESULT_POLL_BACKOFF[0]
+        while True:
+            left = due - time.time()
+            if left <= 0:
+                raise RuntimeError('Remote script execution timeout')
+            if self.server.long_poll_supported:
+                wait = int(min(left * 1000, LONG_POLL_WAIT))
+                client = self.jsonrpc(timeout=LONG_POLL_WAIT / 1000.0 + JSONRPC_TIMEOUT)
+                try:
+                    reply = getattr(client, wait_method)(token, offset, wait)
+                except JsonRPCError as e:
+                    if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                        raise
+                    logging.debug('Long poll not supported, polling {}: {}'.format(poll_method, e))
+                    self.server.long_poll_supported = False
+                    continue
+                output = reply.get('output')
+                if output:
+                    offset += len(output)
+                    if on_output is not None:
+                        on_output(output)
+                if reply.get('result') is not None:
+                    return reply['result'], offset
+            else:
+                result = getattr(self.jsonrpc(), poll_method)(token)
+                if result is not None:
+                    return result, offset
+                time.sleep(min(delay, left))
+                delay = min(delay * 2, RESULT_POLL_BACKOFF[1])
+
+    def __run_apk(self, apk_path, class_name, args_dict):
+        '''start the apk staged by its hash, or sent inline if the server cannot stage.'''
+        stager = self.server.apk_stager
+        if stager.supported:
+            try:
+                return self.__run_staged(stager, apk_path, class_name, args_dict)
+            except JsonRPCError as e:
+                if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                    raise
+                logging.debug('APK staging not supported, sending the apk inline: {}'.format(e))
+                stager.supported = False
         with open(apk_path, 'rb') as f:
             apk_data = base64.b64encode(f.read()).decode('ascii')
-        token = self.jsonrpc().runApk(apk_data, class_name, args_dict)
-        start_time = time.time()
-        timeout_sec = timeout / 1000
-        while time.time() - start_time < timeout_sec:
-            result = self.jsonrpc().getRunApkResult(token)
-            if result is not None:
-                return result
-            time.sleep(1.0)
-        raise RuntimeError('Remote script execution timeout')
+        return self.jsonrpc().runApk(apk_data, class_name, args_dict)
 
+    def __run_staged(self, stager, apk_path, class_name, args_dict):
+        digest = stager.digest(apk_path)
+        if digest in stager.staged:
+            try:
+                return self.jsonrpc().runStagedApk(digest, class_name, args_dict)
+            except JsonRPCError as e:
+                if e.code == ERROR_CODE_METHOD_NOT_FOUND:
+                    raise
+                stager.staged.discard(digest)  # dropped by the server, e.g. on restart
+        if not self.jsonrpc().apkStaged(digest):
+            size = os.path.getsize(apk_path)
+            for offset, data in stager.chunks(apk_path):
+                self.jsonrpc().stageApkChunk(digest, offset, size, data)
+        stager.staged.add(digest)
+        return self.jsonrpc().runStagedApk(digest, class_name, args_dict)
 
 Device = AutomatorDevice
 
 
+class AutomatorHandlers(object):
+
+    '''d.handlers, the functions called when a ui object is not found.'''
+
+    def __init__(self, device):
+        self.device = device
+
+    def on(self, fn):
+        handlers = self.device.server.handlers
+        if fn not in handlers['handlers']:
+            handlers['handlers'].append(fn)
+        handlers['device'] = self.device
+        return fn
+
+    def off(self, fn):
+        handlers = self.device.server.handlers
+        if fn in handlers['handlers']:
+            handlers['handlers'].remove(fn)
+
+
+class AutomatorWatchers(list):
+
+    def __init__(self, device, names):
+        super(AutomatorWatchers, self).__init__(names)
+        self.device = device
+
+    @property
+    def triggered(self):
+        return self.device.jsonrpc().hasAnyWatcherTriggered()
+
+    def remove(self, name=None):
+        if name:
+            self.device.jsonrpc().removeWatcher(name)
+        else:
+            for name in self:
+                self.device.jsonrpc().removeWatcher(name)
+
+    def reset(self):
+        self.device.jsonrpc().resetWatcherTriggers()
+        return self
+
+    def run(self):
+        self.device.jsonrpc().runWatchers()
+        return self
+
+
+class AutomatorWatcher(object):
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+        self.__selectors = []
+
+    @property
+    def triggered(self):
+        return self.device.jsonrpc().hasWatcherTriggered(self.name)
+
+    def remove(self):
+        self.device.jsonrpc().removeWatcher(self.name)
+
+    def when(self, **kwargs):
+        self.__selectors.append(Selector(**kwargs))
+        return self
+
+    def click(self, **kwargs):
+        self.device.jsonrpc().registerClickUiObjectWatcher(self.name, self.__selectors, Selector(**kwargs))
+
+    @fluent_method(
+        "home", "back", "left", "right", "up", "down", "center",
+        "search", "enter", "delete", "del", "recent", "volume_up",
+        "menu", "volume_down", "volume_mute", "camera", "power")
+    def press(self, *args):
+        self.device.jsonrpc().registerPressKeyskWatcher(self.name, self.__selectors, args)
+
+
+class AutomatorScreen(object):
+
+    '''d.screen, see AutomatorDevice.screen.'''
+
+    def __init__(self, device):
+        self.device = device
+
+    def on(self):
+        return self.device.wakeup()
+
+    def off(self):
+        return self.device.sleep()
+
+    def __call__(self, action):
+        if action == "on":
+            return self.on()
+        elif action == "off":
+            return self.off()
+        else:
+            raise AttributeError("Invalid parameter: %s" % action)
+
+    def __eq__(self, value):
+        info = self.device.info
+        if "screenOn" not in info:
+            raise EnvironmentError("Not supported on Android 4.3 and belows.")
+        if value in ["on", "On", "ON"]:
+            return info["screenOn"]
+        elif value in ["off", "Off", "OFF"]:
+            return not info["screenOn"]
+        raise ValueError("Invalid parameter. It can only be compared with on/off.")
+
+    def __ne__(self, value):
+        return not self.__eq__(value)
+
+    __hash__ = object.__hash__
+
+
+class PoolResult(object):
+
+    '''outcome of a call on one device of a DevicePool.'''
+
+    __slots__ = ('serial', 'value', 'error')
+
+    def __init__(self, serial, value=None, error=None):
+        self.serial = serial
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def get(self):
+        '''the value, or raise the error of the call.'''
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __repr__(self):
+        return 'PoolResult(%r, value=%r, error=%r)' % (self.serial, self.value, self.error)
+
+
+class PoolResults(dict):
+
+    '''PoolResult per device serial.'''
+
+    @property
+    def values_ok(self):
+        '''{serial: value} of the calls which succeeded.'''
+        return dict((serial, r.value) for serial, r in self.items() if r.ok)
+
+    @property
+    def errors(self):
+        '''{serial: error} of the calls which failed.'''
+        return dict((serial, r.error) for serial, r in self.items() if not r.ok)
+
+    def raise_errors(self):
+        '''raise the first error, by serial, if any call failed.'''
+        for serial in sorted(self):
+            self[serial].get()
+        return self
+
+
+class PoolExecutor(object):
+
+    '''
+    Worker threads of a DevicePool, at most size of them, started on demand
+    and reused. A task is keyed by its device serial and the key stays busy
+    until the task returns, also when its caller stopped waiting, so a hung
+    call holds its worker instead of adding threads.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.busy = set()  # keys of the tasks which have not returned
+        self.changed = threading.Condition()  # notified when a task is queued or returns
+        self.__tasks = collections.deque()
+        self.__threads = 0
+        self.__idle = 0
+
+    def available(self):
+        '''number of tasks which get a worker at once.'''
+        return self.size - len(self.busy)
+
+    def submit(self, key, func, callback):
+        '''run func() in a worker, then callback(value, error) with changed held.'''
+        with self.changed:
+            self.busy.add(key)
+            self.__tasks.append((key, func, callback))
+            if self.__idle < len(self.__tasks) and self.__threads < self.size:
+                self.__threads += 1
+                thread = threading.Thread(target=self.__work)
+                thread.daemon = True
+                thread.start()
+            self.changed.notify_all()
+
+    def __work(self):
+        while True:
+            with self.changed:
+                while not self.__tasks:
+                    self.__idle += 1
+                    self.changed.wait()
+                    self.__idle -= 1
+                key, func, callback = self.__tasks.popleft()
+            try:
+                value, error = func(), None
+            except Exception as e:
+                value, error = None, e
+            with self.changed:
+                self.busy.discard(key)
+                callback(value, error)
+                self.changed.notify_all()
+
+
+class DevicePool(object):
+
+    '''
+    The devices attached to the adb server, started and called in parallel.
+    Usage:
+    pool = DevicePool()
+    pool.start()  # all rpc servers come up concurrently
+    results = pool.map(lambda d: d.info["productName"])
+    results.values_ok, results.errors
+    pool.broadcast("press.home")  # d.press.home() on every device
+    A device is evicted when a call fails after recovery or times out, and
+    is started again by a later call once readmit_interval has passed.
+    refresh() admits the devices attached since.
+    '''
+
+    def __init__(self, serials=None, adb_server_host=None, adb_server_port=None,
+                 max_workers=POOL_MAX_WORKERS, timeout=None, start_timeout=JSONRPC_TIMEOUT,
+                 readmit_interval=POOL_READMIT_INTERVAL, device_factory=None, **kwargs):
+        self.serials = list(serials) if serials else None  # None: every attached device
+        self.adb_server_host = adb_server_host
+        self.adb_server_port = adb_server_port
+        self.adb = adb_class(kwargs.get('adb_backend'))(
+            adb_server_host=adb_server_host, adb_server_port=adb_server_port)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.readmit_interval = readmit_interval
+        self.device_factory = device_factory or self.__new_device
+        self.device_kwargs = kwargs
+        self.devices = {}  # serial -> AutomatorDevice of the admitted devices
+        self.evicted = {}  # serial -> (eviction time, error)
+        self.__known = {}  # serial -> AutomatorDevice, admitted or evicted
+        self.__executor = PoolExecutor(max_workers)
+
+    def __new_device(self, serial):
+        return AutomatorDevice(
+            serial=serial, adb_server_host=self.adb_server_host,
+            adb_server_port=self.adb_server_port, **self.device_kwargs)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter([self.devices[serial] for serial in sorted(self.devices)])
+
+    def __getitem__(self, serial):
+        return self.devices[serial]
+
+    def discover(self):
+        '''serials of the attached devices ready for use.'''
+        attached = [serial for serial, state in self.adb.devices().items() if state == 'device']
+        if self.serials is not None:
+            attached = [serial for serial in self.serials if serial in attached]
+        return sorted(attached)
+
+    def start(self):
+        '''start the rpc servers of the attached devices. return PoolResults of the started ones.'''
+        return self.refresh(readmit_all=True)
+
+    def refresh(self, readmit_all=False):
+        '''
+        Admit new devices, drop detached ones and start evicted devices
+        whose readmit_interval has passed (all of them with readmit_all).
+        return PoolResults of the start attempts.
+        '''
+        attached = self.discover()
+        for serial in list(self.devices):
+            if serial not in attached:
+                self.evict(serial, EnvironmentError("Device %s detached." % serial))
+        now = time.time()
+        candidates = [
+            serial for serial in attached
+            if serial not in self.devices and (
+                readmit_all or serial not in self.evicted or
+                now - self.evicted[serial][0] >= self.readmit_interval)]
+        results = self.__execute([(serial, self.__admit_call(serial)) for serial in candidates], self.start_timeout)
+        for serial, result in results.items():
+            if result.ok:
+                self.devices[serial] = result.value
+                self.evicted.pop(serial, None)
+            else:
+                logging.debug('Device {} not started: {}'.format(serial, result.error))
+                self.evict(serial, result.error)
+        return results
+
+    def __admit_call(self, serial):
+        def admit():
+            device = self.__known.get(serial)
+            if device is None:
+                device = self.device_factory(serial)
+            else:  # evicted before, whatever runs there is stale
+                device.server.stop_instrumentation()
+            self.__known[serial] = device
+            device.server.start(timeout=self.start_timeout)
+            return device
+        return admit
+
+    def evict(self, serial, error=None):
+        '''remove the device from the pool until it is readmitted.'''
+        self.devices.pop(serial, None)
+        self.evicted[serial] = (time.time(), error)
+
+    @staticmethod
+    def evicts(device, error):
+        '''True if the error means the device is unusable, not that the call went wrong.'''
+        if not isinstance(error, (IOError, JsonRPCError)):
+            return False
+        policy = getattr(getattr(device, 'server', None), 'recovery_policy', None) or RecoveryPolicy()
+        return policy.classify(error) != 'application'
+
+    def map(self, fn, timeout=None):
+        '''
+        fn(device) on every admitted device, at most max_workers at a time.
+        return PoolResults; a call running longer than timeout (seconds)
+        fails with IOError and its device is evicted.
+        '''
+        now = time.time()
+        if any(now - evicted_at >= self.readmit_interval for evicted_at, _ in self.evicted.values()):
+            self.refresh()
+        devices = dict(self.devices)
+        results = self.__execute(
+            [(serial, (lambda device: lambda: fn(device))(device)) for serial, device in sorted(devices.items())],
+            timeout if timeout is not None else self.timeout)
+        for serial, result in results.items():
+            if not result.ok and self.evicts(devices[serial], result.error):
+                logging.debug('Evict device {}: {}'.format(serial, result.error))
+                self.evict(serial, result.error)
+        return results
+
+    def broadcast(self, method, *args, **kwargs):
+        '''
+        call the device method on every admitted device, method being an
+        attribute path such as "click", "press.home" or "screen.on".
+        timeout keyword is the per device timeout as in map.
+        '''
+        timeout = kwargs.pop('timeout', None)
+        names = method.split('.')
+
+        def call(device):
+            target = device
+            for name in names:
+                target = getattr(target, name)
+            return target(*args, **kwargs)
+        return self.map(call, timeout=timeout)
+
+    def stop(self):
+        '''stop the rpc servers of all devices.'''
+        results = self.__execute(
+            [(serial, device.server.stop) for serial, device in sorted(self.__known.items())], STOP_TIMEOUT * 2)
+        self.devices = {}
+        return results
+
+    def __execute(self, calls, timeout):
+        '''
+        run (serial, func) calls on the workers of the pool, at most
+        max_workers at a time. A call which runs longer than timeout is
+        abandoned; it holds its worker until it returns, and its device
+        gets no other call meanwhile.
+        '''
+        executor = self.__executor
+        executor.size = self.max_workers
+        results = PoolResults()
+        pending = []
+        running = {}  # serial -> deadline
+        changed = executor.changed
+
+        def done(serial):
+            def callback(value, error):
+                if serial in running:  # not abandoned
+                    del running[serial]
+                    results[serial] = PoolResult(serial, value=value, error=error)
+            return callback
+
+        with changed:
+            for serial, func in calls:
+                if serial in executor.busy:
+                    results[serial] = PoolResult(
+                        serial, error=IOError("Device %s is still running a timed out call." % serial))
+                else:
+                    pending.append((serial, func))
+            stalled_since = None
+            while pending or running:
+                while pending and executor.available() > 0:
+                    serial, func = pending.pop(0)
+                    running[serial] = time.time() + timeout if timeout else None
+                    executor.submit(serial, func, done(serial))
+                    stalled_since = None
+                now = time.time()
+                for serial, deadline in list(running.items()):
+                    if deadline is not None and deadline <= now:
+                        del running[serial]
+                        results[serial] = PoolResult(
+                            serial, error=IOError("Device %s timed out after %s seconds." % (serial, timeout)))
+                deadlines = [deadline for deadline in running.values() if deadline is not None]
+                if pending and not running and timeout:  # every worker is held by abandoned calls
+                    stalled_since = stalled_since or now
+                    if now - stalled_since >= timeout:
+                        for serial, _ in pending:
+                            results[serial] = PoolResult(
+                                serial, error=IOError("Device %s got no free worker in %s seconds." % (serial, timeout)))
+                        break
+                    deadlines.append(stalled_since + timeout)
+                if pending or running:
+                    changed.wait(max(min(deadlines) - now, 0) if deadlines else None)
+        return results
+
+
 class AutomatorDeviceUiObject(object):
 
     '''Represent a UiObject, on which user can perform actions, such as click, set text
@@ -903,12 +3021,14 @@ class AutomatorDeviceUiObject(object):
 
     __alias = {'description': "contentDescription"}
 
-    def __init__(self, device, selector):
+    def __init__(self, device, selector, info=None):
         self.device = device
         self.selector = selector
+        self.__record = info
 
-    def jsonrpc(self):
-        return self.device.jsonrpc()
+    def jsonrpc(self, timeout=None):
+        self.__record = None  # any call may change the object
+        return self.device.jsonrpc(timeout=timeout)
 
     @property
     def exists(self):
@@ -916,8 +3036,10 @@ class AutomatorDeviceUiObject(object):
         return self.jsonrpc().exist(self.selector)
 
     def __getattr__(self, attr):
-        '''alias of fields in info property.'''
-        info = self.info
+        '''alias of fields in info, served from snapshot().'''
+        if attr.startswith('_AutomatorDeviceUiObject__'):  # not set yet
+            raise AttributeError(attr)
+        info = self.snapshot()
         if attr in info:
             return info[attr]
         elif attr in self.__alias:
@@ -927,8 +3049,23 @@ class AutomatorDeviceUiObject(object):
 
     @property
     def info(self):
-        '''ui object info.'''
-        return self.jsonrpc().objInfo(self.selector)
+        '''ui object info as a read-only UiObjectInfo, read from the device.'''
+        record = UiObjectInfo.from_dict(self.jsonrpc().objInfo(self.selector))
+        self.__record = record
+        return record
+
+    def snapshot(self):
+        '''
+        UiObjectInfo read once and kept until refresh() or the next call on
+        this object, so obj.text, obj.bounds and obj.enabled are one RPC
+        and one consistent view.
+        '''
+        record = self.__record
+        return record if record is not None else self.info
+
+    def refresh(self):
+        '''read the info from the device again. return the new UiObjectInfo.'''
+        return self.info
 
     def set_text(self, text):
         '''set the text field.'''
@@ -941,8 +3078,8 @@ class AutomatorDeviceUiObject(object):
         '''clear text. alias for set_text(None).'''
         self.set_text(None)
 
-    @property
-    def click(self):
+    @fluent_method(action=["tl", "topleft", "br", "bottomright", "wait"])
+    def click(self, action=None, timeout=3000):
         '''
         click on the ui object.
         Usage:
@@ -951,18 +3088,15 @@ class AutomatorDeviceUiObject(object):
         d(text="John").click.topleft() # click on the topleft of the ui object
         d(text="John").click.bottomright() # click on the bottomright of the ui object
         '''
-        @param_to_property(action=["tl", "topleft", "br", "bottomright", "wait"])
-        def _click(action=None, timeout=3000):
-            if action is None:
-                return self.jsonrpc().click(self.selector)
-            elif action in ["tl", "topleft", "br", "bottomright"]:
-                return self.jsonrpc().click(self.selector, action)
-            else:
-                return self.jsonrpc().clickAndWaitForNewWindow(self.selector, timeout)
-        return _click
+        if action is None:
+            return self.jsonrpc().click(self.selector)
+        elif action in ["tl", "topleft", "br", "bottomright"]:
+            return self.jsonrpc().click(self.selector, action)
+        else:
+            return self.jsonrpc().clickAndWaitForNewWindow(self.selector, timeout)
 
-    @property
-    def long_click(self):
+    @fluent_method(corner=["tl", "topleft", "br", "bottomright"])
+    def long_click(self, corner=None):
         '''
         Perform a long click action on the object.
         Usage:
@@ -970,27 +3104,15 @@ class AutomatorDeviceUiObject(object):
         d(text="Image").long_click.topleft()  # long click on the topleft of the ui object
         d(text="Image").long_click.bottomright()  # long click on the topleft of the ui object
         '''
-        @param_to_property(corner=["tl", "topleft", "br", "bottomright"])
-        def _long_click(corner=None):
-            info = self.info
-            if info["longClickable"]:
-                if corner:
-                    return self.jsonrpc().longClick(self.selector, corner)
-                else:
-                    return self.jsonrpc().longClick(self.selector)
+        info = self.info
+        if info["longClickable"]:
+            if corner:
+                return self.jsonrpc().longClick(self.selector, corner)
             else:
-                bounds = info.get("visibleBounds") or info.get("bounds")
-                if corner in ["tl", "topleft"]:
-                    x = (5 * bounds["left"] + bounds["right"]) / 6
-                    y = (5 * bounds["top"] + bounds["bottom"]) / 6
-                elif corner in ["br", "bottomright"]:
-                    x = (bounds["left"] + 5 * bounds["right"]) / 6
-                    y = (bounds["top"] + 5 * bounds["bottom"]) / 6
-                else:
-                    x = (bounds["left"] + bounds["right"]) / 2
-                    y = (bounds["top"] + bounds["bottom"]) / 2
-                return self.device.long_click(x, y)
-        return _long_click
+                return self.jsonrpc().longClick(self.selector)
+        else:
+            x, y = corner_point(info.get("visibleBounds") or info.get("bounds"), corner)
+            return self.device.long_click(x, y)
 
     @property
     def drag(self):
@@ -1000,13 +3122,7 @@ class AutomatorDeviceUiObject(object):
         d(text="Clock").drag.to(x=100, y=100)  # drag to point (x,y)
         d(text="Clock").drag.to(text="Remove") # drag to another object
         '''
-        def to(obj, *args, **kwargs):
-            if len(args) >= 2 or "x" in kwargs or "y" in kwargs:
-                drag_to = lambda x, y, steps=100: self.jsonrpc().dragTo(self.selector, x, y, steps)
-            else:
-                drag_to = lambda steps=100, **kwargs: self.jsonrpc().dragTo(self.selector, Selector(**kwargs), steps)
-            return drag_to(*args, **kwargs)
-        return type("Drag", (object,), {"to": to})()
+        return Drag(self)
 
     def gesture(self, start1, start2, *args, **kwargs):
         '''
@@ -1015,31 +3131,24 @@ class AutomatorDeviceUiObject(object):
         d().gesture(startPoint1, startPoint2).to(endPoint1, endPoint2, steps)
         d().gesture(startPoint1, startPoint2, endPoint1, endPoint2, steps)
         '''
-        def to(obj_self, end1, end2, steps=100):
-            ctp = lambda pt: point(*pt) if type(pt) == tuple else pt  # convert tuple to point
-            s1, s2, e1, e2 = ctp(start1), ctp(start2), ctp(end1), ctp(end2)
-            return self.jsonrpc().gesture(self.selector, s1, s2, e1, e2, steps)
-        obj = type("Gesture", (object,), {"to": to})()
-        return obj if len(args) == 0 else to(None, *args, **kwargs)
+        gesture = Gesture(self, start1, start2)
+        return gesture if len(args) == 0 else gesture.to(*args, **kwargs)
 
-    @property
-    def pinch(self):
+    @fluent_method(in_or_out=["In", "Out"])
+    def pinch(self, in_or_out="Out", percent=100, steps=50):
         '''
         Perform two point gesture from edge to center(in) or center to edge(out).
         Usages:
         d().pinch.In(percent=100, steps=10)
         d().pinch.Out(percent=100, steps=100)
         '''
-        @param_to_property(in_or_out=["In", "Out"])
-        def _pinch(in_or_out="Out", percent=100, steps=50):
-            if in_or_out in ["Out", "out"]:
-                return self.jsonrpc().pinchOut(self.selector, percent, steps)
-            elif in_or_out in ["In", "in"]:
-                return self.jsonrpc().pinchIn(self.selector, percent, steps)
-        return _pinch
+        if in_or_out in ["Out", "out"]:
+            return self.jsonrpc().pinchOut(self.selector, percent, steps)
+        elif in_or_out in ["In", "in"]:
+            return self.jsonrpc().pinchIn(self.selector, percent, steps)
 
-    @property
-    def swipe(self):
+    @fluent_method(direction=["up", "down", "right", "left"])
+    def swipe(self, direction="left", steps=10, percent=1):
         '''
         Perform swipe action. if device platform greater than API 18, percent can be used and value between 0 and 1
         Usages:
@@ -1050,32 +3159,57 @@ class AutomatorDeviceUiObject(object):
         d().swipe("right", steps=20)
         d().swipe("right", steps=20, percent=0.5)
         '''
-        @param_to_property(direction=["up", "down", "right", "left"])
-        def _swipe(direction="left", steps=10, percent=1):
-            if percent == 1:
-                return self.jsonrpc().swipe(self.selector, direction, steps)
-            else:
-                return self.jsonrpc().swipe(self.selector, direction, percent, steps)
-        return _swipe
+        if percent == 1:
+            return self.jsonrpc().swipe(self.selector, direction, steps)
+        else:
+            return self.jsonrpc().swipe(self.selector, direction, percent, steps)
 
-    @property
-    def wait(self):
+    @fluent_method(action=["exists", "gone"])
+    def wait(self, action, timeout=3000):
         '''
         Wait until the ui object gone or exist.
         Usage:
         d(text="Clock").wait.gone()  # wait until it's gone.
         d(text="Settings").wait.exists() # wait until it appears.
         '''
-        @param_to_property(action=["exists", "gone"])
-        def _wait(action, timeout=3000):
-            http_timeout = timeout / 1000 + JSONRPC_TIMEOUT
-            if action == "gone":
-                return self.device.jsonrpc(
-                    timeout=http_timeout).waitUntilGone(self.selector, timeout)
-            else:
-                return self.device.jsonrpc(
-                    timeout=http_timeout).waitForExists(self.selector, timeout)
-        return _wait
+        http_timeout = timeout / 1000 + JSONRPC_TIMEOUT
+        if action == "gone":
+            return self.jsonrpc(timeout=http_timeout).waitUntilGone(self.selector, timeout)
+        else:
+            return self.jsonrpc(timeout=http_timeout).waitForExists(self.selector, timeout)
+
+
+class Drag(object):
+
+    '''obj.drag, see AutomatorDeviceUiObject.drag.'''
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def to(self, *args, **kwargs):
+        if len(args) >= 2 or "x" in kwargs or "y" in kwargs:
+            return self.__to_point(*args, **kwargs)
+        return self.__to_object(*args, **kwargs)
+
+    def __to_point(self, x, y, steps=100):
+        return self.obj.jsonrpc().dragTo(self.obj.selector, x, y, steps)
+
+    def __to_object(self, steps=100, **kwargs):
+        return self.obj.jsonrpc().dragTo(self.obj.selector, Selector(**kwargs), steps)
+
+
+class Gesture(object):
+
+    '''two point gesture started by obj.gesture(start1, start2).'''
+
+    def __init__(self, obj, start1, start2):
+        self.obj = obj
+        self.start1, self.start2 = start1, start2
+
+    def to(self, end1, end2, steps=100):
+        ctp = lambda pt: point(*pt) if type(pt) == tuple else pt  # convert tuple to point
+        s1, s2, e1, e2 = ctp(self.start1), ctp(self.start2), ctp(end1), ctp(end2)
+        return self.obj.jsonrpc().gesture(self.obj.selector, s1, s2, e1, e2, steps)
 
 
 class AutomatorDeviceNamedUiObject(AutomatorDeviceUiObject):
@@ -1102,8 +3236,8 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
     on which user can perform actions, such as click, set text
     '''
 
-    def __init__(self, device, selector):
-        super(AutomatorDeviceObject, self).__init__(device, selector)
+    def __init__(self, device, selector, info=None):
+        super(AutomatorDeviceObject, self).__init__(device, selector, info)
 
     def child(self, **kwargs):
         '''set childSelector.'''
@@ -1168,6 +3302,13 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
     def __len__(self):
         return self.count
 
+    def instance(self, index, info=None):
+        '''
+        the index-th matched object, not checked against count.
+        info, if given, is served by its snapshot() until the next call.
+        '''
+        return AutomatorDeviceObject(self.device, self.selector.freeze().pinned(index), info)
+
     def __getitem__(self, index):
         count = self.count
         if index >= count:
@@ -1175,63 +3316,74 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
         elif count == 1:
             return self
         else:
-            selector = self.selector.clone()
-            selector["instance"] = index
-            return AutomatorDeviceObject(self.device, selector)
+            return self.instance(index)
 
     def __iter__(self):
-        obj, length = self, self.count
+        length = self.count
+        if length == 1:
+            return iter([self])
+        return (self.instance(index) for index in range(length))
 
-        class Iter(object):
-
-            def __init__(self):
-                self.index = -1
+    def infos(self, chunk_size=INFOS_CHUNK_SIZE):
+        '''
+        generator of the UiObjectInfo of every matched object.
+        One count call, then the objInfo calls of chunk_size instances
+        are sent per batch request.
+        '''
+        for _, info in self.__match_infos(chunk_size):
+            yield info
 
-            def next(self):
-                self.index += 1
-                if self.index < length:
-                    return obj[self.index]
-                else:
-                    raise StopIteration()
-            __next__ = next
+    def all(self, chunk_size=INFOS_CHUNK_SIZE):
+        '''
+        generator of every matched object, pinned to its instance and
+        holding the info read as by infos().
+        Usage:
+        for obj in d(className="android.widget.TextView").all():
+            print(obj.text)  # no more RPC
+        '''
+        for index, info in self.__match_infos(chunk_size):
+            yield self.instance(index, info)
 
-        return Iter()
+    def __match_infos(self, chunk_size):
+        count = self.count
+        for begin in range(0, count, chunk_size):
+            with self.device.batch() as batch:
+                futures = [batch.objInfo(self.instance(index).selector)
+                           for index in range(begin, min(count, begin + chunk_size))]
+            for index, future in enumerate(futures, begin):
+                error = future.exception()
+                if isinstance(error, JsonRPCError) and error.code == ERROR_CODE_FILE_NOT_FOUND:
+                    return  # the window changed to fewer matches than counted
+                yield index, UiObjectInfo.from_dict(future.result())
 
     def right(self, **kwargs):
-        def onrightof(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect2["left"] - rect1["right"] if top < bottom else -1
-        return self.__view_beside(onrightof, **kwargs)
+        '''nearest object matched by kwargs on the right of this object.'''
+        return self.__view_beside("right", **kwargs)
 
     def left(self, **kwargs):
-        def onleftof(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect1["left"] - rect2["right"] if top < bottom else -1
-        return self.__view_beside(onleftof, **kwargs)
+        '''nearest object matched by kwargs on the left of this object.'''
+        return self.__view_beside("left", **kwargs)
 
     def up(self, **kwargs):
-        def above(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect1["top"] - rect2["bottom"] if left < right else -1
-        return self.__view_beside(above, **kwargs)
+        '''nearest object matched by kwargs above this object.'''
+        return self.__view_beside("up", **kwargs)
 
     def down(self, **kwargs):
-        def under(rect1, rect2):
-            left, top, right, bottom = intersect(rect1, rect2)
-            return rect2["top"] - rect1["bottom"] if left < right else -1
-        return self.__view_beside(under, **kwargs)
-
-    def __view_beside(self, onsideof, **kwargs):
-        bounds = self.info["bounds"]
-        min_dist, found = -1, None
-        for ui in AutomatorDeviceObject(self.device, Selector(**kwargs)):
-            dist = onsideof(bounds, ui.info["bounds"])
-            if dist >= 0 and (min_dist < 0 or dist < min_dist):
-                min_dist, found = dist, ui
-        return found
-
-    @property
-    def fling(self):
+        '''nearest object matched by kwargs below this object.'''
+        return self.__view_beside("down", **kwargs)
+
+    def __view_beside(self, direction, **kwargs):
+        # found in one hierarchy dump, then a live object pinned by kwargs and instance
+        if isinstance(self, SnapshotDeviceObject):
+            return self.hierarchy_snapshot.beside(self.selector, direction, Selector(**kwargs))
+        found = self.device.snapshot().beside(self.selector, direction, Selector(**kwargs))
+        return beside_object(self.device, found, kwargs)
+
+    @fluent_method(
+        dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
+        action=["forward", "backward", "toBeginning", "toEnd"]
+    )
+    def fling(self, dimention="vert", action="forward", max_swipes=1000):
         '''
         Perform fling action.
         Usage:
@@ -1241,25 +3393,20 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
         d().fling.toBeginning(max_swipes=100) # vertically
         d().fling.horiz.toEnd()
         '''
-        @param_to_property(
-            dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
-            action=["forward", "backward", "toBeginning", "toEnd"]
-        )
-        def _fling(dimention="vert", action="forward", max_swipes=1000):
-            vertical = dimention in ["vert", "vertically", "vertical"]
-            if action == "forward":
-                return self.jsonrpc().flingForward(self.selector, vertical)
-            elif action == "backward":
-                return self.jsonrpc().flingBackward(self.selector, vertical)
-            elif action == "toBeginning":
-                return self.jsonrpc().flingToBeginning(self.selector, vertical, max_swipes)
-            elif action == "toEnd":
-                return self.jsonrpc().flingToEnd(self.selector, vertical, max_swipes)
-
-        return _fling
-
-    @property
-    def scroll(self):
+        vertical = dimention in ["vert", "vertically", "vertical"]
+        if action == "forward":
+            return self.jsonrpc().flingForward(self.selector, vertical)
+        elif action == "backward":
+            return self.jsonrpc().flingBackward(self.selector, vertical)
+        elif action == "toBeginning":
+            return self.jsonrpc().flingToBeginning(self.selector, vertical, max_swipes)
+        elif action == "toEnd":
+            return self.jsonrpc().flingToEnd(self.selector, vertical, max_swipes)
+
+    @fluent_method(
+        dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
+        action=["forward", "backward", "toBeginning", "toEnd", "to"])
+    def scroll(self, dimention="vert", action="forward", **kwargs):
         '''
         Perfrom scroll action.
         Usage:
@@ -1270,30 +3417,142 @@ class AutomatorDeviceObject(AutomatorDeviceUiObject):
         d().scroll.vert.toEnd(steps=100)
         d().scroll.horiz.to(text="Clock")
         '''
-        def __scroll(vertical, forward, steps=100):
-            method = self.jsonrpc().scrollForward if forward else self.jsonrpc().scrollBackward
-            return method(self.selector, vertical, steps)
+        vertical = dimention in ["vert", "vertically", "vertical"]
+        if action in ["forward", "backward"]:
+            return self.__scroll(vertical, action == "forward", **kwargs)
+        elif action == "toBeginning":
+            return self.__scroll_to_beginning(vertical, **kwargs)
+        elif action == "toEnd":
+            return self.__scroll_to_end(vertical, **kwargs)
+        elif action == "to":
+            return self.jsonrpc().scrollTo(self.selector, Selector(**kwargs), vertical)
 
-        def __scroll_to_beginning(vertical, steps=100, max_swipes=1000):
-            return self.jsonrpc().scrollToBeginning(self.selector, vertical, max_swipes, steps)
+    def __scroll(self, vertical, forward, steps=100):
+        method = self.jsonrpc().scrollForward if forward else self.jsonrpc().scrollBackward
+        return method(self.selector, vertical, steps)
 
-        def __scroll_to_end(vertical, steps=100, max_swipes=1000):
-            return self.jsonrpc().scrollToEnd(self.selector, vertical, max_swipes, steps)
+    def __scroll_to_beginning(self, vertical, steps=100, max_swipes=1000):
+        return self.jsonrpc().scrollToBeginning(self.selector, vertical, max_swipes, steps)
 
-        def __scroll_to(vertical, **kwargs):
-            return self.jsonrpc().scrollTo(self.selector, Selector(**kwargs), vertical)
+    def __scroll_to_end(self, vertical, steps=100, max_swipes=1000):
+        return self.jsonrpc().scrollToEnd(self.selector, vertical, max_swipes, steps)
+
+
+class Snapshot(object):
+
+    '''
+    Window hierarchy taken by one dumpWindowHierarchy call.
+    Objects created from it answer info, count, exists and iteration
+    without RPC, while actions are still sent to the device.
+    '''
+
+    def __init__(self, device, hierarchy, compressed=False):
+        self.device = device
+        self.hierarchy = hierarchy
+        self.compressed = compressed
+
+    def __call__(self, **kwargs):
+        return SnapshotDeviceObject(self, Selector(**kwargs))
+
+    def exists(self, **kwargs):
+        '''Check if the specified ui object by kwargs exists in the snapshot.'''
+        return self(**kwargs).exists
+
+    def select(self, selector):
+        return self.hierarchy.select(selector)
+
+    def refresh(self):
+        '''take a new snapshot of the current window.'''
+        return self.device.snapshot(self.compressed, isinstance(self.hierarchy, CompactHierarchy))
+
+    def object_of(self, node):
+        '''SnapshotDeviceObject whose selector pins the node by className and instance.'''
+        selector = Selector(className=node.get("class"), packageName=node.get("package"))
+        selector["instance"] = self.select(selector).index(node)
+        return SnapshotDeviceObject(self, selector)
+
+    def at(self, x, y):
+        '''the top most object containing the point (x, y), or None.'''
+        nodes = self.hierarchy.spatial_index.at(x, y)
+        return self.object_of(nodes[-1]) if nodes else None
+
+    def overlapping(self, bounds):
+        '''objects overlapping the rect, in document order.'''
+        nodes = self.hierarchy.spatial_index.overlapping(
+            (bounds["left"], bounds["top"], bounds["right"], bounds["bottom"]))
+        return [self.object_of(node) for node in nodes]
+
+    def beside(self, selector, direction, target):
+        '''
+        nearest object matched by target on the direction (right/left/up/down)
+        side of the object matched by selector.
+        '''
+        nodes = self.select(selector)
+        if not nodes:
+            raise JsonRPCError(
+                ERROR_CODE_FILE_NOT_FOUND, 'UiObjectNotFoundException: not found in snapshot')
+        candidates = dict((node.order, i) for i, node in enumerate(self.select(target)))
+        found = self.hierarchy.spatial_index.nearest(
+            nodes[0].bounds, direction, lambda node: node.order in candidates)
+        if found is None:
+            return None
+        return SnapshotDeviceObject(self, target)[candidates[found.order]]
+
+
+def beside_object(device, found, kwargs):
+    '''
+    device(**kwargs) pinned to the instance of found, its SnapshotDeviceObject
+    from Snapshot.beside, and holding the snapshot info until its next call.
+    '''
+    if found is None:
+        return None
+    return device(**kwargs).instance(found.selector.get("instance", 0), found.info)
+
+
+class SnapshotDeviceObject(AutomatorDeviceObject):
+
+    '''AutomatorDeviceObject whose queries are evaluated on a Snapshot.'''
+
+    def __init__(self, snapshot, selector):
+        super(SnapshotDeviceObject, self).__init__(snapshot.device, selector)
+        self.hierarchy_snapshot = snapshot
+
+    @property
+    def nodes(self):
+        return self.hierarchy_snapshot.select(self.selector)
+
+    @property
+    def exists(self):
+        return len(self.nodes) > 0
+
+    @property
+    def info(self):
+        nodes = self.nodes
+        if not nodes:
+            raise JsonRPCError(
+                ERROR_CODE_FILE_NOT_FOUND, 'UiObjectNotFoundException: not found in snapshot')
+        return nodes[0].info
+
+    @property
+    def count(self):
+        return len(self.nodes)
+
+    def child(self, **kwargs):
+        return SnapshotDeviceObject(
+            self.hierarchy_snapshot, self.selector.clone().child(**kwargs))
+
+    def sibling(self, **kwargs):
+        return SnapshotDeviceObject(
+            self.hierarchy_snapshot, self.selector.clone().sibling(**kwargs))
+
+    child_selector, from_parent = child, sibling
+
+    def instance(self, index, info=None):
+        return SnapshotDeviceObject(self.hierarchy_snapshot, self.selector.freeze().pinned(index))
+
+    def infos(self, chunk_size=None):
+        '''UiObjectInfo of every matched node, without RPC.'''
+        return (node.info for node in self.nodes)
 
-        @param_to_property(
-            dimention=["vert", "vertically", "vertical", "horiz", "horizental", "horizentally"],
-            action=["forward", "backward", "toBeginning", "toEnd", "to"])
-        def _scroll(dimention="vert", action="forward", **kwargs):
-            vertical = dimention in ["vert", "vertically", "vertical"]
-            if action in ["forward", "backward"]:
-                return __scroll(vertical, action == "forward", **kwargs)
-            elif action == "toBeginning":
-                return __scroll_to_beginning(vertical, **kwargs)
-            elif action == "toEnd":
-                return __scroll_to_end(vertical, **kwargs)
-            elif action == "to":
-                return __scroll_to(vertical, **kwargs)
-        return _scroll
+    def all(self, chunk_size=None):
+        return (self.instance(index) for index in range(self.count))
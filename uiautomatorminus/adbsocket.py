@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Adb backend talking the adb server socket protocol instead of running adb."""
+
+import io
+import logging
+import os
+import posixpath
+import select
+import socket
+import struct
+import subprocess
+import time
+
+from .metrics import collector
+
+SYNC_DATA_MAX = 64 * 1024
+REMOTE_TMP_DIR = '/data/local/tmp'
+
+
+class AdbStream(object):
+
+    '''
+    Popen-like result of an adb service.
+    A running service (shell:, exec:) streams its output from the socket,
+    other commands are completed when the stream is created.
+    '''
+
+    def __init__(self, sock=None, output=b'', error=b'', returncode=0):
+        self.sock = sock
+        self.stdout = sock.makefile('rb') if sock is not None else io.BytesIO(output)
+        self.stderr = io.BytesIO(error)
+        self.returncode = None if sock is not None else returncode
+
+    def __finish(self, returncode):
+        if self.returncode is None:
+            self.returncode = returncode
+        if self.sock is not None:
+            # the makefile keeps the connection open until it is closed as well
+            self.stdout.close()
+            self.stdout = io.BytesIO(b'')
+            self.sock.close()
+            self.sock = None
+
+    def communicate(self, input=None, timeout=None):
+        '''read the output until the service ends. return (stdout, stderr).'''
+        if self.sock is not None:
+            self.sock.settimeout(timeout)
+            try:
+                out = self.stdout.read()
+            except socket.timeout:
+                raise subprocess.TimeoutExpired('adb', timeout)
+            self.__finish(0)
+        else:
+            out = self.stdout.read()
+        return out, self.stderr.read()
+
+    def wait(self, timeout=None):
+        self.communicate(timeout=timeout)
+        return self.returncode
+
+    def poll(self):
+        '''returncode if the service has ended, None otherwise.'''
+        if self.sock is not None:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and not self.sock.recv(1, socket.MSG_PEEK):
+                self.__finish(0)
+        return self.returncode
+
+    def kill(self):
+        self.__finish(-9)
+
+
+class AdbSocket(object):
+
+    '''
+    Adb compatible backend which sends requests to the adb server socket
+    on adb_server_host:adb_server_port without spawning adb processes.
+    cmd/raw_cmd return AdbStream instead of subprocess.Popen.
+    '''
+
+    def __init__(self, serial=None, adb_server_host=None, adb_server_port=None, timeout=None):
+        self.default_serial = serial if serial else os.environ.get("ANDROID_SERIAL", None)
+        self.adb_server_host = str(adb_server_host if adb_server_host else 'localhost')
+        self.adb_server_port = str(adb_server_port if adb_server_port else '5037')
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.create_connection(
+            (self.adb_server_host, int(self.adb_server_port)), timeout=self.timeout)
+        sock.settimeout(None)
+        return sock
+
+    @staticmethod
+    def __recv(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EnvironmentError("adb server closed the connection.")
+            data += chunk
+        return data
+
+    def __read_payload(self, sock):
+        return self.__recv(sock, int(self.__recv(sock, 4), 16))
+
+    def __request(self, sock, service):
+        '''send a service request and check the OKAY/FAIL status.'''
+        data = service.encode('utf-8')
+        sock.sendall(('%04x' % len(data)).encode('ascii') + data)
+        status = self.__recv(sock, 4)
+        if status != b'OKAY':
+            message = self.__read_payload(sock) if status == b'FAIL' else status
+            raise EnvironmentError("adb %s failed: %s" % (service, message.decode('utf-8', 'replace')))
+
+    def query(self, service):
+        '''run a host service and return its length prefixed reply.'''
+        sock = self.connect()
+        try:
+            self.__request(sock, service)
+            return self.__read_payload(sock).decode('utf-8')
+        finally:
+            sock.close()
+
+    def transport(self, serial, service):
+        '''switch to the device transport and start a device service. return the socket.'''
+        sock = self.connect()
+        try:
+            self.__request(sock, 'host:transport:%s' % serial if serial else 'host:transport-any')
+            self.__request(sock, service)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def cmd(self, *args):
+        '''adb command for the default device. return AdbStream.'''
+        return self.raw_cmd(*["-s", self.device_serial()] + list(args))
+
+    def raw_cmd(self, *args):
+        '''
+        adb command line translated to adb server services. return AdbStream.
+        supported: devices, version, forward, forward --list, shell, exec-out,
+        install, push and pull.
+        '''
+        args = list(args)
+        serial = None
+        if args[:1] == ["-s"]:
+            serial, args = args[1].strip("'"), args[2:]
+        logging.debug('ADB:{} {}'.format(serial, args))
+        if not collector.enabled:
+            return self.__run(serial, args[0], args[1:])
+        begin = time.time()
+        stream = self.__run(serial, args[0], args[1:])
+        name = " ".join(args[:2]) if args[0] == "shell" else args[0]
+        collector.observe('adb', name, time.time() - begin, error=stream.returncode not in (None, 0))
+        return stream
+
+    def __run(self, serial, command, params):
+        try:
+            if command == "devices":
+                return AdbStream(output=("List of devices attached\n" + self.query("host:devices")).encode('utf-8'))
+            elif command == "version":
+                version = int(self.query("host:version"), 16)
+                return AdbStream(output=("Android Debug Bridge version 1.0.%d\n" % version).encode('utf-8'))
+            elif command == "forward" and params == ["--list"]:
+                return AdbStream(output=self.query("host:list-forward").encode('utf-8'))
+            elif command == "forward":
+                return AdbStream(returncode=self.__forward(serial, *params))
+            elif command == "shell":
+                return AdbStream(self.transport(serial, "shell:" + " ".join(params)))
+            elif command == "exec-out":
+                return AdbStream(self.transport(serial, "exec:" + " ".join(params)))
+            elif command == "install":
+                return self.__install(serial, params[:-1], params[-1])
+            elif command == "push":
+                self.push(serial, params[0], params[1])
+                return AdbStream()
+            elif command == "pull":
+                self.pull(serial, params[0], params[1])
+                return AdbStream()
+        except EnvironmentError as e:
+            logging.debug('ADB error: {}'.format(e))
+            return AdbStream(error=str(e).encode('utf-8'), returncode=1)
+        return AdbStream(error=("unsupported adb command: %s" % command).encode('utf-8'), returncode=1)
+
+    def __forward(self, serial, local, remote):
+        prefix = 'host-serial:%s' % serial if serial else 'host'
+        sock = self.connect()
+        try:
+            self.__request(sock, '%s:forward:%s;%s' % (prefix, local, remote))
+            # newer adb servers send a second status once the forward is set up
+            status = sock.recv(4)
+            if status == b'FAIL':
+                raise EnvironmentError(self.__read_payload(sock).decode('utf-8', 'replace'))
+        finally:
+            sock.close()
+        return 0
+
+    def __install(self, serial, options, apk_path):
+        remote = posixpath.join(REMOTE_TMP_DIR, os.path.basename(apk_path))
+        self.push(serial, apk_path, remote)
+        sock = self.transport(serial, "exec:pm install %s" % " ".join(options + [remote]))
+        out = AdbStream(sock).communicate()[0]
+        AdbStream(self.transport(serial, "exec:rm -f %s" % remote)).communicate()
+        return AdbStream(output=out, returncode=0 if b'Success' in out else 1)
+
+    def __sync(self, serial):
+        return self.transport(serial, 'sync:')
+
+    @staticmethod
+    def __sync_request(sock, sync_id, data):
+        sock.sendall(sync_id + struct.pack('<I', len(data)) + data)
+
+    def __sync_status(self, sock):
+        sync_id, length = struct.unpack('<4sI', self.__recv(sock, 8))
+        if sync_id == b'FAIL':
+            raise EnvironmentError("adb sync failed: %s" % self.__recv(sock, length).decode('utf-8', 'replace'))
+        return sync_id, length
+
+    def push(self, serial, local, remote, mode=0o644):
+        '''push the local file to the device via the sync service.'''
+        sock = self.__sync(serial)
+        try:
+            spec = ('%s,%d' % (remote, 0o100000 | mode)).encode('utf-8')
+            self.__sync_request(sock, b'SEND', spec)
+            with open(local, 'rb') as f:
+                while True:
+                    data = f.read(SYNC_DATA_MAX)
+                    if not data:
+                        break
+                    self.__sync_request(sock, b'DATA', data)
+            sock.sendall(b'DONE' + struct.pack('<I', int(time.time())))
+            self.__sync_status(sock)
+            self.__sync_request(sock, b'QUIT', b'')
+        finally:
+            sock.close()
+
+    def pull(self, serial, remote, local):
+        '''pull the device file to local via the sync service.'''
+        sock = self.__sync(serial)
+        try:
+            self.__sync_request(sock, b'RECV', remote.encode('utf-8'))
+            sync_id, length = self.__sync_status(sock)  # fails before local is truncated
+            with open(local, 'wb') as f:
+                while sync_id != b'DONE':
+                    f.write(self.__recv(sock, length))
+                    sync_id, length = self.__sync_status(sock)
+            self.__sync_request(sock, b'QUIT', b'')
+        finally:
+            sock.close()
+
+    def device_serial(self):
+        if not self.default_serial:
+            devices = self.devices()
+            if devices:
+                if len(devices) == 1:
+                    self.default_serial = list(devices.keys())[0]
+                else:
+                    raise EnvironmentError("Multiple devices attached but default android serial not set.")
+            else:
+                raise EnvironmentError("Device not attached.")
+        return self.default_serial
+
+    def devices(self):
+        '''get a dict of attached devices. key is the device serial, value is device name.'''
+        try:
+            out = self.query("host:devices")
+        except (EnvironmentError, socket.error):
+            raise EnvironmentError("adb is not working.")
+        return dict([s.split("\t") for s in out.strip().splitlines() if s.strip()])
+
+    def forward(self, local_port, device_port):
+        '''adb port forward. return 0 if success, else non-zero.'''
+        return self.cmd("forward", "tcp:%d" % local_port, "tcp:%d" % device_port).wait()
+
+    def forward_list(self):
+        '''adb forward --list'''
+        lines = self.query("host:list-forward").strip().splitlines()
+        return [line.strip().split() for line in lines]
+
+    def version(self):
+        '''adb version'''
+        version = int(self.query("host:version"), 16)
+        return ['1.0.%d' % version, '1', '0', str(version)]
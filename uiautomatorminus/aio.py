@@ -0,0 +1,1329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+asyncio API: AsyncDevice mirrors AutomatorDevice with awaitable calls.
+    d = AsyncDevice(serial)
+    await d.server.start()
+    await d(text="Settings").click()
+    await d(text="OK").wait.exists(timeout=3000)
+JSON-RPC calls go through a keep-alive HTTP/1.1 client on asyncio streams
+and adb commands run as asyncio subprocesses, so nothing blocks the loop.
+"""
+
+import asyncio
+import base64
+import inspect
+import json
+import logging
+import os
+import re
+import time
+
+import requests
+
+from . import (
+    Adb, ApkStager, AutomatorDevice, AutomatorDeviceObject, AutomatorDeviceNamedUiObject, CaptureOutput,
+    CompactHierarchy, FrozenSelector, Hierarchy, InstallCache, InstrumentationError, JsonRPCBatch,
+    JsonRPCClient, JsonRPCClientCache, JsonRPCError, RecoveryPolicy, Selector, SelectorRegistry, Snapshot, U,
+    adb_command_name, beside_object, capture_done, corner_point, flush_output, fluent_method,
+    jsonrpc_batch_request, jsonrpc_batch_results, jsonrpc_request, jsonrpc_result, next_local_port,
+    observe_rpc, port_registry, running_handlers, DEVICE_PORT, ERROR_CODE_FILE_NOT_FOUND,
+    ERROR_CODE_METHOD_NOT_FOUND, ERROR_CODE_UNKNOWN_HANDLE, INSTRUMENT_EXTRA_OPTS, INSTRUMENTATION_END_MARKERS,
+    JSON_HEADERS,
+    JSONRPC_TIMEOUT, LONG_POLL_WAIT, MAINPACKAGE, PING_BACKOFF, PING_TIMEOUT, READY_PATTERN,
+    RECOVERABLE_ERRORS, RESTART_TIMEOUT_AFTER_INSTRUMENT_RESET, RESTART_TIMEOUT_AFTER_REINSTALL,
+    RESULT_POLL_BACKOFF, SCREENSHOT_CHUNK_SIZE, STABLE_MATCHES, STABLE_WINDOW, STOP_TIMEOUT, TESTPACKAGE,
+    TESTRUNNER)
+from .hierarchy import StabilityTracker, iter_nodes, pretty_xml
+from .info import UiObjectInfo
+from .metrics import collector
+
+APK_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libs', apk)
+    for apk in ('app-debug.apk', 'app-debug-androidTest.apk')]
+HTTP_MAX_IDLE = 4
+
+
+class HttpError(IOError):
+    pass
+
+
+class HttpClient(object):
+
+    '''
+    Minimal HTTP/1.1 client on asyncio streams for the rpc server.
+    Connections are kept alive and reused, one request at a time each;
+    a reused connection the server has closed meanwhile is retried once
+    on a new one.
+    '''
+
+    def __init__(self, max_idle=HTTP_MAX_IDLE):
+        self.max_idle = max_idle
+        self.__idle = {}
+
+    async def request(self, method, host, port, path, body=b'', headers=None, timeout=None):
+        '''return (status, headers, body). raise OSError or asyncio.TimeoutError.'''
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s:%d' % (host, port),
+                 'Content-Length: %d' % len(body), 'Connection: keep-alive']
+        lines.extend('%s: %s' % item for item in (headers or {}).items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        key = (host, port)
+        idle = self.__idle.setdefault(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            try:
+                return await self.__exchange(key, reader, writer, request, timeout, reused=True)
+            except _StaleConnection:
+                logging.debug('HTTP connection closed by the server, reconnecting.')
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        return await self.__exchange(key, reader, writer, request, timeout, reused=False)
+
+    async def __exchange(self, key, reader, writer, request, timeout, reused):
+        due = None if timeout is None else asyncio.get_event_loop().time() + timeout
+        try:
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await asyncio.wait_for(reader.readline(), _remaining(due))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if reused:
+                    raise _StaleConnection()
+                raise
+            if not status_line:
+                if reused:
+                    raise _StaleConnection()
+                raise HttpError('connection closed by the server')
+            status, headers, body, keep_alive = await asyncio.wait_for(
+                self.__read_response(status_line, reader), _remaining(due))
+        except BaseException:
+            writer.close()
+            raise
+        idle = self.__idle.setdefault(key, [])
+        if keep_alive and len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, headers, body
+
+    @staticmethod
+    async def __read_response(status_line, reader):
+        parts = status_line.decode('latin-1').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+            raise HttpError('invalid status line: %r' % status_line)
+        status = int(parts[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = parts[0] != 'HTTP/1.0' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return status, headers, body, keep_alive
+
+    def close(self):
+        '''close the idle connections.'''
+        for idle in self.__idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self.__idle = {}
+
+
+class _StaleConnection(Exception):
+    pass
+
+
+def _remaining(due):
+    if due is None:
+        return None
+    return max(due - asyncio.get_event_loop().time(), 0)
+
+
+def transport_error(error):
+    '''the requests exception of the same failure, so RecoveryPolicy classifies it alike.'''
+    if isinstance(error, asyncio.TimeoutError):
+        return requests.exceptions.ReadTimeout('Read timed out.')
+    if isinstance(error, ConnectionRefusedError):
+        return requests.exceptions.ConnectionError('Connection refused: %s' % error)
+    if isinstance(error, (OSError, EOFError)):
+        return requests.exceptions.ConnectionError(str(error) or error.__class__.__name__)
+    if isinstance(error, ValueError):
+        return requests.exceptions.RequestException('Invalid response: %s' % error)
+    return error
+
+
+async def post(http, host, port, path, body, timeout):
+    '''content of a JSON-RPC POST, errors raised as their requests exception.'''
+    try:
+        status, headers, content = await http.request(
+            'POST', host, port, path, body.encode('utf-8'), JSON_HEADERS, timeout)
+        return content
+    except Exception as e:
+        error = transport_error(e)
+        if error is e:
+            raise
+        raise error
+
+
+async def jsonrpc_call(http, host, port, timeout, call_desc, path='/jsonrpc/'):
+    method, body = jsonrpc_request(call_desc)
+    begin = time.time() if collector.enabled else None
+    content = b''
+    try:
+        content = await post(http, host, port, path, body, timeout)
+        jsonresult = json.loads(content.decode('utf-8'))
+    except Exception as e:
+        observe_rpc(method, begin, body, content, True)
+        error = transport_error(e)
+        if error is e:
+            raise
+        raise error
+    return jsonrpc_result(method, begin, body, content, jsonresult)
+
+
+async def jsonrpc_batch_call(http, host, port, timeout, call_descs, path='/jsonrpc/'):
+    '''jsonrpc_batch_call of the package, sent with HttpClient.'''
+    ids, body = jsonrpc_batch_request(call_descs)
+    begin = time.time() if collector.enabled else None
+    content = b''
+    try:
+        content = await post(http, host, port, path, body, timeout)
+        jsonresult = json.loads(content.decode('utf-8'))
+    except Exception as e:
+        observe_rpc('batch', begin, body, content, True)
+        if isinstance(e, ValueError):
+            return None
+        raise
+    return jsonrpc_batch_results(ids, begin, body, content, jsonresult)
+
+
+def add_fnf_handling(call, handlers):
+    '''handlers may be plain functions or coroutine functions.'''
+
+    async def wrap(method, *args, **kwargs):
+        try:
+            return await call(method, *args, **kwargs)
+        except JsonRPCError as e:
+            if e.code != ERROR_CODE_FILE_NOT_FOUND:
+                raise
+        with running_handlers(handlers, method) as device_handlers:
+            # any handler returns True will break the left handlers
+            for handler in device_handlers:
+                result = handler(handlers.get('device', None))
+                if inspect.isawaitable(result):
+                    result = await result
+                if result:
+                    break
+        return await call(method, *args, **kwargs)
+    return wrap
+
+
+async def recover(policy, error, recover, call):
+    '''RecoveryPolicy.recover with awaited recover(level) and call().'''
+    steps, outcome = policy.steps(error), None
+    while True:
+        try:
+            delay, level = steps.send(outcome)
+        except StopIteration:
+            return result
+        outcome = None
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            if level != 'retry':
+                await recover(level)
+            result = await call()
+        except (IOError, JsonRPCError) as e:
+            outcome = e
+
+
+def add_recovery(call, recover_level, policy=None):
+    '''await recover_level(level) is called with the levels of RecoveryPolicy.'''
+    policy = policy or RecoveryPolicy()
+
+    async def wrap(method, *args, **kwargs):
+        try:
+            return await call(method, *args, **kwargs)
+        except RECOVERABLE_ERRORS as e:
+            error = e
+        return await recover(policy, error, recover_level, lambda: call(method, *args, **kwargs))
+    return wrap
+
+
+class AsyncJsonRPCBatch(JsonRPCBatch):
+
+    '''
+    JsonRPCBatch sent when the async with block exits.
+    Usage:
+    async with d.batch() as b:
+        info = b.deviceInfo()
+        found = b.exist(Selector(text="OK"))
+    info.result(), found.result()
+    '''
+
+    def entry_call(self, outcome):
+        call = super(AsyncJsonRPCBatch, self).entry_call(outcome)
+
+        async def entry(method, *args, **kwargs):
+            result = call(method, *args, **kwargs)  # the batch answer, or a coroutine of a single call
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        return entry
+
+    async def execute(self):
+        '''send the queued calls and resolve their futures.'''
+        queue = self.take()
+        if not queue:
+            return
+        calls = self.entry_calls(queue, await self.send(queue))
+        for (method, args, kwargs, future), call in zip(queue, calls):
+            try:
+                future.set_result(await call(method, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+    def __enter__(self):
+        raise TypeError("use async with to send the batch.")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.execute()
+        else:
+            self.take()
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except ProcessLookupError:
+        pass
+
+
+class AsyncAdb(object):
+
+    '''Adb commands run as asyncio subprocesses.'''
+
+    def __init__(self, serial=None, adb_server_host=None, adb_server_port=None):
+        self.sync = Adb(serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
+        self.adb_server_host = self.sync.adb_server_host
+        self.adb_server_port = self.sync.adb_server_port
+
+    def device_serial(self):
+        '''the serial given or found by resolve_serial(), None before.'''
+        return self.sync.default_serial
+
+    async def raw_cmd(self, *args):
+        '''adb command. return the asyncio.subprocess.Process.'''
+        cmd_line = [self.sync.adb()] + self.sync.adbHostPortOptions + list(args)
+        logging.debug('EXEC:{}'.format(cmd_line))
+        if not collector.enabled:
+            return await self.__exec(cmd_line)
+        begin = time.time()
+        try:
+            process = await self.__exec(cmd_line)
+        except Exception:
+            collector.observe('adb', adb_command_name(args), time.time() - begin, error=True)
+            raise
+        collector.observe('adb', adb_command_name(args), time.time() - begin)
+        return process
+
+    @staticmethod
+    def __exec(cmd_line):
+        return asyncio.create_subprocess_exec(
+            *cmd_line, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def cmd(self, *args):
+        '''adb command for the device. return the asyncio.subprocess.Process.'''
+        return await self.raw_cmd(*["-s", await self.resolve_serial()] + list(args))
+
+    async def run(self, *args, timeout=None):
+        '''run an adb command for the device. return (returncode, stdout, stderr).'''
+        process = await self.cmd(*args)
+        try:
+            out, err = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            _kill(process)
+            raise
+        return process.returncode, out, err
+
+    async def resolve_serial(self):
+        if not self.sync.default_serial:
+            devices = await self.devices()
+            if devices:
+                if len(devices) == 1:
+                    self.sync.default_serial = list(devices.keys())[0]
+                else:
+                    raise EnvironmentError("Multiple devices attached but default android serial not set.")
+            else:
+                raise EnvironmentError("Device not attached.")
+        return self.sync.default_serial
+
+    async def devices(self):
+        '''get a dict of attached devices. key is the device serial, value is device name.'''
+        out = (await (await self.raw_cmd("devices")).communicate())[0].decode("utf-8")
+        match = "List of devices attached"
+        index = out.find(match)
+        if index < 0:
+            raise EnvironmentError("adb is not working.")
+        return dict([s.split("\t") for s in out[index + len(match):].strip().splitlines() if s.strip()])
+
+    async def forward(self, local_port, device_port):
+        '''adb port forward. return 0 if success, else non-zero.'''
+        return (await self.run("forward", "tcp:%d" % local_port, "tcp:%d" % device_port))[0]
+
+    async def forward_list(self):
+        '''adb forward --list'''
+        out = (await (await self.raw_cmd("forward", "--list")).communicate())[0]
+        return [line.strip().split() for line in out.decode("utf-8").strip().splitlines()]
+
+
+class AsyncAutomatorServer(object):
+
+    '''start and quit rpc server on device, asyncio counterpart of AutomatorServer.'''
+
+    def __init__(self,
+            serial=None, local_port=None, device_port=None,
+            adb_server_host=None, adb_server_port=None,
+            auto_restart=True):
+        self.uiautomator_process = None
+        self.output = []
+        self.http = HttpClient()
+        self.adb = AsyncAdb(serial=serial, adb_server_host=adb_server_host, adb_server_port=adb_server_port)
+        self.device_port = int(device_port) if device_port else DEVICE_PORT
+        self.local_port = local_port
+        self.__port_key = None
+        self.auto_restart = auto_restart
+        self.handlers = {'on': True, 'handlers': []}  # handler UI Not Found exception
+        self.long_poll_supported = True
+        self.batch_supported = True
+        self.apk_stager = ApkStager()
+        self.selector_registry = SelectorRegistry()
+        self.recovery_policy = RecoveryPolicy()
+        self.__clients = JsonRPCClientCache(lambda timeout: JsonRPCClient(self.__wrap(self.__call(timeout))))
+        self.__reader = None
+        self.__sdk = 0
+
+    async def resolve_local_port(self):
+        '''the local port already adb forwarded to the device port, or a free one.'''
+        if self.local_port is None:
+            try:
+                serial = await self.adb.resolve_serial()
+                for s, lp, rp in await self.adb.forward_list():
+                    if s == serial and rp == 'tcp:%d' % self.device_port:
+                        self.local_port = int(lp[4:])
+                        break
+            except (EnvironmentError, ValueError, IndexError):
+                pass
+            if self.local_port is None:
+                self.__port_key = (self.adb.adb_server_host, self.adb.device_serial(), self.device_port)
+                self.local_port = next_local_port(*self.__port_key)
+        return self.local_port
+
+    def release_port(self):
+        '''unregister this process from the port registry entry of the local port.'''
+        if self.__port_key is not None:
+            key, self.__port_key, self.local_port = self.__port_key, None, None
+            try:
+                port_registry.release(*key)
+            except (IOError, OSError) as e:
+                logging.debug('Port registry not available: {}'.format(e))
+
+    async def __rpc(self, timeout, call_desc):
+        port = self.local_port or await self.resolve_local_port()
+        return await jsonrpc_call(self.http, self.adb.adb_server_host, port, timeout, call_desc)
+
+    def __call(self, timeout):
+        to = timeout or JSONRPC_TIMEOUT
+
+        registry = self.selector_registry
+
+        async def call(method, *args, **kwargs):
+            sent = registry.substitute(args)
+            if sent is not args:
+                try:
+                    return await self.__rpc(to, {'method': method, 'args': sent})
+                except JsonRPCError as e:
+                    if e.code != ERROR_CODE_UNKNOWN_HANDLE:
+                        raise
+                    logging.debug('Selector handles lost, registering them again: {}'.format(e))
+                await self.reregister_selectors()
+                args = registry.substitute(args)
+            return await self.__rpc(to, {'method': method, 'args': args or kwargs})
+        return call
+
+    async def __register(self, call, selector):
+        registry = self.selector_registry
+        handle = registry.lookup(selector)
+        if handle is not None or not registry.supported:
+            return handle
+        try:
+            handle = await call('registerSelector', selector)
+        except JsonRPCError as e:
+            if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                raise
+            logging.debug('Selector registry not supported: {}'.format(e))
+            registry.supported = False
+            return None
+        for evicted in registry.add(selector, handle):
+            try:
+                await call('unregisterSelector', evicted)
+            except JsonRPCError as e:
+                logging.debug('Selector handle {} not unregistered: {}'.format(evicted, e))
+        return handle
+
+    async def register_selector(self, selector):
+        '''register the selector with the server, see AutomatorServer.register_selector.'''
+        return await self.__register(self.__call(None), selector.freeze())
+
+    async def unregister_selector(self, selector):
+        handle = self.selector_registry.remove(selector.freeze())
+        if handle is not None:
+            await self.__call(None)('unregisterSelector', handle)
+
+    async def reregister_selectors(self):
+        '''register the selectors of selector_registry again, after the server lost them.'''
+        call = self.__call(None)
+        for selector in self.selector_registry.reset():
+            try:
+                await self.__register(call, selector)
+            except (JsonRPCError, requests.exceptions.RequestException) as e:
+                logging.debug('Selector not registered again: {}'.format(e))
+
+    def __wrap(self, call):
+        return add_recovery(add_fnf_handling(call, self.handlers), self.recover, self.recovery_policy)
+
+    def jsonrpc(self, timeout=None):
+        '''JsonRPCClient whose calls return coroutines, see JsonRPCClientCache.'''
+        return self.__clients.get(timeout)
+
+    def jsonrpc_batch(self, timeout=None):
+        '''AsyncJsonRPCBatch which sends its calls in one request if the server accepts it.'''
+        to = timeout or JSONRPC_TIMEOUT
+
+        async def send_batch(calls):
+            if not self.batch_supported:
+                return None
+            call_descs = [
+                {'method': method, 'args': args or kwargs} for method, args, kwargs in calls]
+            port = self.local_port or await self.resolve_local_port()
+            try:
+                results = await jsonrpc_batch_call(self.http, self.adb.adb_server_host, port, to, call_descs)
+            except requests.exceptions.RequestException as e:
+                logging.debug('RequestException during JSONRPC batch call: {}'.format(e))
+                return None
+            if results is None:
+                logging.debug('JSONRPC batch rejected, falling back to single calls.')
+                self.batch_supported = False
+            return results
+        return AsyncJsonRPCBatch(send_batch, self.__call(timeout), self.__wrap)
+
+    async def sdk_version(self):
+        '''sdk version of connected device.'''
+        if self.__sdk == 0:
+            try:
+                out = (await self.adb.run("shell", "getprop", "ro.build.version.sdk"))[1]
+                self.__sdk = int(out.decode("utf-8").strip())
+            except (EnvironmentError, ValueError):
+                pass
+        return self.__sdk
+
+    async def device_state(self):
+        return InstallCache.parse_state((await self.adb.run(*InstallCache.state_command))[1])
+
+    async def install(self, force=False, confirm=False):
+        '''
+        install the apks unless the device already has the same build,
+        see InstallCache.installed for confirm.
+        False if the install was skipped, True otherwise.
+        '''
+        await self.adb.resolve_serial()  # the cache record is kept per serial
+        cache = InstallCache(self.adb, APK_PATHS)
+        if not force:
+            installed = cache.check()
+            if installed is None or (confirm and installed):
+                installed = cache.confirm(await self.device_state())
+            if installed:
+                logging.debug('Apks already installed, skip install.')
+                return False
+        success = True
+        for apkpath in cache.apk_paths:
+            out = (await self.adb.run("install", "-r", "-t", apkpath))[1]
+            success = success and b'Success' in out
+        if success:
+            cache.update(await self.device_state())
+        else:
+            cache.invalidate()
+        return True
+
+    async def set_forwarding(self):
+        await self.adb.forward(await self.resolve_local_port(), self.device_port)
+
+    async def start_instrumentation(self):
+        cmd = ['shell', 'am', 'instrument']
+        instrument_opts = ['-r', '-w', '-e', 'port', str(self.device_port)]
+        instrument_opts.extend(INSTRUMENT_EXTRA_OPTS)
+        cmd.extend(instrument_opts)
+        cmd.append('/'.join((TESTPACKAGE, TESTRUNNER)))
+        self.uiautomator_process = await self.adb.cmd(*cmd)
+        self.output = []
+
+    async def force_stop(self, package):
+        await self.adb.run('shell', 'am', 'force-stop', package)
+
+    async def stop_instrumentation(self, signal_server=False):
+        process = self.uiautomator_process
+        if process and process.returncode is None:
+            if signal_server:
+                try:
+                    await self.__rpc(5, {'method': 'stopServer'})
+                    await asyncio.wait_for(process.wait(), STOP_TIMEOUT)
+                except Exception:
+                    _kill(process)
+            else:
+                _kill(process)
+        self.uiautomator_process = None
+        self.__stop_reader()
+        await self.force_stop(MAINPACKAGE)
+        await self.force_stop(TESTPACKAGE)
+
+    def __stop_reader(self):
+        if self.__reader is not None:
+            self.__reader.cancel()
+            self.__reader = None
+
+    async def __read(self, process, wakeup, exited):
+        ready_regex = re.compile(READY_PATTERN)
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace')
+                self.output.append(line)
+                if ready_regex.search(line):
+                    wakeup.set()
+                    return
+                if line.startswith(INSTRUMENTATION_END_MARKERS):
+                    break
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('Instrument output closed: {}'.format(e))
+        exited.set()
+        wakeup.set()
+
+    async def wait_device(self, timeout):
+        '''
+        Wait for the rpc server as ServerReadiness does: the instrument output
+        is read meanwhile, the ready line triggers a ping at once and the end
+        of the instrumentation fails without waiting for the timeout.
+        The reader stops at the ready line or once the wait is over.
+        '''
+        process = self.uiautomator_process
+        wakeup, exited = asyncio.Event(), asyncio.Event()
+        self.__stop_reader()
+        self.__reader = asyncio.ensure_future(self.__read(process, wakeup, exited))
+        loop = asyncio.get_event_loop()
+        due = loop.time() + timeout
+        delay = PING_BACKOFF[0]
+        while True:
+            ended = exited.is_set()
+            if await self.ping(timeout=PING_TIMEOUT) == "pong":
+                self.__stop_reader()
+                return
+            if ended or loop.time() >= due:
+                break
+            try:
+                await asyncio.wait_for(wakeup.wait(), min(delay, max(due - loop.time(), 0)))
+                woken = True
+            except asyncio.TimeoutError:
+                woken = False
+            wakeup.clear()
+            delay = PING_BACKOFF[0] if woken else min(delay * 2, PING_BACKOFF[1])
+        self.__stop_reader()
+        logging.debug('Instrument output=[{}]'.format(''.join(self.output)))
+        if process is not None:
+            _kill(process)
+        if ended:
+            raise InstrumentationError("RPC server not started! (instrumentation ended)")
+        raise IOError("RPC server not started!")
+
+    async def start(self, timeout=JSONRPC_TIMEOUT, wait=True):
+        '''
+        Install, forward and start the rpc server.
+        With wait=False return the asyncio.Task of wait_device instead of
+        waiting, so other setup can run while the server starts.
+        A skipped install is retried as AutomatorServer.start does.
+        '''
+        installed = await self.install(confirm=not wait)
+        await self.set_forwarding()
+        await self.start_instrumentation()
+        if not wait:
+            return asyncio.ensure_future(self.wait_device(timeout))
+        try:
+            await self.wait_device(timeout)
+        except IOError:
+            if installed:
+                raise
+            logging.debug('RPC server not started, reinstall the apks.')
+            InstallCache(self.adb, APK_PATHS).invalidate()
+            await self.stop_instrumentation()
+            await self.install(force=True)
+            await self.start_instrumentation()
+            await self.wait_device(timeout)
+
+    async def recover(self, level):
+        '''recovery action of RecoveryPolicy level forward, restart or reinstall.'''
+        if level == 'forward':
+            await self.set_forwarding()
+        else:
+            await self.restart(reinstall=level == 'reinstall')
+
+    async def restart(self, reinstall=None):
+        '''
+        Restart the instrumentation. The apks are reinstalled when it does
+        not come up (reinstall=None), always (True) or never (False).
+        '''
+        await self.set_forwarding()
+        if not self.auto_restart:
+            return
+
+        if not reinstall:
+            await self.stop_instrumentation()
+            await self.start_instrumentation()
+
+            try:
+                await self.wait_device(timeout=RESTART_TIMEOUT_AFTER_INSTRUMENT_RESET)
+                await self.reregister_selectors()
+                return
+            except IOError:
+                if reinstall is False:
+                    raise
+
+        await self.stop_instrumentation()
+        await self.install(force=True)
+        await self.start_instrumentation()
+        await self.wait_device(timeout=RESTART_TIMEOUT_AFTER_REINSTALL)
+        await self.reregister_selectors()
+
+    async def ping(self, timeout=JSONRPC_TIMEOUT):
+        try:
+            return await self.__rpc(timeout, {'method': 'ping'})
+        except Exception:
+            return None
+
+    async def alive(self):
+        '''Check if the rpc server is alive.'''
+        return await self.ping() == "pong"
+
+    async def stop(self):
+        '''Stop the rpc server.'''
+        await self.stop_instrumentation(signal_server=True)
+        self.http.close()
+        self.release_port()
+
+    async def screenshot(self, scale=1.0, quality=100):
+        '''png content from the screenshot endpoint, None if it is not available.'''
+        port = self.local_port or await self.resolve_local_port()
+        try:
+            status, headers, content = await self.http.request(
+                'GET', self.adb.adb_server_host, port,
+                '/screenshot.png?scale={}&quality={}'.format(scale, quality), timeout=JSONRPC_TIMEOUT)
+        except (OSError, EOFError, asyncio.TimeoutError) as e:
+            logging.debug('Screenshot request failed: {}'.format(e))
+            return None
+        return content if status == 200 and content else None
+
+
+class AsyncDevice(AutomatorDevice):
+
+    '''
+    AutomatorDevice whose calls return coroutines.
+    Properties which call the device (info, exists, count, orientation, ...)
+    are awaited as well: await d.info, await d(text="OK").exists.
+    '''
+
+    __alias = {
+        "width": "displayWidth",
+        "height": "displayHeight"
+    }
+
+    def __init__(self,
+            serial=None, local_port=None, device_port=None,
+            adb_server_host=None, adb_server_port=None,
+            auto_restart_server=True,
+            jsonrpc_timeout=None, server=None):
+        if server is None:
+            server = AsyncAutomatorServer(
+                serial=serial,
+                local_port=local_port,
+                device_port=device_port,
+                adb_server_host=adb_server_host,
+                adb_server_port=adb_server_port,
+                auto_restart=auto_restart_server
+            )
+        super(AsyncDevice, self).__init__(server=server, jsonrpc_timeout=jsonrpc_timeout)
+
+    @property
+    def info(self):
+        '''coroutine of the device info, not cached.'''
+        return self.jsonrpc().deviceInfo()
+
+    def timeout(self, timeout):
+        return AsyncDevice(server=self.server, jsonrpc_timeout=timeout)
+
+    def __call__(self, **kwargs):
+        return AsyncDeviceObject(self, FrozenSelector(**kwargs))
+
+    def __getattr__(self, attr):
+        '''alias of fields in info property, e.g. await d.displayWidth.'''
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        async def field():
+            info = await self.info
+            if attr in info:
+                return info[attr]
+            elif attr in self.__alias:
+                return info[self.__alias[attr]]
+            raise AttributeError("%s attribute not found!" % attr)
+        return field()
+
+    async def dump(self, filename=None, compressed=True, pretty=True):
+        '''dump device window and pull to local file.'''
+        content = await self.jsonrpc().dumpWindowHierarchy(compressed, None)
+        raw = content.encode("utf-8")
+        if filename:
+            with open(filename, "wb") as f:
+                f.write(raw)
+        if pretty and "\n " not in content:
+            content = U(pretty_xml(raw))
+        return content
+
+    async def dump_nodes(self, filename=None, compressed=True):
+        '''
+        dump device window and return a generator of its hierarchy Node, see AutomatorDevice.dump_nodes.
+        Usage:
+        for node in await d.dump_nodes():
+            print(node.get("text"))
+        '''
+        raw = (await self.jsonrpc().dumpWindowHierarchy(compressed, None)).encode("utf-8")
+        if filename:
+            with open(filename, "wb") as f:
+                f.write(raw)
+        return iter_nodes(raw)
+
+    async def snapshot(self, compressed=False, compact=False):
+        '''
+        Dump the window hierarchy once and evaluate selectors on it locally.
+        compact keeps it as a CompactHierarchy.
+        Usage:
+        snap = await d.snapshot()
+        snap(text="OK").exists  # no RPC
+        await snap(text="OK").click()  # sent to the device
+        '''
+        content = await self.jsonrpc().dumpWindowHierarchy(compressed, None)
+        return Snapshot(self, (CompactHierarchy if compact else Hierarchy).parse(content), compressed)
+
+    async def at(self, x, y):
+        '''the top most object containing the point (x, y), from a new snapshot.'''
+        return (await self.snapshot()).at(x, y)
+
+    async def screenshot(self, filename, scale=1.0, quality=100):
+        '''take screenshot to filename. return filename, or None if it failed.'''
+        with open(filename, "wb") as f:
+            capture = await self.capture(f, scale, quality)
+        if capture.ok:
+            return filename
+        os.remove(filename)
+        return None
+
+    async def capture(self, out, scale=1.0, quality=100):
+        '''write a screenshot to out and return its Capture, see AutomatorDevice.capture.'''
+        timings = []
+        begin = time.time()
+        content = await self.server.screenshot(scale, quality)
+        if content:
+            out.write(content)
+        timings.append(('http', time.time() - begin))
+        if content:
+            return capture_done('http', len(content), timings)
+        begin = time.time()
+        out = CaptureOutput(out)
+        size = await self.__screencap(out)
+        timings.append(('screencap', time.time() - begin))
+        if size:
+            out.commit()
+        else:
+            out.rewind()
+        return capture_done('screencap' if size else None, size, timings)
+
+    def capture_stream(self, *args, **kwargs):
+        # CaptureStream captures on its own thread, which cannot await capture.
+        raise TypeError("capture_stream needs a sync device, use await d.capture(out) in a loop instead.")
+
+    async def __screencap(self, out):
+        process = await self.server.adb.cmd("exec-out", "screencap", "-p")
+        size = 0
+        while True:
+            chunk = await process.stdout.read(SCREENSHOT_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            size += len(chunk)
+        return size if await process.wait() == 0 else 0
+
+    def freeze_rotation(self, freeze=True):
+        '''freeze or unfreeze the device rotation in current status.'''
+        return self.jsonrpc().freezeRotation(freeze)
+
+    @property
+    def orientation(self):
+        '''coroutine of the orientation name, see AutomatorDevice.orientation.'''
+        async def orientation():
+            rotation = (await self.info)["displayRotation"]
+            return ORIENTATIONS[rotation][1]
+        return orientation()
+
+    @orientation.setter
+    def orientation(self, value):
+        raise AttributeError("use await d.set_orientation(value) instead.")
+
+    async def set_orientation(self, value):
+        '''orient the device to left/l, right/r, natural/n or upsidedown/u.'''
+        for values in ORIENTATIONS:
+            if value in values:
+                # can not set upside-down until api level 18.
+                return await self.jsonrpc().setOrientation(values[1])
+        raise ValueError("Invalid orientation.")
+
+    def clear_traversed_text(self):
+        '''clear the last traversed text.'''
+        return self.jsonrpc().clearLastTraversedText()
+
+    @property
+    def watchers(self):
+        '''coroutine of the registered watchers.'''
+        async def watchers():
+            return AsyncWatchers(self, await self.jsonrpc().getWatchers())
+        return watchers()
+
+    def watcher(self, name):
+        return AsyncWatcher(self, name)
+
+    def wakeup(self):
+        '''turn on screen in case of screen off.'''
+        return self.jsonrpc().wakeUp()
+
+    def sleep(self):
+        '''turn off screen in case of screen on.'''
+        return self.jsonrpc().sleep()
+
+    @property
+    def screen(self):
+        '''
+        Turn on/off screen.
+        Usage:
+        await d.screen.on()
+        await d.screen.off()
+        await d.screen.state()  # "on" or "off"
+        '''
+        return AsyncScreen(self)
+
+    @fluent_method(action=["idle", "update", "stable"])
+    def wait(self, action, timeout=None, package_name=None, window_ms=STABLE_WINDOW, matches=STABLE_MATCHES,
+             ignore=()):
+        '''
+        Waits for idle, a window update or a stable window as AutomatorDevice.wait does.
+        Usage:
+        await d.wait.idle(timeout=1000)
+        await d.wait.stable(window_ms=500, timeout=10000)
+        '''
+        if action == "stable":
+            return self.__wait_stable(window_ms, 10000 if timeout is None else timeout, matches, ignore)
+        if timeout is None:
+            timeout = 1000
+        http_timeout = timeout / 1000 + JSONRPC_TIMEOUT
+        if action == "idle":
+            return self.jsonrpc(timeout=http_timeout).waitForIdle(timeout)
+        elif action == "update":
+            return self.jsonrpc(timeout=http_timeout).waitForWindowUpdate(package_name, timeout)
+
+    async def __wait_stable(self, window_ms, timeout, matches, ignore):
+        tracker = StabilityTracker(window_ms / 1000.0, matches, ignore)
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout / 1000.0
+        while True:
+            content = await self.jsonrpc().dumpWindowHierarchy(True, None)
+            stable, delay = tracker.observe(content, loop.time())
+            if stable:
+                return True
+            if loop.time() + delay >= deadline:
+                return False
+            await asyncio.sleep(delay)
+
+    async def exists(self, **kwargs):
+        '''Check if the specified ui object by kwargs exists.'''
+        return await self(**kwargs).exists
+
+    async def remote_exec(self, text, timeout=60000, on_output=None):
+        '''run a script on the device and return its stdout, see AutomatorDevice.remote_exec.'''
+        token = await self.jsonrpc().runScript(text)
+        result, streamed = await self.__wait_result(
+            token, 'getScriptResult', 'waitScriptResult', timeout, on_output)
+        flush_output(result, streamed, on_output)
+        if result.get('resultCode') == 0:
+            return result['stdOutString']
+        else:
+            raise RuntimeError(
+                'Remote script execution failed: code={resultCode}, message={stdErrString}'.format(**result))
+
+    async def remote_exec_apk(self, apk_path, class_name, args_dict, timeout=60000, on_output=None):
+        token = await self.__run_apk(apk_path, class_name, args_dict)
+        result, streamed = await self.__wait_result(
+            token, 'getRunApkResult', 'waitRunApkResult', timeout, on_output)
+        flush_output(result, streamed, on_output)
+        return result
+
+    async def __wait_result(self, token, poll_method, wait_method, timeout, on_output):
+        '''long poll for the result of a remote run, or poll with backoff, as AutomatorDevice does.'''
+        due = time.time() + timeout / 1000.0
+        offset, delay = 0, RESULT_POLL_BACKOFF[0]
+        while True:
+            left = due - time.time()
+            if left <= 0:
+                raise RuntimeError('Remote script execution timeout')
+            if self.server.long_poll_supported:
+                wait = int(min(left * 1000, LONG_POLL_WAIT))
+                client = self.jsonrpc(timeout=LONG_POLL_WAIT / 1000.0 + JSONRPC_TIMEOUT)
+                try:
+                    reply = await getattr(client, wait_method)(token, offset, wait)
+                except JsonRPCError as e:
+                    if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                        raise
+                    logging.debug('Long poll not supported, polling {}: {}'.format(poll_method, e))
+                    self.server.long_poll_supported = False
+                    continue
+                output = reply.get('output')
+                if output:
+                    offset += len(output)
+                    if on_output is not None:
+                        on_output(output)
+                if reply.get('result') is not None:
+                    return reply['result'], offset
+            else:
+                result = await getattr(self.jsonrpc(), poll_method)(token)
+                if result is not None:
+                    return result, offset
+                await asyncio.sleep(min(delay, left))
+                delay = min(delay * 2, RESULT_POLL_BACKOFF[1])
+
+    async def __run_apk(self, apk_path, class_name, args_dict):
+        '''start the apk staged by its hash, or sent inline, as AutomatorDevice does.'''
+        stager = self.server.apk_stager
+        if stager.supported:
+            try:
+                return await self.__run_staged(stager, apk_path, class_name, args_dict)
+            except JsonRPCError as e:
+                if e.code != ERROR_CODE_METHOD_NOT_FOUND:
+                    raise
+                logging.debug('APK staging not supported, sending the apk inline: {}'.format(e))
+                stager.supported = False
+        with open(apk_path, 'rb') as f:
+            apk_data = base64.b64encode(f.read()).decode('ascii')
+        return await self.jsonrpc().runApk(apk_data, class_name, args_dict)
+
+    async def __run_staged(self, stager, apk_path, class_name, args_dict):
+        digest = stager.digest(apk_path)
+        if digest in stager.staged:
+            try:
+                return await self.jsonrpc().runStagedApk(digest, class_name, args_dict)
+            except JsonRPCError as e:
+                if e.code == ERROR_CODE_METHOD_NOT_FOUND:
+                    raise
+                stager.staged.discard(digest)
+        if not await self.jsonrpc().apkStaged(digest):
+            size = os.path.getsize(apk_path)
+            for offset, data in stager.chunks(apk_path):
+                await self.jsonrpc().stageApkChunk(digest, offset, size, data)
+        stager.staged.add(digest)
+        return await self.jsonrpc().runStagedApk(digest, class_name, args_dict)
+
+ORIENTATIONS = (  # device orientation
+    (0, "natural", "n", 0),
+    (1, "left", "l", 90),
+    (2, "upsidedown", "u", 180),
+    (3, "right", "r", 270)
+)
+
+
+class AsyncWatchers(list):
+
+    def __init__(self, device, names):
+        super(AsyncWatchers, self).__init__(names)
+        self.device = device
+
+    @property
+    def triggered(self):
+        return self.device.jsonrpc().hasAnyWatcherTriggered()
+
+    async def remove(self, name=None):
+        for name in [name] if name else list(self):
+            await self.device.jsonrpc().removeWatcher(name)
+
+    async def reset(self):
+        await self.device.jsonrpc().resetWatcherTriggers()
+        return self
+
+    async def run(self):
+        await self.device.jsonrpc().runWatchers()
+        return self
+
+
+class AsyncWatcher(object):
+
+    def __init__(self, device, name):
+        self.device = device
+        self.name = name
+        self.__selectors = []
+
+    @property
+    def triggered(self):
+        return self.device.jsonrpc().hasWatcherTriggered(self.name)
+
+    def remove(self):
+        return self.device.jsonrpc().removeWatcher(self.name)
+
+    def when(self, **kwargs):
+        self.__selectors.append(Selector(**kwargs))
+        return self
+
+    def click(self, **kwargs):
+        return self.device.jsonrpc().registerClickUiObjectWatcher(self.name, self.__selectors, Selector(**kwargs))
+
+    @fluent_method(
+        "home", "back", "left", "right", "up", "down", "center",
+        "search", "enter", "delete", "del", "recent", "volume_up",
+        "menu", "volume_down", "volume_mute", "camera", "power")
+    def press(self, *args):
+        return self.device.jsonrpc().registerPressKeyskWatcher(self.name, self.__selectors, args)
+
+
+class AsyncScreen(object):
+
+    def __init__(self, device):
+        self.device = device
+
+    def on(self):
+        return self.device.wakeup()
+
+    def off(self):
+        return self.device.sleep()
+
+    def __call__(self, action):
+        if action == "on":
+            return self.on()
+        elif action == "off":
+            return self.off()
+        else:
+            raise AttributeError("Invalid parameter: %s" % action)
+
+    async def state(self):
+        '''"on" or "off".'''
+        info = await self.device.info
+        if "screenOn" not in info:
+            raise EnvironmentError("Not supported on Android 4.3 and belows.")
+        return "on" if info["screenOn"] else "off"
+
+    def __eq__(self, value):
+        raise TypeError("use await d.screen.state() == %r instead." % (value,))
+
+    __ne__ = __eq__
+    __hash__ = object.__hash__
+
+
+class AsyncUiObjectMixin(object):
+
+    '''awaitable info aliases and the ui object actions which need the object info.'''
+
+    __alias = {'description': "contentDescription"}
+
+    def __getattr__(self, attr):
+        '''alias of fields in info property, e.g. await d(text="OK").bounds.'''
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+
+        async def field():
+            info = await self.info
+            if attr in info:
+                return info[attr]
+            elif attr in self.__alias:
+                return info[self.__alias[attr]]
+            raise AttributeError("%s attribute not found!" % attr)
+        return field()
+
+    @property
+    def info(self):
+        '''coroutine of the ui object info as a UiObjectInfo.'''
+        async def info():
+            return UiObjectInfo.from_dict(await self.jsonrpc().objInfo(self.selector))
+        return info()
+
+    def snapshot(self):
+        '''same as info, the object info is not kept by async objects.'''
+        return self.info
+
+    refresh = snapshot
+
+    def clear_text(self):
+        '''clear text. alias for set_text(None).'''
+        return self.set_text(None)
+
+    @fluent_method(corner=["tl", "topleft", "br", "bottomright"])
+    async def long_click(self, corner=None):
+        '''
+        Perform a long click action on the object.
+        Usage:
+        await d(text="Image").long_click()
+        await d(text="Image").long_click.topleft()
+        '''
+        info = await self.info
+        if info["longClickable"]:
+            if corner:
+                return await self.jsonrpc().longClick(self.selector, corner)
+            else:
+                return await self.jsonrpc().longClick(self.selector)
+        else:
+            x, y = corner_point(info.get("visibleBounds") or info.get("bounds"), corner)
+            return await self.device.long_click(x, y)
+
+
+class AsyncDeviceNamedUiObject(AsyncUiObjectMixin, AutomatorDeviceNamedUiObject):
+
+    async def child(self, **kwargs):
+        return AsyncDeviceNamedUiObject(
+            self.device, await self.jsonrpc().getChild(self.selector, Selector(**kwargs)))
+
+    async def sibling(self, **kwargs):
+        return AsyncDeviceNamedUiObject(
+            self.device, await self.jsonrpc().getFromParent(self.selector, Selector(**kwargs)))
+
+
+class AsyncDeviceObject(AsyncUiObjectMixin, AutomatorDeviceObject):
+
+    '''
+    AutomatorDeviceObject whose calls return coroutines.
+    Usage:
+    await d(text="OK").click()
+    count = await d(className="android.widget.TextView").count
+    async for obj in d(className="android.widget.TextView"): ...
+    '''
+
+    def child(self, **kwargs):
+        '''set childSelector.'''
+        return AsyncDeviceObject(self.device, self.selector.clone().child(**kwargs))
+
+    def sibling(self, **kwargs):
+        '''set fromParent selector.'''
+        return AsyncDeviceObject(self.device, self.selector.clone().sibling(**kwargs))
+
+    child_selector, from_parent = child, sibling
+
+    async def child_by_text(self, txt, **kwargs):
+        args = [txt, kwargs.pop("allow_scroll_search")] if "allow_scroll_search" in kwargs else [txt]
+        return AsyncDeviceNamedUiObject(
+            self.device, await self.jsonrpc().childByText(self.selector, Selector(**kwargs), *args))
+
+    async def child_by_description(self, txt, **kwargs):
+        args = [txt, kwargs.pop("allow_scroll_search")] if "allow_scroll_search" in kwargs else [txt]
+        return AsyncDeviceNamedUiObject(
+            self.device, await self.jsonrpc().childByDescription(self.selector, Selector(**kwargs), *args))
+
+    async def child_by_instance(self, inst, **kwargs):
+        return AsyncDeviceNamedUiObject(
+            self.device, await self.jsonrpc().childByInstance(self.selector, Selector(**kwargs), inst))
+
+    def __len__(self):
+        raise TypeError("use await obj.count instead of len(obj).")
+
+    def instance(self, index, info=None):
+        '''the index-th matched object, not checked against count.'''
+        return AsyncDeviceObject(self.device, self.selector.freeze().pinned(index))
+
+    def __getitem__(self, index):
+        if index < 0:
+            raise IndexError()
+        return self.instance(index)
+
+    async def infos(self):
+        '''UiObjectInfo list of every matched object, the objInfo calls are sent concurrently.'''
+        count = await self.count
+        return list(await asyncio.gather(*[self.instance(index).info for index in range(count)]))
+
+    async def all(self):
+        '''list of every matched object pinned to its instance.'''
+        return [self.instance(index) for index in range(await self.count)]
+
+    def __iter__(self):
+        raise TypeError("use async for to iterate over the matched objects.")
+
+    def __aiter__(self):
+        return AsyncObjectIterator(self)
+
+    async def right(self, **kwargs):
+        '''nearest object matched by kwargs on the right of this object.'''
+        return beside_object(self.device, (await self.device.snapshot()).beside(
+            self.selector, "right", Selector(**kwargs)), kwargs)
+
+    async def left(self, **kwargs):
+        '''nearest object matched by kwargs on the left of this object.'''
+        return beside_object(self.device, (await self.device.snapshot()).beside(
+            self.selector, "left", Selector(**kwargs)), kwargs)
+
+    async def up(self, **kwargs):
+        '''nearest object matched by kwargs above this object.'''
+        return beside_object(self.device, (await self.device.snapshot()).beside(
+            self.selector, "up", Selector(**kwargs)), kwargs)
+
+    async def down(self, **kwargs):
+        '''nearest object matched by kwargs below this object.'''
+        return beside_object(self.device, (await self.device.snapshot()).beside(
+            self.selector, "down", Selector(**kwargs)), kwargs)
+
+
+class AsyncObjectIterator(object):
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.index = 0
+        self.length = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.length is None:
+            self.length = await self.obj.count
+        if self.index >= self.length:
+            raise StopAsyncIteration()
+        self.index += 1
+        return self.obj[self.index - 1]
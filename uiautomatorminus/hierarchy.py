@@ -0,0 +1,853 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local model of the window hierarchy returned by dumpWindowHierarchy."""
+
+import array
+import io
+import re
+import sys
+import xml.etree.ElementTree as ET
+import xml.sax
+import xml.sax.handler
+
+from .info import Rect, UiObjectInfo
+
+# selector field -> (node attribute, comparison)
+FIELDS = {
+    "text": ("text", "equals"),
+    "textContains": ("text", "contains"),
+    "textMatches": ("text", "matches"),
+    "textStartsWith": ("text", "startswith"),
+    "className": ("class", "equals"),
+    "classNameMatches": ("class", "matches"),
+    "description": ("content-desc", "equals"),
+    "descriptionContains": ("content-desc", "contains"),
+    "descriptionMatches": ("content-desc", "matches"),
+    "descriptionStartsWith": ("content-desc", "startswith"),
+    "checkable": ("checkable", "bool"),
+    "checked": ("checked", "bool"),
+    "clickable": ("clickable", "bool"),
+    "longClickable": ("long-clickable", "bool"),
+    "scrollable": ("scrollable", "bool"),
+    "enabled": ("enabled", "bool"),
+    "focusable": ("focusable", "bool"),
+    "focused": ("focused", "bool"),
+    "selected": ("selected", "bool"),
+    "packageName": ("package", "equals"),
+    "packageNameMatches": ("package", "matches"),
+    "resourceId": ("resource-id", "equals"),
+    "resourceIdMatches": ("resource-id", "matches"),
+    "index": ("index", "int"),
+}
+
+_bounds_re = re.compile(r"\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]")
+_patterns = {}
+
+
+def parse_bounds(value):
+    '''parse "[left,top][right,bottom]" to a (left, top, right, bottom) tuple.'''
+    match = _bounds_re.match(value or "")
+    if match is None:
+        return (0, 0, 0, 0)
+    return tuple(int(v) for v in match.groups())
+
+
+def _fullmatch(pattern, value):
+    '''java.lang.String.matches semantics: the whole value must match.'''
+    regex = _patterns.get(pattern)
+    if regex is None:
+        regex = _patterns[pattern] = re.compile(r"(?:%s)\Z" % pattern)
+    return regex.match(value) is not None
+
+
+def _compare(node, field, expected):
+    attr, how = FIELDS[field]
+    value = node.get(attr)
+    if how == "equals":
+        return value == expected
+    elif how == "contains":
+        return expected in value
+    elif how == "startswith":
+        return value.startswith(expected)
+    elif how == "matches":
+        return _fullmatch(expected, value)
+    elif how == "bool":
+        return (value == "true") == bool(expected)
+    else:
+        return node.index == int(expected)
+
+
+def node_matches(node, selector):
+    '''check the node against every field of the selector except instance.'''
+    for field, expected in selector.items():
+        if field in FIELDS and not _compare(node, field, expected):
+            return False
+    return True
+
+
+class Node(object):
+
+    '''A node element of the dumped window hierarchy.'''
+
+    __slots__ = ("attrib", "parent", "children", "bounds", "order", "end")
+
+    def __init__(self, attrib, parent, order):
+        self.attrib = attrib
+        self.parent = parent
+        self.children = []
+        self.bounds = parse_bounds(attrib.get("bounds"))
+        self.order = order  # position in document order
+        self.end = order + 1  # position after the last descendant
+
+    def get(self, attr):
+        return self.attrib.get(attr, "")
+
+    @property
+    def index(self):
+        return int(self.attrib.get("index") or 0)
+
+    @property
+    def info(self):
+        '''node properties in the same format as objInfo.'''
+        bounds = Rect(*self.bounds)
+        boolean = lambda attr: self.get(attr) == "true"
+        return UiObjectInfo({
+            "bounds": bounds,
+            "checkable": boolean("checkable"),
+            "checked": boolean("checked"),
+            "childCount": len(self.children),
+            "className": self.get("class"),
+            "clickable": boolean("clickable"),
+            "contentDescription": self.get("content-desc"),
+            "enabled": boolean("enabled"),
+            "focusable": boolean("focusable"),
+            "focused": boolean("focused"),
+            "longClickable": boolean("long-clickable"),
+            "packageName": self.get("package"),
+            "resourceName": self.get("resource-id") or None,
+            "scrollable": boolean("scrollable"),
+            "selected": boolean("selected"),
+            "text": self.get("text"),
+            "visibleBounds": bounds,
+        })
+
+    def __repr__(self):
+        return "<Node %s %s>" % (self.get("class"), self.get("bounds"))
+
+
+class Hierarchy(object):
+
+    '''
+    Window hierarchy kept in memory, on which Selector is evaluated locally.
+    Usage:
+    h = Hierarchy.parse(d.jsonrpc().dumpWindowHierarchy(False, None))
+    h.select(Selector(text="OK"))
+    '''
+
+    def __init__(self, nodes, rotation=0):
+        self.nodes = nodes  # all nodes in document order
+        self.roots = [node for node in nodes if node.parent is None]
+        self.rotation = rotation
+        self.__spatial_index = None
+
+    @classmethod
+    def parse(cls, content):
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        root = ET.fromstring(content)
+        nodes = []
+
+        def walk(element, parent):
+            for child in element:
+                if child.tag != "node":
+                    continue
+                node = Node(child.attrib, parent, len(nodes))
+                nodes.append(node)
+                if parent is not None:
+                    parent.children.append(node)
+                walk(child, node)
+                node.end = len(nodes)
+        walk(root, None)
+        return cls(nodes, int(root.attrib.get("rotation") or 0))
+
+    @property
+    def spatial_index(self):
+        if self.__spatial_index is None:
+            self.__spatial_index = SpatialIndex(self.nodes)
+        return self.__spatial_index
+
+    def descendants(self, node):
+        return self.nodes[node.order + 1:node.end]
+
+    def __scope(self, matches, relation):
+        '''nodes searched by a child/sibling selector, in document order.'''
+        orders, exclude = set(), set()
+        for node in matches:
+            if relation == "child":
+                orders.update(range(node.order + 1, node.end))
+            else:
+                exclude.add(node.order)
+                if node.parent is None:
+                    orders.update(range(len(self.nodes)))
+                else:
+                    orders.update(range(node.parent.order + 1, node.parent.end))
+        return [self.nodes[i] for i in sorted(orders - exclude)]
+
+    @staticmethod
+    def __instance(matches, selector):
+        if "instance" not in selector:
+            return matches
+        instance = int(selector["instance"])
+        return matches[instance:instance + 1]
+
+    def select(self, selector):
+        '''nodes matching the selector including its child/sibling chain.'''
+        matches = [node for node in self.nodes if node_matches(node, selector)]
+        matches = self.__instance(matches, selector)
+        chain = zip(selector.get("childOrSibling") or [], selector.get("childOrSiblingSelector") or [])
+        for relation, sub_selector in chain:
+            if not matches:
+                break
+            matches = [node for node in self.__scope(matches, relation)
+                       if node_matches(node, sub_selector)]
+            matches = self.__instance(matches, sub_selector)
+        return matches
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+
+def iter_nodes(content):
+    '''
+    generator of the Node of every node element in document order, parsed
+    incrementally. A node's children and end are complete once its
+    descendants have been consumed.
+    '''
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    stack, order = [], 0
+    for event, element in ET.iterparse(io.BytesIO(content), events=("start", "end")):
+        if element.tag != "node":
+            continue
+        if event == "start":
+            parent = stack[-1] if stack else None
+            node = Node(dict(element.attrib), parent, order)
+            order += 1
+            if parent is not None:
+                parent.children.append(node)
+            stack.append(node)
+            yield node
+        else:
+            stack.pop().end = order
+            element.clear()
+
+
+# bytes fed to the parser at a time when pretty printing
+PRETTY_CHUNK_SIZE = 64 * 1024
+
+
+def _escape(data, attr=False):
+    '''escape data as minidom of the running python writes it.'''
+    data = data.replace("&", "&amp;").replace("<", "&lt;")
+    if sys.version_info < (3, 13):
+        return data.replace("\"", "&quot;").replace(">", "&gt;")
+    data = data.replace(">", "&gt;")
+    if attr:
+        data = data.replace("\"", "&quot;").replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#9;")
+    return data
+
+
+class PrettyPrinter(xml.sax.handler.ContentHandler):
+
+    '''
+    SAX handler writing the document as xml.dom.minidom toprettyxml(indent)
+    does, holding only the open elements and their pending text.
+    '''
+
+    def __init__(self, write, indent="  "):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.write = write
+        self.indent = indent
+        self.__stack = []  # [name, expanded, text chunks] of the open elements
+
+    def startDocument(self):
+        self.write('<?xml version="1.0" ?>\n')
+
+    def __expand(self, state, depth):
+        '''close the start tag of the element with children and write its pending text.'''
+        if not state[1]:
+            self.write(">\n")
+            state[1] = True
+        if state[2]:
+            self.write(self.indent * depth + _escape("".join(state[2])) + "\n")
+            state[2] = []
+
+    def startElement(self, name, attrs):
+        depth = len(self.__stack)
+        if self.__stack:
+            self.__expand(self.__stack[-1], depth)
+        names = attrs.getNames()
+        if sys.version_info < (3, 8):  # minidom sorted the attributes
+            names = sorted(names)
+        self.write(self.indent * depth + "<" + name + "".join(
+            ' %s="%s"' % (attr, _escape(attrs.getValue(attr), True)) for attr in names))
+        self.__stack.append([name, False, []])
+
+    def characters(self, content):
+        if self.__stack:
+            self.__stack[-1][2].append(content)
+
+    def endElement(self, name):
+        _, expanded, text = self.__stack.pop()
+        depth = len(self.__stack)
+        if not expanded and text:  # a single text child is written inline
+            self.write(">" + _escape("".join(text)) + "</%s>\n" % name)
+        elif not expanded:
+            self.write("/>\n")
+        else:
+            if text:
+                self.write(self.indent * (depth + 1) + _escape("".join(text)) + "\n")
+            self.write(self.indent * depth + "</%s>\n" % name)
+
+
+def write_pretty(content, write, indent="  "):
+    '''
+    pass the xml content pretty printed to write, piece by piece.
+    The output is the same as minidom toprettyxml(indent) without building a DOM.
+    '''
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    parser.setContentHandler(PrettyPrinter(write, indent))
+    for begin in range(0, len(content), PRETTY_CHUNK_SIZE):
+        parser.feed(content[begin:begin + PRETTY_CHUNK_SIZE])
+    parser.close()
+
+
+def pretty_xml(content, indent="  "):
+    '''xml content pretty printed as minidom toprettyxml(indent) does.'''
+    parts = []
+    write_pretty(content, parts.append, indent)
+    return "".join(parts)
+
+
+# node attributes in the order dumpWindowHierarchy writes them
+NODE_ATTRS = (
+    "index", "text", "resource-id", "class", "package", "content-desc", "checkable", "checked",
+    "clickable", "enabled", "focusable", "focused", "scrollable", "long-clickable", "password",
+    "selected", "bounds")
+STRING_ATTRS = ("text", "resource-id", "class", "package", "content-desc")
+FLAG_ATTRS = (
+    "checkable", "checked", "clickable", "enabled", "focusable", "focused", "scrollable",
+    "long-clickable", "password", "selected")
+ALL_PRESENT = (1 << len(NODE_ATTRS)) - 1
+
+
+class StringTable(object):
+
+    '''interned strings, each stored once and referred to by its integer id.'''
+
+    def __init__(self):
+        self.strings = []
+        self.__ids = {}
+
+    def intern(self, value):
+        sid = self.__ids.get(value)
+        if sid is None:
+            sid = self.__ids[value] = len(self.strings)
+            self.strings.append(value)
+        return sid
+
+    def id_of(self, value):
+        '''id of value, or None if it was never interned.'''
+        return self.__ids.get(value)
+
+    def ids_where(self, predicate):
+        '''set of the ids whose string satisfies predicate.'''
+        return set(sid for sid, value in enumerate(self.strings) if predicate(value))
+
+    def __getitem__(self, sid):
+        return self.strings[sid]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class CompactNode(Node):
+
+    '''
+    Node view over a row of CompactHierarchy. Views are made on access
+    and compare equal when they refer to the same row.
+    '''
+
+    __slots__ = ("hierarchy", "row")
+
+    def __init__(self, hierarchy, row):
+        self.hierarchy = hierarchy
+        self.row = row
+
+    order = property(lambda self: self.row)
+    end = property(lambda self: self.hierarchy.end[self.row])
+    bounds = property(lambda self: self.hierarchy.bounds_of(self.row))
+
+    @property
+    def attrib(self):
+        return self.hierarchy.attrib_of(self.row)
+
+    @property
+    def parent(self):
+        parent = self.hierarchy.parent[self.row]
+        return CompactNode(self.hierarchy, parent) if parent >= 0 else None
+
+    @property
+    def children(self):
+        return [CompactNode(self.hierarchy, row) for row in self.hierarchy.child_rows(self.row)]
+
+    def get(self, attr):
+        return self.hierarchy.value_of(self.row, attr)
+
+    @property
+    def index(self):
+        return self.hierarchy.index[self.row]
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and other.hierarchy is self.hierarchy and other.row == self.row
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self.hierarchy), self.row))
+
+
+class CompactNodes(object):
+
+    '''sequence of the CompactNode views of a CompactHierarchy in document order.'''
+
+    def __init__(self, hierarchy):
+        self.hierarchy = hierarchy
+
+    def __len__(self):
+        return len(self.hierarchy.parent)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [CompactNode(self.hierarchy, row) for row in range(len(self))[key]]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(key)
+        return CompactNode(self.hierarchy, key)
+
+    def __iter__(self):
+        return (CompactNode(self.hierarchy, row) for row in range(len(self)))
+
+
+class CompactHierarchy(Hierarchy):
+
+    '''
+    Hierarchy stored column-wise: tree links, bounds and index in int
+    arrays, string attributes as ids of a StringTable and boolean attributes
+    as bit flags. Nodes are CompactNode views made on access, and select()
+    scans the columns instead of the nodes.
+    The columns support the buffer protocol, e.g. numpy.frombuffer(h.left, "i").
+    Usage:
+    h = CompactHierarchy.parse(d.jsonrpc().dumpWindowHierarchy(False, None))
+    h.select(Selector(text="OK"))
+    '''
+
+    INT_COLUMNS = ("parent", "first_child", "next_sibling", "end", "index", "left", "top", "right", "bottom")
+
+    def __init__(self, strings=None, rotation=0):
+        super(CompactHierarchy, self).__init__([], rotation)
+        self.strings = strings if strings is not None else StringTable()
+        for name in self.INT_COLUMNS:
+            setattr(self, name, array.array("i"))
+        self.string_columns = dict((attr, array.array("i")) for attr in STRING_ATTRS)
+        self.flags = array.array("H")
+        self.present = array.array("i")  # bit per NODE_ATTRS present in the dump
+        self.extra = {}  # row -> attributes beyond NODE_ATTRS
+        self.nodes = CompactNodes(self)
+
+    @classmethod
+    def parse(cls, content, strings=None):
+        '''
+        parse dumpWindowHierarchy output incrementally. strings may be a
+        StringTable shared by the hierarchies of a run.
+        '''
+        if not isinstance(content, bytes):
+            content = content.encode("utf-8")
+        hierarchy, stack, last_child = None, [], [None]
+        for event, element in ET.iterparse(io.BytesIO(content), events=("start", "end")):
+            if hierarchy is None:  # the root element
+                hierarchy = cls(strings, int(element.attrib.get("rotation") or 0))
+                continue
+            if element.tag != "node":
+                continue
+            if event == "start":
+                row = hierarchy.append(element.attrib, stack[-1] if stack else -1, last_child[-1])
+                last_child[-1] = row
+                stack.append(row)
+                last_child.append(None)
+            else:
+                hierarchy.end[stack.pop()] = len(hierarchy.parent)
+                last_child.pop()
+                element.clear()
+        if hierarchy is None:
+            raise ValueError("empty hierarchy")
+        hierarchy.roots = [CompactNode(hierarchy, row) for row in hierarchy.child_rows(-1)]
+        return hierarchy
+
+    def append(self, attrib, parent, previous):
+        '''add a node as the last child of the parent row, after the previous sibling row.'''
+        row = len(self.parent)
+        for name, value in zip(self.INT_COLUMNS, (parent, -1, -1, row + 1, 0, 0, 0, 0, 0)):
+            getattr(self, name).append(value)
+        if previous is not None:
+            self.next_sibling[previous] = row
+        elif parent >= 0:
+            self.first_child[parent] = row
+        present, flags, extra = 0, 0, {}
+        for attr, value in attrib.items():
+            try:
+                present |= 1 << NODE_ATTRS.index(attr)
+            except ValueError:
+                extra[attr] = value
+        for attr in STRING_ATTRS:
+            self.string_columns[attr].append(self.strings.intern(attrib.get(attr, "")))
+        for bit, attr in enumerate(FLAG_ATTRS):
+            if attrib.get(attr) == "true":
+                flags |= 1 << bit
+        self.flags.append(flags)
+        self.present.append(present)
+        self.index[row] = int(attrib.get("index") or 0)
+        self.left[row], self.top[row], self.right[row], self.bottom[row] = parse_bounds(attrib.get("bounds"))
+        if extra:
+            self.extra[row] = extra
+        return row
+
+    def child_rows(self, row):
+        '''rows of the children of row, or of the roots if row is -1.'''
+        child = self.first_child[row] if row >= 0 else (0 if len(self.parent) else -1)
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def bounds_of(self, row):
+        return (self.left[row], self.top[row], self.right[row], self.bottom[row])
+
+    def value_of(self, row, attr):
+        '''attribute value as the dump has it, "" if it is missing.'''
+        if attr in self.string_columns:
+            return self.strings[self.string_columns[attr][row]]
+        elif attr in FLAG_ATTRS:
+            if not self.present[row] >> NODE_ATTRS.index(attr) & 1:
+                return ""
+            return "true" if self.flags[row] >> FLAG_ATTRS.index(attr) & 1 else "false"
+        elif attr == "index":
+            return str(self.index[row]) if self.present[row] & 1 else ""
+        elif attr == "bounds":
+            return "[%d,%d][%d,%d]" % self.bounds_of(row) if self.present[row] >> NODE_ATTRS.index(attr) & 1 else ""
+        return self.extra.get(row, {}).get(attr, "")
+
+    def attrib_of(self, row):
+        present = self.present[row]
+        attrib = dict((attr, self.value_of(row, attr)) for bit, attr in enumerate(NODE_ATTRS) if present >> bit & 1)
+        attrib.update(self.extra.get(row, {}))
+        return attrib
+
+    def __filter(self, rows, field, expected):
+        '''rows whose column satisfies one selector field.'''
+        attr, how = FIELDS[field]
+        if how == "bool":
+            bit, flags = 1 << FLAG_ATTRS.index(attr), self.flags
+            return [row for row in rows if bool(flags[row] & bit) == bool(expected)]
+        elif how == "int":
+            index, expected = self.index, int(expected)
+            return [row for row in rows if index[row] == expected]
+        column = self.string_columns[attr]
+        if how == "equals":
+            sid = self.strings.id_of(expected)
+            return [row for row in rows if column[row] == sid] if sid is not None else []
+        elif how == "contains":
+            sids = self.strings.ids_where(lambda value: expected in value)
+        elif how == "startswith":
+            sids = self.strings.ids_where(lambda value: value.startswith(expected))
+        else:
+            sids = self.strings.ids_where(lambda value: _fullmatch(expected, value))
+        return [row for row in rows if column[row] in sids]
+
+    def __match(self, rows, selector):
+        for field, expected in selector.items():
+            if field in FIELDS:
+                rows = self.__filter(rows, field, expected)
+                if not rows:
+                    break
+        if "instance" in selector:
+            instance = int(selector["instance"])
+            rows = rows[instance:instance + 1]
+        return rows
+
+    def __scope(self, rows, relation):
+        orders, exclude = set(), set()
+        for row in rows:
+            if relation == "child":
+                orders.update(range(row + 1, self.end[row]))
+            else:
+                exclude.add(row)
+                parent = self.parent[row]
+                orders.update(range(parent + 1, self.end[parent]) if parent >= 0 else range(len(self.parent)))
+        return sorted(orders - exclude)
+
+    def select(self, selector):
+        rows = self.__match(range(len(self.parent)), selector)
+        chain = zip(selector.get("childOrSibling") or [], selector.get("childOrSiblingSelector") or [])
+        for relation, sub_selector in chain:
+            if not rows:
+                break
+            rows = self.__match(self.__scope(rows, relation), sub_selector)
+        return [CompactNode(self, row) for row in rows]
+
+
+def node_keys(hierarchy):
+    '''
+    stable key of every node in document order: the resource-id, class and
+    sibling index of the node and of its ancestors, counted among siblings
+    sharing them.
+    '''
+    keys, seen = [], {}
+    for node in hierarchy:
+        parent = node.parent
+        key = (keys[parent.order] if parent is not None else None,
+               node.get("resource-id"), node.get("class"), node.index)
+        occurrence = seen.get(key, 0)
+        seen[key] = occurrence + 1
+        keys.append(key + (occurrence,))
+    return keys
+
+
+class HierarchyDiff(object):
+
+    '''
+    nodes added to and removed from a hierarchy, and (old, new) pairs of the
+    nodes whose attributes changed. False when nothing changed.
+    '''
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "<HierarchyDiff added=%d removed=%d changed=%d>" % (
+            len(self.added), len(self.removed), len(self.changed))
+
+
+class HierarchyDiffer(object):
+
+    '''
+    Structural diff of hierarchies, matching nodes by node_keys.
+    update() diffs each hierarchy against the previous one, so consecutive
+    dumps are keyed once. Attributes in ignore are not compared.
+    '''
+
+    def __init__(self, ignore=()):
+        self.ignore = frozenset(ignore)
+        self.last = None
+
+    def keyed(self, hierarchy):
+        '''(key, node) pairs in document order and the dict of them.'''
+        pairs = list(zip(node_keys(hierarchy), hierarchy))
+        return pairs, dict(pairs)
+
+    def __attrs(self, node):
+        attrib = node.attrib
+        if not self.ignore:
+            return attrib
+        return dict((attr, value) for attr, value in attrib.items() if attr not in self.ignore)
+
+    def compare(self, old, new):
+        '''HierarchyDiff of two keyed() hierarchies.'''
+        (old_pairs, old_nodes), (new_pairs, new_nodes) = old, new
+        added, changed = [], []
+        for key, node in new_pairs:
+            before = old_nodes.get(key)
+            if before is None:
+                added.append(node)
+            elif self.__attrs(before) != self.__attrs(node):
+                changed.append((before, node))
+        removed = [node for key, node in old_pairs if key not in new_nodes]
+        return HierarchyDiff(added, removed, changed)
+
+    def update(self, hierarchy):
+        '''diff against the hierarchy of the previous update, every node is added on the first.'''
+        keyed = self.keyed(hierarchy)
+        last, self.last = self.last, keyed
+        return self.compare(last or ([], {}), keyed)
+
+
+def diff(old, new, ignore=()):
+    '''HierarchyDiff from the old to the new hierarchy.'''
+    differ = HierarchyDiffer(ignore)
+    return differ.compare(differ.keyed(old), differ.keyed(new))
+
+
+# seconds before the next dump right after the window changed
+STABLE_MIN_INTERVAL = 0.05
+
+
+class StabilityTracker(object):
+
+    '''
+    Tell from consecutive dumps when the window has settled: the last
+    matches dumps are equal, ignoring the attributes in ignore, and span
+    window seconds. While the window changes the dumps back off from
+    STABLE_MIN_INTERVAL, once it looks still the remaining dumps are spread
+    over what is left of the window.
+    '''
+
+    def __init__(self, window, matches=3, ignore=()):
+        self.window = window
+        self.matches = max(matches, 2)
+        self.differ = HierarchyDiffer(ignore) if ignore else None
+        self.strings = StringTable()
+        self.last = None
+        self.since = None  # time of the first dump equal to the last one
+        self.streak = 0
+        self.__backoff = STABLE_MIN_INTERVAL
+
+    def __changed(self, content):
+        if content == self.last:
+            return False
+        first, self.last = self.last is None, content
+        if self.differ is None:
+            return True
+        return bool(self.differ.update(CompactHierarchy.parse(content, self.strings))) or first
+
+    def observe(self, content, now):
+        '''record a dump taken at now. return (stable, seconds to wait before the next dump).'''
+        spread = max(STABLE_MIN_INTERVAL, float(self.window) / (self.matches - 1))
+        if self.__changed(content):
+            self.since, self.streak = now, 1
+            delay = self.__backoff
+            self.__backoff = min(self.__backoff * 2, spread)
+            return False, delay
+        self.streak += 1
+        self.__backoff = STABLE_MIN_INTERVAL
+        if self.streak >= self.matches and now - self.since >= self.window:
+            return True, 0
+        left = max(0, self.since + self.window - now)
+        return False, left / max(1, self.matches - self.streak)
+
+
+def _overlap(low1, high1, low2, high2):
+    return max(low1, low2) < min(high1, high2)
+
+
+# distance from rect1 to rect2 in each direction, -1 if rect2 is not on that side.
+DISTANCES = {
+    "right": lambda r1, r2: r2[0] - r1[2] if _overlap(r1[1], r1[3], r2[1], r2[3]) else -1,
+    "left": lambda r1, r2: r1[0] - r2[2] if _overlap(r1[1], r1[3], r2[1], r2[3]) else -1,
+    "up": lambda r1, r2: r1[1] - r2[3] if _overlap(r1[0], r1[2], r2[0], r2[2]) else -1,
+    "down": lambda r1, r2: r2[1] - r1[3] if _overlap(r1[0], r1[2], r2[0], r2[2]) else -1,
+}
+
+
+class SpatialIndex(object):
+
+    '''
+    Uniform grid over node bounds for point, rectangle and
+    nearest-by-direction queries.
+    '''
+
+    def __init__(self, nodes, cell_size=64):
+        self.cell_size = cell_size
+        self.__cells = {}
+        self.__xrange = self.__yrange = (0, -1)
+        for node in nodes:
+            self.add(node)
+
+    def __cell(self, value):
+        return int(value) // self.cell_size
+
+    def __span(self, low, high):
+        '''cells covered by [low, high), at least one.'''
+        return range(self.__cell(low), self.__cell(max(low, high - 1)) + 1)
+
+    def add(self, node):
+        left, top, right, bottom = node.bounds
+        xs, ys = self.__span(left, right), self.__span(top, bottom)
+        self.__xrange = (min(self.__xrange[0], xs[0]), max(self.__xrange[1], xs[-1]))
+        self.__yrange = (min(self.__yrange[0], ys[0]), max(self.__yrange[1], ys[-1]))
+        for cx in xs:
+            for cy in ys:
+                self.__cells.setdefault((cx, cy), []).append(node)
+
+    def __collect(self, xs, ys):
+        found = {}
+        for cx in xs:
+            for cy in ys:
+                for node in self.__cells.get((cx, cy), ()):
+                    found[node.order] = node
+        return [found[order] for order in sorted(found)]
+
+    def at(self, x, y):
+        '''nodes containing the point, in document order.'''
+        return [node for node in self.__collect([self.__cell(x)], [self.__cell(y)])
+                if node.bounds[0] <= x < node.bounds[2] and node.bounds[1] <= y < node.bounds[3]]
+
+    def overlapping(self, bounds):
+        '''nodes whose bounds overlap the (left, top, right, bottom) rectangle.'''
+        left, top, right, bottom = bounds
+        return [node for node in self.__collect(self.__span(left, right), self.__span(top, bottom))
+                if _overlap(left, right, node.bounds[0], node.bounds[2]) and
+                _overlap(top, bottom, node.bounds[1], node.bounds[3])]
+
+    def nearest(self, bounds, direction, accept=None):
+        '''
+        Nearest node on the given side (right/left/up/down) of bounds, whose
+        extent overlaps bounds on the other axis. Ties go to the node first
+        in document order. accept optionally filters the candidates.
+        '''
+        distance = DISTANCES[direction]
+        left, top, right, bottom = bounds
+        horizontal = direction in ("left", "right")
+        forward = direction in ("right", "down")
+        if horizontal:
+            band, edge, extent = self.__span(top, bottom), right if forward else left, self.__xrange
+        else:
+            band, edge, extent = self.__span(left, right), bottom if forward else top, self.__yrange
+        if forward:
+            lines = range(self.__cell(edge), extent[1] + 1)
+        else:
+            lines = range(self.__cell(edge), extent[0] - 1, -1)
+        best, seen = None, set()
+        for line in lines:
+            # lower bound of the distance of nodes not yet seen
+            if forward:
+                bound = line * self.cell_size - edge
+            else:
+                bound = edge - (line + 1) * self.cell_size
+            if best is not None and bound > best[0]:
+                break
+            for cell in band:
+                for node in self.__cells.get((line, cell) if horizontal else (cell, line), ()):
+                    if node.order in seen:
+                        continue
+                    seen.add(node.order)
+                    if accept is not None and not accept(node):
+                        continue
+                    dist = distance(bounds, node.bounds)
+                    if dist >= 0 and (best is None or (dist, node.order) < best[:2]):
+                        best = (dist, node.order, node)
+        return best[2] if best is not None else None
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Read-only records of ui object info."""
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+RECT_FIELDS = ("left", "top", "right", "bottom")
+
+
+class Rect(tuple):
+
+    '''
+    (left, top, right, bottom) bounds. Fields read as rect.left or
+    rect["left"] as well, and a Rect equals the dict of its fields.
+    '''
+
+    __slots__ = ()
+
+    def __new__(cls, left=0, top=0, right=0, bottom=0):
+        return tuple.__new__(cls, (left, top, right, bottom))
+
+    @classmethod
+    def from_dict(cls, bounds):
+        return cls(bounds.get("left", 0), bounds.get("top", 0), bounds.get("right", 0), bounds.get("bottom", 0))
+
+    left = property(lambda self: tuple.__getitem__(self, 0))
+    top = property(lambda self: tuple.__getitem__(self, 1))
+    right = property(lambda self: tuple.__getitem__(self, 2))
+    bottom = property(lambda self: tuple.__getitem__(self, 3))
+
+    @property
+    def width(self):
+        return self.right - self.left
+
+    @property
+    def height(self):
+        return self.bottom - self.top
+
+    @property
+    def center(self):
+        return (self.left + self.right) / 2, (self.top + self.bottom) / 2
+
+    def contains(self, x, y):
+        return self.left <= x < self.right and self.top <= y < self.bottom
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        try:
+            return tuple.__getitem__(self, RECT_FIELDS.index(key))
+        except ValueError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in RECT_FIELDS else default
+
+    def keys(self):
+        return list(RECT_FIELDS)
+
+    def items(self):
+        return list(zip(RECT_FIELDS, self))
+
+    def to_dict(self):
+        return dict(zip(RECT_FIELDS, self))
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return "Rect(left=%r, top=%r, right=%r, bottom=%r)" % tuple(self)
+
+
+class UiObjectInfo(object):
+
+    '''
+    objInfo result as a read-only record. Fields read as info.text or
+    info["text"]; bounds and visibleBounds are Rect. Fields the server
+    sends beyond FIELDS are kept in extra.
+    It is a Mapping but not a dict: to_dict() gives the plain dict to
+    json.dumps or modify.
+    '''
+
+    FIELDS = (
+        "bounds", "checkable", "checked", "childCount", "className", "clickable",
+        "contentDescription", "enabled", "focusable", "focused", "longClickable",
+        "packageName", "resourceName", "scrollable", "selected", "text", "visibleBounds")
+    __slots__ = FIELDS + ("extra",)
+
+    def __init__(self, fields=None, **kwargs):
+        extra = {}
+        for source in (fields or {}, kwargs):
+            for name, value in source.items():
+                if name in ("bounds", "visibleBounds") and isinstance(value, dict):
+                    value = Rect.from_dict(value)
+                if name in self.FIELDS:
+                    object.__setattr__(self, name, value)
+                else:
+                    extra[name] = value
+        object.__setattr__(self, "extra", extra or None)
+
+    @classmethod
+    def from_dict(cls, fields):
+        '''UiObjectInfo of an objInfo dict, anything else is returned as is.'''
+        return cls(fields) if isinstance(fields, dict) else fields
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UiObjectInfo is read-only.")
+
+    def __delattr__(self, name):
+        raise AttributeError("UiObjectInfo is read-only.")
+
+    def __getattr__(self, name):  # unset slots and extra fields
+        extra = object.__getattribute__(self, "extra") if name != "extra" else None
+        if extra and name in extra:
+            return extra[name]
+        raise AttributeError("%s attribute not found!" % name)
+
+    def keys(self):
+        keys = [name for name in self.FIELDS if name in self]
+        return keys + sorted(self.extra) if self.extra else keys
+
+    def __contains__(self, name):
+        if name in self.FIELDS:
+            return hasattr(self, name)
+        return bool(self.extra) and name in self.extra
+
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def to_dict(self):
+        '''plain dict in the objInfo format.'''
+        return dict((name, value.to_dict() if isinstance(value, Rect) else value) for name, value in self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, UiObjectInfo)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return "UiObjectInfo(%s)" % ", ".join("%s=%r" % item for item in self.items())
+
+
+Mapping.register(UiObjectInfo)
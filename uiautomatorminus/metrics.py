@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Call counts, bytes and latency of rpc and adb calls."""
+
+import atexit
+import json
+import os
+import random
+import threading
+
+MAX_SAMPLES = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _quantile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Series(object):
+
+    '''Counters and a bounded latency sample of one (kind, name).'''
+
+    __slots__ = ("count", "errors", "bytes_out", "bytes_in", "total", "max", "samples")
+
+    def __init__(self):
+        self.count = self.errors = self.bytes_out = self.bytes_in = 0
+        self.total = self.max = 0.0
+        self.samples = []
+
+    def add(self, elapsed, bytes_out, bytes_in, error):
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(elapsed)
+        else:  # reservoir sampling keeps a uniform sample of all calls
+            i = random.randrange(self.count)
+            if i < MAX_SAMPLES:
+                self.samples[i] = elapsed
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+            "latency": {
+                "sum": self.total,
+                "max": self.max,
+                "p50": _quantile(ordered, 0.5),
+                "p95": _quantile(ordered, 0.95),
+                "p99": _quantile(ordered, 0.99),
+            },
+        }
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics(object):
+
+    '''
+    Process wide collector. kind is "rpc" (per JSON-RPC method), "adb"
+    (per adb command), "recovery" (per recovery level and outcome) or
+    "fnf" (UiObjectNotFound handlers).
+    Callers check enabled before measuring, so a disabled collector costs
+    one attribute lookup per call.
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.hooks = []
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_hook(self, hook):
+        '''
+        hook(kind, name, elapsed, bytes_out, bytes_in, error) is called on
+        every observation. Adding a hook enables the collector.
+        '''
+        self.hooks.append(hook)
+        self.enabled = True
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def observe(self, kind, name, elapsed, bytes_out=0, bytes_in=0, error=False):
+        with self.__lock:
+            series = self.__series.get((kind, name))
+            if series is None:
+                series = self.__series[(kind, name)] = Series()
+            series.add(elapsed, bytes_out, bytes_in, error)
+        for hook in self.hooks:
+            hook(kind, name, elapsed, bytes_out, bytes_in, error)
+
+    def reset(self):
+        with self.__lock:
+            self.__series = {}
+
+    def snapshot(self):
+        '''{kind: {name: {count, errors, bytes_out, bytes_in, latency: {sum, max, p50, p95, p99}}}}'''
+        with self.__lock:
+            items = [(key, series.summary()) for key, series in self.__series.items()]
+        result = {}
+        for (kind, name), summary in sorted(items):
+            result.setdefault(kind, {})[name] = summary
+        return result
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        '''the snapshot in Prometheus text exposition format.'''
+        snapshot = self.snapshot()
+        counters = (
+            ("uiautomator_calls_total", "count"),
+            ("uiautomator_errors_total", "errors"),
+            ("uiautomator_bytes_sent_total", "bytes_out"),
+            ("uiautomator_bytes_received_total", "bytes_in"),
+        )
+        lines = []
+        for metric, field in counters:
+            lines.append("# TYPE %s counter" % metric)
+            for kind, names in sorted(snapshot.items()):
+                for name, summary in sorted(names.items()):
+                    lines.append('%s{kind="%s",name="%s"} %d' % (metric, _label(kind), _label(name), summary[field]))
+        lines.append("# TYPE uiautomator_latency_seconds summary")
+        for kind, names in sorted(snapshot.items()):
+            for name, summary in sorted(names.items()):
+                labels = 'kind="%s",name="%s"' % (_label(kind), _label(name))
+                latency = summary["latency"]
+                for q in QUANTILES:
+                    lines.append('uiautomator_latency_seconds{%s,quantile="%s"} %r' % (
+                        labels, q, latency["p%d" % int(q * 100)]))
+                lines.append("uiautomator_latency_seconds_sum{%s} %r" % (labels, latency["sum"]))
+                lines.append("uiautomator_latency_seconds_count{%s} %d" % (labels, summary["count"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, prefix):
+        '''write prefix.json and prefix.prom.'''
+        with open(prefix + ".json", "w") as f:
+            f.write(self.to_json())
+        with open(prefix + ".prom", "w") as f:
+            f.write(self.to_prometheus())
+
+
+# UIAUTOMATOR_METRICS=1 enables the collector, UIAUTOMATOR_METRICS_DUMP=prefix
+# enables it as well and dumps it to prefix.json and prefix.prom at exit.
+DUMP_PREFIX = os.environ.get("UIAUTOMATOR_METRICS_DUMP")
+collector = Metrics(enabled=os.environ.get("UIAUTOMATOR_METRICS", "").lower() in ("1", "true", "yes") or bool(DUMP_PREFIX))
+
+if DUMP_PREFIX:
+    atexit.register(lambda: collector.dump(DUMP_PREFIX))